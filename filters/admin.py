@@ -1,5 +1,7 @@
 from django.contrib import admin
-from filters.models import EnteredImage, FilteredImage
+from filters.models import EnteredImage, FilteredImage, FilterCacheEntry, FilterJob
 
 admin.site.register(EnteredImage)
 admin.site.register(FilteredImage)
+admin.site.register(FilterCacheEntry)
+admin.site.register(FilterJob)
@@ -0,0 +1,196 @@
+"""Admission control for filter work.
+
+Before a request decodes an upload it asks for a share of the process's
+CPU and memory budget, estimated from the pixel count in the image header
+and the per-pixel ``cost`` of its filters. Requests that do not fit wait
+in line; once ``FILTER_ADMISSION_QUEUE_TIMEOUT`` passes, or the line is
+already ``FILTER_ADMISSION_MAX_QUEUE`` long, they are turned away with
+``Overloaded`` and the views answer 503 with ``Retry-After``.
+
+Images of at most ``FILTER_ADMISSION_FAST_LANE_PIXELS`` go through a
+separate fast lane with ``FILTER_ADMISSION_FAST_LANE_SHARE`` of the
+budget, so they never wait behind large ones. Within a lane requests are
+admitted in arrival order, so a large one is not starved by smaller ones
+behind it. A request larger than its whole lane runs once the lane is
+empty. Budgets are per process.
+"""
+import math
+import os
+import threading
+import time
+from collections import deque, namedtuple
+from contextlib import asynccontextmanager, contextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from PIL import Image
+
+from .metrics import stage
+from .registry import FilterError
+
+# JPEG decode and encode time per pixel, relative to a 3x3 kernel.
+DECODE_COST = 2.3
+ENCODE_COST = 1.0
+# Decoded source, working copy and output of a 3-channel image, plus encoder buffers.
+BYTES_PER_PIXEL = 12
+
+Cost = namedtuple('Cost', ['pixels', 'cpu', 'memory'])
+
+_lock = threading.Lock()
+_controller = None
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after):
+        super().__init__('The server is busy; retry later.')
+        self.retry_after = retry_after
+
+
+def enabled():
+    return getattr(settings, 'FILTER_ADMISSION_ENABLED', True)
+
+
+def estimate(image_file, specs, max_dimension=None, outputs=1):
+    """The ``Cost`` of running ``specs`` over ``image_file``, read from its header only.
+
+    ``outputs`` is the number of images encoded; each one past the first
+    also needs its own output buffer.
+    """
+    image_file.seek(0)
+    try:
+        width, height = Image.open(image_file).size
+    except Exception:
+        raise FilterError('Uploaded file is not a readable image.')
+    finally:
+        image_file.seek(0)
+    pixels = width * height
+    longest = max(width, height)
+    if max_dimension and longest > max_dimension:
+        pixels = round(pixels * (max_dimension / longest) ** 2)
+    cpu = pixels / 1e6 * (DECODE_COST + ENCODE_COST * outputs + sum(spec.cost for spec in specs))
+    return Cost(pixels, cpu, pixels * (BYTES_PER_PIXEL + 3 * (outputs - 1)))
+
+
+class Lane:
+    def __init__(self, cpu_budget, memory_budget):
+        self.cpu_budget = cpu_budget
+        self.memory_budget = memory_budget
+        self.cpu = 0.0
+        self.memory = 0
+        self.running = 0
+        self.waiting = deque()
+        # Moving average of how long admitted requests take.
+        self.seconds = 1.0
+
+    def fits(self, cost):
+        return self.running == 0 or (self.cpu + cost.cpu <= self.cpu_budget
+                                     and self.memory + cost.memory <= self.memory_budget)
+
+
+class Ticket:
+    __slots__ = ('lane', 'cost', 'started')
+
+    def __init__(self, lane, cost):
+        self.lane = lane
+        self.cost = cost
+        self.started = None
+
+
+class AdmissionController:
+    """CPU (in megapixel cost units) and memory budgets split over a fast and a standard lane."""
+
+    def __init__(self, cpu_budget, memory_budget, fast_lane_pixels, fast_lane_share=0.2, queue_timeout=5.0,
+                 max_queue=64):
+        self.fast_lane_pixels = fast_lane_pixels
+        self.queue_timeout = queue_timeout
+        self.max_queue = max_queue
+        self.condition = threading.Condition()
+        self.fast = Lane(cpu_budget * fast_lane_share, memory_budget * fast_lane_share)
+        self.standard = Lane(cpu_budget * (1 - fast_lane_share), memory_budget * (1 - fast_lane_share))
+
+    def acquire(self, cost):
+        """Wait for room for ``cost`` and return a ticket to ``release``; raises ``Overloaded``."""
+        ticket = Ticket(self.fast if cost.pixels <= self.fast_lane_pixels else self.standard, cost)
+        lane = ticket.lane
+        deadline = time.monotonic() + self.queue_timeout
+        with self.condition:
+            if len(lane.waiting) >= self.max_queue:
+                raise Overloaded(self.retry_after(lane))
+            lane.waiting.append(ticket)
+            while lane.waiting[0] is not ticket or not lane.fits(cost):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    lane.waiting.remove(ticket)
+                    self.condition.notify_all()
+                    raise Overloaded(self.retry_after(lane))
+                self.condition.wait(remaining)
+            lane.waiting.popleft()
+            lane.cpu += cost.cpu
+            lane.memory += cost.memory
+            lane.running += 1
+            # The next in line may fit as well.
+            self.condition.notify_all()
+        ticket.started = time.monotonic()
+        return ticket
+
+    def release(self, ticket):
+        lane = ticket.lane
+        with self.condition:
+            lane.cpu -= ticket.cost.cpu
+            lane.memory -= ticket.cost.memory
+            lane.running -= 1
+            lane.seconds = 0.8 * lane.seconds + 0.2 * (time.monotonic() - ticket.started)
+            self.condition.notify_all()
+
+    def retry_after(self, lane):
+        # Roughly how long until the work already admitted or queued drains.
+        queued = sum(ticket.cost.cpu for ticket in lane.waiting)
+        rounds = 1 + (lane.cpu + queued) / max(lane.cpu_budget, 1e-9)
+        return min(60, max(1, math.ceil(lane.seconds * rounds)))
+
+
+def get_controller():
+    global _controller
+    with _lock:
+        if _controller is None:
+            _controller = AdmissionController(
+                cpu_budget=getattr(settings, 'FILTER_ADMISSION_CPU_BUDGET', None) or 40 * os.cpu_count(),
+                memory_budget=getattr(settings, 'FILTER_ADMISSION_MEMORY_BUDGET', 2 * 2 ** 30),
+                fast_lane_pixels=getattr(settings, 'FILTER_ADMISSION_FAST_LANE_PIXELS', 2000000),
+                fast_lane_share=getattr(settings, 'FILTER_ADMISSION_FAST_LANE_SHARE', 0.2),
+                queue_timeout=getattr(settings, 'FILTER_ADMISSION_QUEUE_TIMEOUT', 5.0),
+                max_queue=getattr(settings, 'FILTER_ADMISSION_MAX_QUEUE', 64),
+            )
+    return _controller
+
+
+@contextmanager
+def admit(image_file, specs, max_dimension=None, outputs=1):
+    """Hold a share of the budget while filtering ``image_file`` with ``specs``."""
+    if not enabled():
+        yield
+        return
+    cost = estimate(image_file, specs, max_dimension, outputs)
+    controller = get_controller()
+    with stage('admission'):
+        ticket = controller.acquire(cost)
+    try:
+        yield
+    finally:
+        controller.release(ticket)
+
+
+@asynccontextmanager
+async def aadmit(image_file, specs, max_dimension=None):
+    """``admit`` for async views; waiting happens on a worker thread."""
+    if not enabled():
+        yield
+        return
+    cost = estimate(image_file, specs, max_dimension)
+    controller = get_controller()
+    with stage('admission'):
+        ticket = await sync_to_async(controller.acquire, thread_sensitive=False)(cost)
+    try:
+        yield
+    finally:
+        controller.release(ticket)
@@ -0,0 +1,146 @@
+"""Async filter endpoints for ASGI deployments.
+
+The sync views hold a server thread for the whole request. These parse
+the upload off the event loop, run decode, filter and encode on the
+shared process pool, and talk to the database through the async ORM, so
+one ASGI worker can keep many slow uploads in flight while every core
+filters. Under WSGI they still work, but gain nothing.
+"""
+import asyncio
+import os
+from concurrent.futures.process import BrokenProcessPool
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, JsonResponse
+from django.urls import reverse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.parsers import FormParser, JSONParser, MultiPartParser
+from rest_framework.request import Request
+
+from . import pipeline
+from .admission import Overloaded, aadmit
+from .cache import aget_cached_result
+from .ingest import open_upload
+from .metrics import TimedViewMixin, stage
+from .persistence import save_result, store_original_in_background
+from .registry import FilterError, get_filter
+from .serializers import EnteredImageSerializer, FilteredImageSerializer
+from .similarity import get_similar_cached_result, near_duplicate_distance
+from .views import (ConvolutionFilterView, FilterView, PipelineFilterView, is_flag_set, parse_encode_options,
+                    parse_max_dimension, parse_tiled)
+from .workers import discard_process_pool, get_process_pool
+
+
+# Exempt from CSRF checks like the DRF views, which API clients call without a token.
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncFilterView(TimedViewMixin, View):
+    """``FilterView`` as a native async view; takes the same fields except ``async``."""
+    parsers = (MultiPartParser(), FormParser(), JSONParser())
+    stages_view = FilterView
+
+    def get_metrics_name(self):
+        # Labels come from the registry, so unknown names in the URL cannot add new series.
+        filter_name = self.kwargs.get('filter_name')
+        if filter_name is None:
+            return 'async_pipeline'
+        try:
+            return f'async_{get_filter(filter_name).name}'
+        except FilterError:
+            return 'async_unknown'
+
+    def get_stages_view(self):
+        filter_name = self.kwargs.get('filter_name')
+        if filter_name == ConvolutionFilterView.filter_name:
+            # Caches under the kernel's digest, like the sync endpoint.
+            return ConvolutionFilterView()
+        return self.stages_view(filter_name=filter_name)
+
+    async def post(self, request, *args, **kwargs):
+        request = Request(request, parsers=self.parsers)
+        with stage('parse'):
+            # Django's multipart parser is synchronous.
+            await sync_to_async(lambda: request.data)()
+        image_file = request.FILES.get('image_file')
+        if not image_file:
+            return JsonResponse({'error': 'Image file is required.'}, status=400)
+
+        upload = await sync_to_async(open_upload)(image_file)
+        try:
+            view = self.get_stages_view()
+            stages = view.get_stages(request)
+            filter_used, suffix, params, default_format = view.get_output(stages)
+            max_dimension = parse_max_dimension(request)
+            if max_dimension:
+                params = dict(params or {}, max_dimension=max_dimension)
+                suffix = f'{suffix}_{max_dimension}'
+            output_format, options = parse_encode_options(request, default_format)
+            if options:
+                params = dict(params or {}, output=options)
+            process_only = is_flag_set(request, 'process_only')
+
+            filtered_image_obj = None
+            if not process_only:
+                with stage('hash'):
+                    content_hash = await sync_to_async(upload.sha256, thread_sensitive=False)()
+                with stage('cache'):
+                    filtered_image_obj = await aget_cached_result(content_hash, filter_used, params)
+                if filtered_image_obj is None and near_duplicate_distance() is not None:
+                    with stage('similar'):
+                        filtered_image_obj = await sync_to_async(get_similar_cached_result)(
+                            await sync_to_async(upload.perceptual_hash, thread_sensitive=False)(), filter_used, params)
+
+            if filtered_image_obj is None:
+                async with aadmit(image_file, [item.spec for item in stages], max_dimension):
+                    if not process_only:
+                        store_original_in_background(upload)
+                    # The upload buffer may be memory-mapped, which cannot be pickled.
+                    source = upload.data if isinstance(upload.data, bytes) else bytes(upload.data)
+                    with stage('process'):
+                        encoded = await run_in_process_pool(
+                            pipeline.process, source, pipeline.serialize(stages), max_dimension,
+                            parse_tiled(request), options)
+                if process_only:
+                    response = HttpResponse(encoded, content_type=output_format.content_type)
+                    name = os.path.splitext(os.path.basename(upload.name))[0].replace('"', '')
+                    response['Content-Disposition'] = f'inline; filename="{name}_{suffix}{output_format.extension}"'
+                    response['Vary'] = 'Accept'
+                    return response
+                _, filtered_image_obj = await sync_to_async(save_result)(
+                    upload, content_hash, encoded, filter_used, suffix, output_format.extension, params)
+
+            response = JsonResponse({
+                'entered_image': EnteredImageSerializer(filtered_image_obj.original_image).data,
+                'filtered_image': FilteredImageSerializer(filtered_image_obj).data
+            })
+            response['Vary'] = 'Accept'
+            if filtered_image_obj.pk is None:
+                response['Location'] = reverse('image-record', args=[filtered_image_obj.uuid])
+            return response
+
+        except Overloaded as e:
+            response = JsonResponse({'error': str(e)}, status=503)
+            response['Retry-After'] = str(e.retry_after)
+            return response
+        except FilterError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        except Exception as e:
+            return JsonResponse({'error': str(e)}, status=500)
+        finally:
+            await sync_to_async(upload.close)()
+
+
+class AsyncPipelineFilterView(AsyncFilterView):
+    stages_view = PipelineFilterView
+
+    def get_stages_view(self):
+        return self.stages_view()
+
+
+async def run_in_process_pool(func, *args):
+    try:
+        return await asyncio.get_running_loop().run_in_executor(get_process_pool(), func, *args)
+    except BrokenProcessPool:
+        discard_process_pool()
+        raise
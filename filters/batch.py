@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, wait
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+
+from . import pipeline
+from .cache import maybe_evict_cached_results, params_key
+from .db import ResultRow, insert_results
+from .derivatives import schedule_derivatives
+from .formats import get_format
+from .models import EnteredImage, FilteredImage
+from .registry import FilterError
+from .similarity import schedule_perceptual_hash
+from .workers import get_process_pool, process_pool_size
+
+
+def read_batch_inputs(request):
+    """Return ``(name, open_file)`` pairs from an ``archive`` zip or repeated ``image_files``."""
+    max_files = getattr(settings, 'FILTER_BATCH_MAX_FILES', 500)
+    archive = request.FILES.get('archive')
+    if archive is not None:
+        try:
+            zip_file = zipfile.ZipFile(archive)
+        except zipfile.BadZipFile:
+            raise FilterError('Archive is not a valid zip file.')
+        members = [info for info in zip_file.infolist()
+                   if not info.is_dir() and not info.filename.startswith('__MACOSX/')]
+        # file_size is the size declared in the archive; zipfile never
+        # decompresses more than that, so checking it bounds what is read.
+        max_file_bytes = getattr(settings, 'FILTER_BATCH_MAX_FILE_BYTES', 50 * 1024 * 1024)
+        max_bytes = getattr(settings, 'FILTER_BATCH_MAX_BYTES', 500 * 1024 * 1024)
+        for info in members:
+            if max_file_bytes is not None and info.file_size > max_file_bytes:
+                raise FilterError(f'{info.filename} is larger than the {max_file_bytes} byte limit per image.')
+        if max_bytes is not None and sum(info.file_size for info in members) > max_bytes:
+            raise FilterError(f'Archive contents are larger than the {max_bytes} byte limit.')
+        inputs = [(os.path.basename(info.filename), lambda info=info: zip_file.read(info)) for info in members]
+    else:
+        inputs = [(image_file.name, image_file.read) for image_file in request.FILES.getlist('image_files')]
+
+    if not inputs:
+        raise FilterError('Provide a zip archive or one or more image_files.')
+    if len(inputs) > max_files:
+        raise FilterError(f'Batches are limited to {max_files} images.')
+    return inputs
+
+
+def run_batch(inputs, stages, filter_used, suffix, max_dimension=None, encode_options=None):
+    """Filter every input on the process pool and yield results as they finish.
+
+    Each result is a dict with the input ``index`` and ``name`` plus either
+    the stored records or an ``error``. Files are stored as soon as their
+    image is done; rows are written in one transaction for every group of
+    images that finish together (see ``db.insert_results``).
+    """
+    text = pipeline.serialize(stages)
+    encode_options = encode_options or {}
+    params = {'max_dimension': max_dimension} if max_dimension else {}
+    if encode_options:
+        params['output'] = encode_options
+    params = params_key(params)
+    extension = get_format(encode_options.get('format', 'jpeg')).extension
+    pool = get_process_pool()
+    window = 2 * process_pool_size()
+    write_size = getattr(settings, 'FILTER_BATCH_WRITE_SIZE', 32)
+    pending = iter(enumerate(inputs))
+    running = {}
+    finished = []
+
+    def submit_next():
+        for index, (name, read) in pending:
+            data = read()
+            running[pool.submit(pipeline.process, data, text, max_dimension, encode_options=encode_options)] = (
+                index, name, data)
+            return
+
+    for _ in range(window):
+        submit_next()
+
+    while running:
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            index, name, data = running.pop(future)
+            submit_next()
+            try:
+                finished.append(store_files(index, name, data, future.result(), filter_used, suffix, extension))
+            except Exception as e:
+                yield {'index': index, 'name': name, 'error': str(e)}
+            if len(finished) >= write_size:
+                yield from write_rows(finished, params)
+                finished = []
+        if finished:
+            yield from write_rows(finished, params)
+            finished = []
+
+    maybe_evict_cached_results()
+
+
+def store_files(index, name, data, encoded, filter_used, suffix, extension='.jpg'):
+    content_hash = hashlib.sha256(data).hexdigest()
+    entered_image = EnteredImage(content_hash=content_hash)
+    entered_image.image_file.save(name, ContentFile(data), save=False)
+    stem = os.path.splitext(os.path.basename(entered_image.image_file.name))[0]
+    filtered_image = FilteredImage(filter_used=filter_used)
+    filtered_image.image_file.save(f'{stem}_{suffix}{extension}', ContentFile(encoded), save=False)
+    return index, name, entered_image, filtered_image, encoded
+
+
+def write_rows(finished, params=''):
+    # The same image twice in a batch, or one cached meanwhile, yields the one cached result.
+    cached = insert_results([ResultRow(entered_image, filtered_image, params, len(encoded))
+                             for _, _, entered_image, filtered_image, encoded in finished])
+
+    for (index, name, entered_image, filtered_image, encoded), result in zip(finished, cached):
+        schedule_derivatives(entered_image)
+        schedule_perceptual_hash(entered_image)
+        if result is filtered_image:
+            schedule_derivatives(filtered_image, encoded)
+        yield {
+            'index': index,
+            'name': name,
+            'entered_image': entered_image,
+            'filtered_image': result,
+            'data': encoded,
+        }
+
+
+def ndjson_stream(results, serialize):
+    for result in results:
+        yield json.dumps(serialize(result)) + '\n'
+
+
+class _ZipStream:
+    # zipfile writes to any object with write(); without tell() it switches
+    # to streaming mode with data descriptors.
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+
+def zip_stream(results, serialize):
+    """Stream filtered images as a zip, with a ``manifest.ndjson`` at the end."""
+    stream = _ZipStream()
+    manifest = []
+    names = set()
+    with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for result in results:
+            name = os.path.basename(result['filtered_image'].image_file.name) if 'data' in result else None
+            # Repeated images share one cached result, stored once.
+            if name is not None and name not in names:
+                archive.writestr(name, result['data'])
+                names.add(name)
+            manifest.append(json.dumps(serialize(result)))
+            yield stream.drain()
+        archive.writestr('manifest.ndjson', '\n'.join(manifest) + '\n')
+    yield stream.drain()
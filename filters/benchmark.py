@@ -0,0 +1,241 @@
+"""Filter benchmarks over a reproducible image corpus.
+
+Every case runs one filter over one corpus image and times the same
+stages a request goes through: decode, filter, encode and persist. The
+synthetic corpus is generated from a fixed seed, so its images are
+identical on every machine. The sample corpus is real photos resized to
+each resolution. Results are plain dicts, so they can be written to JSON
+and compared against a stored baseline with ``compare``.
+"""
+import hashlib
+import os
+import platform
+import statistics
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import cv2
+import numpy as np
+import PIL
+from django.db import transaction
+from django.test.utils import override_settings
+
+from . import engine
+from .black_and_white_filter import black_and_white_filter
+from .models import EnteredImage
+from .persistence import save_filtered_image
+from .pipeline import Stage, run_pipeline
+from .registry import FILTERS
+
+RESOLUTIONS = {
+    'vga': (640, 480),
+    '720p': (1280, 720),
+    '1080p': (1920, 1080),
+    '12mp': (4000, 3000),
+    '24mp': (6000, 4000),
+    '50mp': (8192, 6144),
+}
+MODES = ('L', 'RGB', 'RGBA')
+STAGES = ('decode', 'filter', 'encode', 'persist')
+# The original PIL implementation, kept to compare the engine against.
+LEGACY_FILTER = 'black_and_white_filter.py'
+SEED = 20231107
+# Filters with required parameters run with these; anything else gets none.
+FILTER_PARAMS = {
+    # A 5x5 Laplacian-of-Gaussian sharpen: dense and not separable.
+    'convolve': {'kernel': [[0, 0, -1, 0, 0], [0, -1, -2, -1, 0], [-1, -2, 17, -2, -1], [0, -1, -2, -1, 0],
+                            [0, 0, -1, 0, 0]]},
+}
+
+
+def synthetic_image(width, height, seed=SEED):
+    """A photo-like BGR image: smooth colour fields, edges and fine noise."""
+    rng = np.random.default_rng(seed)
+    coarse = rng.integers(0, 256, (height // 64 + 2, width // 64 + 2, 3), dtype=np.uint8)
+    image = cv2.resize(coarse, (width, height), interpolation=cv2.INTER_CUBIC)
+    for _ in range(12):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        color = tuple(int(value) for value in rng.integers(0, 256, 3))
+        cv2.circle(image, center, int(rng.integers(height // 20 + 1, height // 4 + 2)), color, -1, cv2.LINE_AA)
+    noise = rng.integers(-8, 9, (height, width, 1), dtype=np.int16)
+    return np.clip(image + noise, 0, 255).astype(np.uint8)
+
+
+def load_samples(paths, limit=None):
+    """Decode each distinct image file under ``paths`` (files or directories)."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path)))
+        else:
+            files.append(path)
+
+    samples, seen = [], set()
+    for path in files:
+        with open(path, 'rb') as source:
+            data = source.read()
+        digest = hashlib.sha256(data).hexdigest()
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None or digest in seen:
+            continue
+        seen.add(digest)
+        samples.append((os.path.basename(path), image))
+        if limit and len(samples) >= limit:
+            break
+    return samples
+
+
+def to_mode(image, mode):
+    """Convert a BGR image to the array layout of a PIL ``mode`` image."""
+    if mode == 'L':
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if mode == 'RGBA':
+        alpha = np.linspace(64, 255, image.shape[1], dtype=np.uint8)
+        return np.dstack([image, np.broadcast_to(alpha, image.shape[:2])])
+    return image
+
+
+def build_corpus(resolutions, modes, samples=()):
+    """Yield ``(corpus, resolution, mode, width, height, upload bytes)``.
+
+    Uploads are JPEG, except RGBA which is PNG so the alpha channel survives.
+    """
+    sources = [('synthetic', None)] + [(f'sample:{name}', image) for name, image in samples]
+    for resolution in resolutions:
+        width, height = RESOLUTIONS[resolution]
+        for corpus, source in sources:
+            if source is None:
+                image = synthetic_image(width, height)
+            else:
+                interpolation = cv2.INTER_AREA if source.shape[1] > width else cv2.INTER_CUBIC
+                image = cv2.resize(source, (width, height), interpolation=interpolation)
+            for mode in modes:
+                array = to_mode(image, mode)
+                if mode == 'RGBA':
+                    ok, buffer = cv2.imencode('.png', array, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+                else:
+                    ok, buffer = cv2.imencode('.jpg', array, [cv2.IMWRITE_JPEG_QUALITY, 90])
+                yield corpus, resolution, mode, width, height, buffer.tobytes()
+            del image
+
+
+def run_stages(name, data, persist=True):
+    """Run one request's worth of work and return the seconds spent per stage."""
+    timings = {}
+    if name == LEGACY_FILTER:
+        with tempfile.TemporaryDirectory() as directory:
+            source, target = os.path.join(directory, 'in'), os.path.join(directory, 'out.jpg')
+            with open(source, 'wb') as upload:
+                upload.write(data)
+            start = time.perf_counter()
+            black_and_white_filter(source, target)
+            timings['total'] = time.perf_counter() - start
+        return timings
+
+    start = time.perf_counter()
+    image = engine.decode(data)
+    timings['decode'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    image = run_pipeline(image, [Stage(FILTERS[name], FILTER_PARAMS.get(name, {}))])
+    timings['filter'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    encoded = engine.encode(image)
+    timings['encode'] = time.perf_counter() - start
+
+    if persist:
+        with transaction.atomic():
+            entered_image = EnteredImage.objects.create(content_hash='benchmark')
+            entered_image.image_file.name = 'enteredImages/benchmark.jpg'
+            start = time.perf_counter()
+            save_filtered_image(encoded, entered_image, name, 'benchmark')
+            timings['persist'] = time.perf_counter() - start
+            transaction.set_rollback(True)
+
+    timings['total'] = sum(timings.values())
+    return timings
+
+
+def peak_memory(name, data):
+    """Peak bytes allocated through Python and NumPy while filtering ``data``."""
+    tracemalloc.start()
+    try:
+        run_stages(name, data, persist=False)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_benchmarks(filters, resolutions, modes, samples=(), repeat=3, persist=True, progress=None):
+    """Benchmark every filter on every corpus image; returns a list of result dicts.
+
+    Each case is run once to warm up and then ``repeat`` times; stage
+    times are the median. Persisted files go to a temporary MEDIA_ROOT and
+    the rows are rolled back.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+        for corpus, resolution, mode, width, height, data in build_corpus(resolutions, modes, samples):
+            for name in filters:
+                run_stages(name, data, persist)
+                runs = [run_stages(name, data, persist) for _ in range(repeat)]
+                result = {
+                    'filter': name,
+                    'corpus': corpus,
+                    'resolution': resolution,
+                    'mode': mode,
+                    'width': width,
+                    'height': height,
+                    'input_bytes': len(data),
+                    'repeat': repeat,
+                }
+                for stage in STAGES + ('total',):
+                    if stage in runs[0]:
+                        result[f'{stage}_ms'] = round(statistics.median(run[stage] for run in runs) * 1000, 3)
+                result['megapixels_per_second'] = round(width * height / 1e6 / (result['total_ms'] / 1000), 2)
+                result['peak_memory_bytes'] = peak_memory(name, data)
+                results.append(result)
+                if progress:
+                    progress(result)
+    return results
+
+
+def environment():
+    return {
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'pillow': PIL.__version__,
+    }
+
+
+def case_key(result):
+    return result['filter'], result['corpus'], result['resolution'], result['mode']
+
+
+def compare(results, baseline, threshold=0.15, min_ms=1.0):
+    """Return the measurements in ``results`` more than ``threshold`` worse than ``baseline``.
+
+    Timings under ``min_ms`` in both runs are ignored as noise. Each
+    regression is ``(key, metric, baseline value, current value)``.
+    """
+    previous = {case_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get(case_key(result))
+        if old is None:
+            continue
+        for metric in [f'{stage}_ms' for stage in STAGES + ('total',)] + ['peak_memory_bytes']:
+            if metric not in result or metric not in old:
+                continue
+            if metric.endswith('_ms') and max(result[metric], old[metric]) < min_ms:
+                continue
+            if result[metric] > old[metric] * (1 + threshold):
+                regressions.append((case_key(result), metric, old[metric], result[metric]))
+    return regressions
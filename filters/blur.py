@@ -0,0 +1,161 @@
+"""Gaussian blur with a choice of algorithms.
+
+``quality`` trades accuracy for speed:
+
+* ``exact`` always runs ``cv2.GaussianBlur`` (separable, cost grows with
+  the kernel size). This is what ``BlurFilter`` used to do.
+* ``balanced`` runs three box blurs sized to the same sigma for kernels
+  larger than 15 pixels. Each box pass costs the same whatever its size.
+* ``fast`` also downsamples first when the radius is large enough, blurs
+  the small image and scales it back up.
+
+Compared with a floating-point Gaussian of the same kernel size,
+``balanced`` and ``fast`` differ by at most ``MAX_ERROR`` levels (out of
+255) per channel. The mean error is under ``MAX_MEAN_ERROR`` on photos and
+synthetic images and under twice that on a grid of one pixel lines. This
+was measured for kernel sizes from 17 to 301, on images from VGA to 2 MP,
+and the tests check it. Most of the error comes from the shape of the box
+passes; the downsampling blur stayed within 3 levels except on the grid.
+``exact`` is not exact either: OpenCV's fixed-point uint8 Gaussian is off
+by up to 13 levels on the grid at 301 pixels.
+
+Images under a quarter megapixel always get the exact blur. ``algorithm``
+(``gaussian``, ``box`` or ``downsample``) overrides the choice. Kernels are
+limited to ``MAX_KERNEL_SIZE``, since the exact blur's cost grows with it.
+"""
+import math
+
+import cv2
+import numpy as np
+
+from .registry import FilterError
+
+
+QUALITIES = ('exact', 'balanced', 'fast')
+ALGORITHMS = ('gaussian', 'box', 'downsample')
+EXACT_MAX_KERNEL = 15
+EXACT_MAX_PIXELS = 250000
+# The downsampled image must keep a sigma of at least this many pixels.
+MIN_DOWNSAMPLED_SIGMA = 2.0
+# Largest and mean per-channel error against a floating-point Gaussian; see above.
+MAX_ERROR = 9
+MAX_MEAN_ERROR = 1.25
+# The largest kernel size the bounds were measured for.
+MAX_KERNEL_SIZE = 301
+
+
+def kernel_sigma(ksize):
+    """Sigma OpenCV derives for ``GaussianBlur(..., (ksize, ksize), 0)``."""
+    return 0.3 * ((ksize - 1) * 0.5 - 1) + 0.8
+
+
+def choose_algorithm(ksize, shape, quality='balanced', algorithm=None):
+    if algorithm is not None:
+        if algorithm not in ALGORITHMS:
+            raise FilterError(f'algorithm must be one of {", ".join(ALGORITHMS)}.')
+        return algorithm
+    if quality not in QUALITIES:
+        raise FilterError(f'quality must be one of {", ".join(QUALITIES)}.')
+    if quality == 'exact' or ksize <= EXACT_MAX_KERNEL or shape[0] * shape[1] < EXACT_MAX_PIXELS:
+        return 'gaussian'
+    # Halving alone does not beat the box blur; only downsample by 4 or more.
+    if quality == 'fast' and downsample_factor(kernel_sigma(ksize)) >= 4:
+        return 'downsample'
+    return 'box'
+
+
+def gaussian_blur(image, ksize, quality='balanced', algorithm=None, dst=None):
+    check_kernel_size(ksize)
+    algorithm = choose_algorithm(ksize, image.shape, quality, algorithm)
+    if algorithm == 'gaussian':
+        return cv2.GaussianBlur(image, (ksize, ksize), 0, dst=dst)
+    if algorithm == 'downsample':
+        return downsampled_blur(image, kernel_sigma(ksize), dst=dst)
+    return box_blur(image, kernel_sigma(ksize), dst=dst)
+
+
+def check_kernel_size(ksize):
+    if isinstance(ksize, bool) or not isinstance(ksize, int) or ksize < 1 or ksize % 2 == 0:
+        raise FilterError('Blur kernel size must be a positive odd integer.')
+    if ksize > MAX_KERNEL_SIZE:
+        raise FilterError(f'Blur kernel size is limited to {MAX_KERNEL_SIZE}.')
+
+
+def kernel_size(ksize, radius=None):
+    """The checked kernel size for ``ksize``, or for ``radius`` if it is given."""
+    if radius is not None:
+        if isinstance(radius, bool) or not isinstance(radius, int) or radius < 0:
+            raise FilterError('Blur radius must be a non-negative integer.')
+        ksize = 2 * radius + 1
+    check_kernel_size(ksize)
+    return ksize
+
+
+def tile_plan(ksize, shape, quality='balanced', algorithm=None):
+    """Rows of context a tile needs and the algorithm to pin, or None if it cannot be tiled.
+
+    The algorithm is chosen from the full image ``shape`` so every tile uses
+    the same one. The downsampling blur resamples the whole image and cannot
+    be tiled exactly.
+    """
+    check_kernel_size(ksize)
+    algorithm = choose_algorithm(ksize, shape, quality, algorithm)
+    if algorithm == 'gaussian':
+        return ksize // 2, algorithm
+    if algorithm == 'box':
+        return box_blur_radius(ksize), algorithm
+    return None
+
+
+def box_sizes(sigma, passes=3):
+    """Odd box widths whose repeated application has variance ``sigma ** 2``."""
+    ideal = math.sqrt(12 * sigma * sigma / passes + 1)
+    lower = int(ideal)
+    if lower % 2 == 0:
+        lower -= 1
+    lower_count = round((12 * sigma * sigma - passes * lower * lower - 4 * passes * lower - 3 * passes)
+                        / (-4 * lower - 4))
+    return [lower if i < lower_count else lower + 2 for i in range(passes)]
+
+
+def box_blur(image, sigma, dst=None):
+    blurred = image
+    for width in box_sizes(sigma):
+        blurred = cv2.blur(blurred, (width, width), dst=dst)
+    return blurred
+
+
+def box_blur_radius(ksize):
+    """Number of neighbouring pixels ``box_blur`` reads on each side."""
+    return sum(width // 2 for width in box_sizes(kernel_sigma(ksize)))
+
+
+def downsample_factor(sigma):
+    # Area downsampling by f and linear upsampling add about (f * f - 1) / 4
+    # of variance between them, which the small blur has to leave room for.
+    factor = 1
+    while (sigma * sigma - ((2 * factor) ** 2 - 1) / 4) / (2 * factor) ** 2 >= MIN_DOWNSAMPLED_SIGMA ** 2:
+        factor *= 2
+    return factor
+
+
+def downsampled_blur(image, sigma, dst=None):
+    factor = downsample_factor(sigma)
+    height, width = image.shape[:2]
+    small_sigma = math.sqrt((sigma * sigma - (factor * factor - 1) / 4) / (factor * factor))
+    # Borders are mirrored at full size, as the other algorithms do, far
+    # enough out that the small blur never reaches past them, and the image
+    # is padded to whole multiples of ``factor`` so every small pixel
+    # covers exactly factor x factor pixels and upsampling lines up with it.
+    margin = factor * (math.ceil(4 * small_sigma) + 2)
+    padded = cv2.copyMakeBorder(image, margin, margin + -height % factor, margin, margin + -width % factor,
+                                cv2.BORDER_REFLECT_101)
+    small = cv2.resize(padded, (padded.shape[1] // factor, padded.shape[0] // factor), interpolation=cv2.INTER_AREA)
+    # The small image is cheap to blur in floating point, which avoids
+    # GaussianBlur's fixed-point rounding.
+    small = cv2.convertScaleAbs(cv2.GaussianBlur(small.astype(np.float32), (0, 0), small_sigma))
+    large = cv2.resize(small, (padded.shape[1], padded.shape[0]), interpolation=cv2.INTER_LINEAR)
+    if dst is None:
+        return large[margin:margin + height, margin:margin + width].copy()
+    dst[...] = large[margin:margin + height, margin:margin + width]
+    return dst
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import threading
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .db import discard_result
+from .derivatives import delete_derivatives
+from .models import FilterCacheEntry
+from .writer import find_pending_result
+
+_evict_lock = threading.Lock()
+_last_eviction = None
+
+
+def hash_upload(image_file):
+    digest = hashlib.sha256()
+    for chunk in image_file.chunks():
+        digest.update(chunk)
+    image_file.seek(0)
+    return digest.hexdigest()
+
+
+def params_key(params=None):
+    if not params:
+        return ''
+    return json.dumps(params, sort_keys=True, separators=(',', ':'))
+
+
+def get_cached_result(content_hash, filter_used, params=None):
+    """Return the stored FilteredImage for this upload/filter/params, or None.
+
+    Results still queued for write-behind are returned unsaved.
+    """
+    pending = find_pending_result(content_hash, filter_used, params_key(params))
+    if pending is not None:
+        return pending
+
+    entry = (FilterCacheEntry.objects
+             .select_related('filtered_image__original_image')
+             .filter(content_hash=content_hash, filter_used=filter_used, params=params_key(params))
+             .first())
+    if entry is None:
+        return None
+
+    filtered_image = entry.filtered_image
+    if not filtered_image.image_file.storage.exists(filtered_image.image_file.name):
+        entry.delete()
+        return None
+
+    FilterCacheEntry.objects.filter(pk=entry.pk).update(last_used_at=timezone.now(), hits=F('hits') + 1)
+    return filtered_image
+
+
+async def aget_cached_result(content_hash, filter_used, params=None):
+    """``get_cached_result`` for async views, using the async ORM."""
+    pending = find_pending_result(content_hash, filter_used, params_key(params))
+    if pending is not None:
+        return pending
+
+    entry = await (FilterCacheEntry.objects
+                   .select_related('filtered_image__original_image')
+                   .filter(content_hash=content_hash, filter_used=filter_used, params=params_key(params))
+                   .afirst())
+    if entry is None:
+        return None
+
+    filtered_image = entry.filtered_image
+    if not await sync_to_async(filtered_image.image_file.storage.exists)(filtered_image.image_file.name):
+        await entry.adelete()
+        return None
+
+    await FilterCacheEntry.objects.filter(pk=entry.pk).aupdate(last_used_at=timezone.now(), hits=F('hits') + 1)
+    return filtered_image
+
+
+def cache_result(content_hash, filter_used, filtered_image, params=None):
+    """Cache a saved ``filtered_image`` and return the cached FilteredImage.
+
+    If a concurrent request cached the same result first, ``filtered_image``
+    is discarded and theirs is returned.
+    """
+    try:
+        with transaction.atomic():
+            FilterCacheEntry.objects.create(
+                content_hash=content_hash,
+                filter_used=filter_used,
+                params=params_key(params),
+                filtered_image=filtered_image,
+                size=filtered_image.image_file.size,
+            )
+    except IntegrityError:
+        winner = get_cached_result(content_hash, filter_used, params)
+        if winner is not None:
+            discard_result(filtered_image)
+            return winner
+        return filtered_image
+    maybe_evict_cached_results()
+    return filtered_image
+
+
+def maybe_evict_cached_results():
+    """``evict_cached_results``, at most once every ``FILTER_CACHE_EVICT_INTERVAL`` seconds per process.
+
+    Eviction scans the whole cache, so it is too slow to run after every
+    new result. With the interval set to None it only runs from the
+    ``evict_filter_cache`` command.
+    """
+    global _last_eviction
+    interval = getattr(settings, 'FILTER_CACHE_EVICT_INTERVAL', 60)
+    if interval is None:
+        return 0
+    now = time.monotonic()
+    with _evict_lock:
+        if _last_eviction is not None and now - _last_eviction < interval:
+            return 0
+        _last_eviction = now
+    return evict_cached_results()
+
+
+def evict_cached_results(max_age=None, max_bytes=None):
+    """Drop least recently used results (rows and files) past the age or size limit."""
+    if max_age is None:
+        max_age = getattr(settings, 'FILTER_CACHE_MAX_AGE', None)
+    if max_bytes is None:
+        max_bytes = getattr(settings, 'FILTER_CACHE_MAX_BYTES', None)
+
+    evicted = 0
+    if max_age is not None:
+        cutoff = timezone.now() - timedelta(seconds=max_age)
+        evicted += _evict(FilterCacheEntry.objects.filter(last_used_at__lt=cutoff))
+
+    if max_bytes is not None:
+        total = FilterCacheEntry.objects.aggregate(total=Sum('size'))['total'] or 0
+        if total > max_bytes:
+            stale = []
+            for entry in FilterCacheEntry.objects.order_by('last_used_at').only('pk', 'size'):
+                if total <= max_bytes:
+                    break
+                stale.append(entry.pk)
+                total -= entry.size
+            evicted += _evict(FilterCacheEntry.objects.filter(pk__in=stale))
+
+    return evicted
+
+
+def _evict(entries):
+    evicted = 0
+    for entry in entries.select_related('filtered_image'):
+        filtered_image = entry.filtered_image
+        delete_derivatives(filtered_image)
+        filtered_image.image_file.delete(save=False)
+        filtered_image.delete()
+        evicted += 1
+    return evicted
@@ -0,0 +1,164 @@
+"""SQLite tuning and grouped inserts for filter results.
+
+``configure_sqlite`` runs the ``FILTER_SQLITE_PRAGMAS`` on every new
+SQLite connection. WAL journaling lets readers run alongside the single
+writer, and ``synchronous=NORMAL`` only syncs at checkpoints, which is
+still safe against application crashes.
+
+A request's rows (the original, its filtered images and their cache
+entries) are written in one transaction by ``insert_results``. When two
+requests race to cache the same result, the first cache entry wins and
+the other request's FilteredImage and file are discarded. With
+``FILTER_GROUP_COMMIT`` on, ``commit_result`` also merges concurrent
+requests' rows: while one transaction is being written, the requests
+that arrive queue up and the next of them writes all their rows in one
+transaction, so a burst of requests pays for a few commits instead of
+one each.
+"""
+import threading
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from .models import EnteredImage, FilterCacheEntry, FilteredImage
+
+ResultRow = namedtuple('ResultRow', ['entered_image', 'filtered_image', 'params', 'size'])
+
+_lock = threading.Lock()
+_committers = {}
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, value in getattr(settings, 'FILTER_SQLITE_PRAGMAS', {}).items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+
+
+def insert_results(rows, using=DEFAULT_DB_ALIAS):
+    """Insert unsaved ``ResultRow`` images and their cache entries in one transaction.
+
+    Rows may share an EnteredImage, or have one that is already saved; each
+    new original is inserted once. Returns the cached FilteredImage for
+    each row: its own, or the one another request cached first, in which
+    case the row's own is discarded.
+    """
+    entered_images = {id(row.entered_image): row.entered_image for row in rows if row.entered_image.pk is None}
+    with transaction.atomic(using=using):
+        EnteredImage.objects.using(using).bulk_create(list(entered_images.values()))
+        for row in rows:
+            row.filtered_image.original_image = row.entered_image
+        FilteredImage.objects.using(using).bulk_create([row.filtered_image for row in rows])
+        FilterCacheEntry.objects.using(using).bulk_create([
+            FilterCacheEntry(content_hash=row.entered_image.content_hash,
+                             filter_used=row.filtered_image.filter_used, params=row.params,
+                             filtered_image=row.filtered_image, size=row.size)
+            for row in rows
+        ], ignore_conflicts=True)
+        return _cached_results(rows, using)
+
+
+def _cached_results(rows, using):
+    # Conflicting entries were skipped, so the stored entry names the winner.
+    keys = {(row.entered_image.content_hash, row.filtered_image.filter_used, row.params) for row in rows}
+    winners = {
+        (content_hash, filter_used, params): filtered_image_id
+        for content_hash, filter_used, params, filtered_image_id in FilterCacheEntry.objects.using(using)
+        .filter(content_hash__in={key[0] for key in keys})
+        .values_list('content_hash', 'filter_used', 'params', 'filtered_image_id')
+        if (content_hash, filter_used, params) in keys
+    }
+    inserted = {row.filtered_image.pk: row.filtered_image for row in rows}
+    results = []
+    for row in rows:
+        winner_id = winners[row.entered_image.content_hash, row.filtered_image.filter_used, row.params]
+        if winner_id == row.filtered_image.pk:
+            results.append(row.filtered_image)
+            continue
+        discard_result(row.filtered_image, using)
+        winner = inserted.get(winner_id)
+        if winner is None:
+            winner = FilteredImage.objects.using(using).select_related('original_image').get(pk=winner_id)
+        results.append(winner)
+    return results
+
+
+def discard_result(filtered_image, using=DEFAULT_DB_ALIAS):
+    """Delete a FilteredImage that lost the race to be cached, and its file once that commits."""
+    storage, name = filtered_image.image_file.storage, filtered_image.image_file.name
+    filtered_image.delete(using=using)
+    transaction.on_commit(lambda: storage.delete(name), using=using)
+
+
+class GroupCommitter:
+    """Write ``ResultRow``s from concurrent threads together.
+
+    There is never more than one writing thread. It takes up to
+    ``max_batch`` queued rows, its own included, inserts them, and then
+    hands over to the thread that queued the next row.
+    """
+
+    def __init__(self, max_batch=64, using=DEFAULT_DB_ALIAS):
+        self.max_batch = max_batch
+        self.using = using
+        self.lock = threading.Lock()
+        self.queue = []
+        self.writing = False
+
+    def commit(self, row):
+        """Write ``row`` and return its cached FilteredImage; see ``insert_results``."""
+        # An item is [row, event, done, error, result].
+        item = [row, threading.Event(), False, None, None]
+        with self.lock:
+            self.queue.append(item)
+            lead = not self.writing
+            self.writing = True
+        if not lead:
+            item[1].wait()
+        if not item[2]:
+            # Either first in line or handed the lead by the previous writer.
+            self.write()
+        if item[3] is not None:
+            raise item[3]
+        return item[4]
+
+    def write(self):
+        with self.lock:
+            batch = self.queue[:self.max_batch]
+            del self.queue[:self.max_batch]
+        error = None
+        results = [None] * len(batch)
+        try:
+            results = insert_results([item[0] for item in batch], self.using)
+        except Exception as e:
+            error = e
+        for item, result in zip(batch, results):
+            item[2], item[3], item[4] = True, error, result
+            item[1].set()
+        with self.lock:
+            if self.queue:
+                self.queue[0][1].set()
+            else:
+                self.writing = False
+
+
+def get_committer(using=DEFAULT_DB_ALIAS):
+    with _lock:
+        if using not in _committers:
+            _committers[using] = GroupCommitter(
+                max_batch=getattr(settings, 'FILTER_GROUP_COMMIT_MAX_BATCH', 64), using=using)
+    return _committers[using]
+
+
+def commit_result(row):
+    """Insert one request's rows, grouped with concurrent requests when ``FILTER_GROUP_COMMIT`` is on.
+
+    Returns the cached FilteredImage; see ``insert_results``.
+    """
+    # Inside a transaction the rows must be written on this connection, or
+    # they would not roll back with it.
+    if getattr(settings, 'FILTER_GROUP_COMMIT', False) and not transaction.get_connection().in_atomic_block:
+        return get_committer().commit(row)
+    return insert_results([row])[0]
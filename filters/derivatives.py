@@ -0,0 +1,91 @@
+"""Fixed-size downscaled copies of stored images, for galleries and previews.
+
+Each stored image gets a JPEG no larger than each of
+``FILTER_DERIVATIVE_SIZES`` on its longest side, generated in the
+background after upload. File names include a digest of the source
+bytes, so a derivative's URL never changes content and can be cached
+forever.
+"""
+import hashlib
+import logging
+import os
+
+import cv2
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+
+from . import engine
+from .workers import get_derivative_pool
+
+logger = logging.getLogger(__name__)
+
+DERIVATIVE_DIR = 'derivatives'
+
+
+def derivative_sizes():
+    return sorted(getattr(settings, 'FILTER_DERIVATIVE_SIZES', (128, 512, 1024)), reverse=True)
+
+
+def build_derivatives(data, sizes):
+    """Yield ``(size, jpeg)`` for every size smaller than the image, largest first.
+
+    The image is decoded once at the largest size (see
+    ``engine.decode_preview``) and each smaller level is resized from the
+    one before it.
+    """
+    sizes = sorted(sizes, reverse=True)
+    image, scale = engine.decode_preview(data, sizes[0]) if sizes else (None, 1.0)
+    if image is None:
+        return
+    longest = max(image.shape[:2]) / scale
+    for size in sizes:
+        if size >= longest:
+            continue
+        if max(image.shape[:2]) > size:
+            ratio = size / max(image.shape[:2])
+            width, height = (max(1, round(side * ratio)) for side in (image.shape[1], image.shape[0]))
+            image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+        yield size, engine.encode(image)
+
+
+def generate_derivatives(instance, data=None):
+    """Write ``instance``'s derivatives to storage and record them on its row."""
+    image_file = instance.image_file
+    if data is None:
+        with image_file.open('rb') as source:
+            data = source.read()
+    digest = hashlib.sha256(data).hexdigest()[:16]
+    stem = os.path.splitext(os.path.basename(image_file.name))[0]
+    folder = os.path.join(DERIVATIVE_DIR, os.path.dirname(image_file.name))
+
+    derivatives = {}
+    for size, encoded in build_derivatives(data, derivative_sizes()):
+        name = os.path.join(folder, f'{stem}_{digest}_{size}.jpg')
+        if not image_file.storage.exists(name):
+            name = image_file.storage.save(name, ContentFile(encoded))
+        derivatives[str(size)] = name
+    type(instance).objects.filter(pk=instance.pk).update(derivatives=derivatives)
+    instance.derivatives = derivatives
+    return derivatives
+
+
+def schedule_derivatives(instance, data=None):
+    """Generate derivatives on their own pool once the row is committed."""
+    if not derivative_sizes() or not instance.image_file:
+        return
+    transaction.on_commit(lambda: get_derivative_pool().submit(_generate, instance, data))
+
+
+def delete_derivatives(instance):
+    for name in instance.derivatives.values():
+        instance.image_file.storage.delete(name)
+
+
+def _generate(instance, data):
+    try:
+        generate_derivatives(instance, data)
+    except Exception:
+        logger.exception('Could not generate derivatives for %s %s', type(instance).__name__, instance.pk)
+    finally:
+        connection.close()
@@ -0,0 +1,46 @@
+"""Output formats and ``Accept`` header negotiation."""
+from collections import namedtuple
+
+
+OutputFormat = namedtuple('OutputFormat', ['name', 'content_type', 'extension', 'default_quality'])
+
+FORMATS = {
+    'jpeg': OutputFormat('jpeg', 'image/jpeg', '.jpg', 75),
+    'webp': OutputFormat('webp', 'image/webp', '.webp', 80),
+    'png': OutputFormat('png', 'image/png', '.png', None),
+}
+FORMAT_ALIASES = {'jpg': 'jpeg'}
+CONTENT_TYPES = {output_format.content_type: name for name, output_format in FORMATS.items()}
+CONTENT_TYPES['image/jpg'] = 'jpeg'
+
+
+def get_format(name):
+    name = (name or '').lower()
+    return FORMATS.get(FORMAT_ALIASES.get(name, name))
+
+
+def negotiate(accept, default='jpeg'):
+    """Pick the output format for an ``Accept`` header.
+
+    Only image types the client names explicitly count; wildcards and
+    non-image types (e.g. ``application/json`` from API clients) leave the
+    filter's default in place. Ties go to the default, then to the order
+    the client listed them in.
+    """
+    best, best_quality = default, 0.0
+    for position, item in enumerate((accept or '').split(',')):
+        media_type, *params = [part.strip() for part in item.split(';')]
+        name = CONTENT_TYPES.get(media_type.lower())
+        if name is None:
+            continue
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > best_quality or (quality == best_quality and name == default):
+            best, best_quality = name, quality
+    return best
@@ -0,0 +1,92 @@
+"""Read uploads without copying them out of the request.
+
+Small uploads live in memory: ``BytesIO.getvalue()`` hands back the
+buffer Django already filled, without copying it. Large uploads are
+spooled to a temporary file, which is memory-mapped. Either way ``data``
+can go straight to ``np.frombuffer``/``cv2.imdecode`` and ``hashlib``.
+
+``start_store`` writes the original to storage on the thread pool while
+the request goes on to filter it.
+"""
+import hashlib
+import io
+import logging
+import mmap
+
+from .models import EnteredImage
+from .similarity import perceptual_hash
+from .workers import get_thread_pool
+
+logger = logging.getLogger(__name__)
+
+
+class Upload:
+    def __init__(self, image_file):
+        self.image_file = image_file
+        self.name = image_file.name
+        self._mmap = None
+        self._store = None
+        self._perceptual_hash = None
+        source = getattr(image_file, 'file', None)
+        if isinstance(source, io.BytesIO):
+            self.data = source.getvalue()
+        elif hasattr(image_file, 'temporary_file_path') and image_file.size:
+            with open(image_file.temporary_file_path(), 'rb') as temporary_file:
+                self._mmap = mmap.mmap(temporary_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.data = self._mmap
+        else:
+            image_file.seek(0)
+            self.data = image_file.read()
+            image_file.seek(0)
+
+    def sha256(self):
+        return hashlib.sha256(self.data).hexdigest()
+
+    def perceptual_hash(self):
+        if self._perceptual_hash is None:
+            self._perceptual_hash = perceptual_hash(self.data)
+        return self._perceptual_hash
+
+    def known_perceptual_hash(self):
+        """The hash if a lookup already needed it, else ``''``; stored images are hashed in the background."""
+        return self._perceptual_hash or ''
+
+    def start_store(self):
+        if self._store is None:
+            self._store = get_thread_pool().submit(self._store_file)
+
+    def take_stored(self):
+        """The unsaved EnteredImage whose file ``start_store`` wrote, or None if it was not started."""
+        store, self._store = self._store, None
+        return store.result() if store is not None else None
+
+    def _store_file(self):
+        entered_image = EnteredImage()
+        entered_image.image_file.save(self.name, self.image_file, save=False)
+        return entered_image
+
+    def close(self):
+        if self._store is not None:
+            # The request failed before the original was recorded.
+            try:
+                self.take_stored().image_file.delete(save=False)
+            except Exception:
+                logger.exception('Could not remove the stored upload %s', self.name)
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # An array still points into the mapping; it is unmapped
+                # once that array is garbage collected.
+                pass
+        self.data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_upload(image_file):
+    return Upload(image_file)
@@ -0,0 +1,178 @@
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, connection
+from django.utils import timezone
+
+from . import pipeline
+from .cache import maybe_evict_cached_results, params_key
+from .db import ResultRow, commit_result
+from .derivatives import schedule_derivatives
+from .formats import get_format
+from .models import FilterJob
+from .persistence import store_filtered_image
+from .workers import discard_process_pool, get_process_pool
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_dispatcher = None
+
+
+def enqueue_job(entered_image, stages, filter_used, suffix, params=None, priority=0):
+    job = FilterJob.objects.create(
+        entered_image=entered_image,
+        pipeline=pipeline.serialize(stages),
+        filter_used=filter_used,
+        suffix=suffix,
+        params=params_key(params),
+        priority=priority,
+    )
+    if getattr(settings, 'FILTER_JOBS_INLINE_WORKER', True):
+        get_dispatcher().notify()
+    return job
+
+
+def claim_next_job():
+    while True:
+        job = (FilterJob.objects
+               .filter(status=FilterJob.QUEUED)
+               .order_by('-priority', 'created_at', 'pk')
+               .select_related('entered_image')
+               .first())
+        if job is None:
+            return None
+        # Another dispatcher may have claimed it between the two queries.
+        started_at = timezone.now()
+        if FilterJob.objects.filter(pk=job.pk, status=FilterJob.QUEUED).update(
+                status=FilterJob.RUNNING, started_at=started_at):
+            job.status, job.started_at = FilterJob.RUNNING, started_at
+            return job
+
+
+def requeue_stale_jobs(stale_after=None):
+    """Put jobs running for more than ``FILTER_JOB_STALE_AFTER`` seconds back in the queue.
+
+    Their worker most likely stopped with them, e.g. when the server was
+    restarted mid-job. Returns how many were requeued.
+    """
+    if stale_after is None:
+        stale_after = getattr(settings, 'FILTER_JOB_STALE_AFTER', 600)
+    cutoff = timezone.now() - timedelta(seconds=stale_after)
+    return (FilterJob.objects
+            .filter(status=FilterJob.RUNNING, started_at__lt=cutoff)
+            .update(status=FilterJob.QUEUED, started_at=None))
+
+
+def run_job(job):
+    try:
+        params = json.loads(job.params) if job.params else None
+        with job.entered_image.image_file.open('rb') as image_file:
+            data = image_file.read()
+        options = (params or {}).get('output', {})
+        encoded = get_process_pool().submit(
+            pipeline.process, data, job.pipeline, (params or {}).get('max_dimension'), encode_options=options).result()
+        filtered_image = store_filtered_image(encoded, job.entered_image, job.filter_used, job.suffix,
+                                              get_format(options.get('format', 'jpeg')).extension)
+        # The FilteredImage and its cache entry go in one transaction.
+        cached = commit_result(ResultRow(job.entered_image, filtered_image, params_key(params), len(encoded)))
+        if cached is filtered_image:
+            schedule_derivatives(filtered_image, encoded)
+        filtered_image = cached
+        maybe_evict_cached_results()
+        job.filtered_image = filtered_image
+        job.status = FilterJob.DONE
+    except Exception as e:
+        if isinstance(e, BrokenProcessPool):
+            discard_process_pool()
+        logger.exception('Filter job %s failed', job.pk)
+        job.status = FilterJob.FAILED
+        job.error = str(e)
+    job.finished_at = timezone.now()
+    job.save(update_fields=['filtered_image', 'status', 'error', 'finished_at'])
+
+
+class JobDispatcher:
+    """Feeds queued jobs to the process pool, at most ``concurrency`` at a time.
+
+    Jobs are claimed highest priority first, oldest first. The queue is the
+    FilterJob table, so several dispatchers (e.g. one per server process)
+    can share it safely. Every ``requeue_interval`` seconds stale running
+    jobs are requeued; see ``requeue_stale_jobs``.
+    """
+
+    def __init__(self, concurrency, poll_interval=1.0, requeue_interval=60.0):
+        self.poll_interval = poll_interval
+        self.requeue_interval = requeue_interval
+        self.next_requeue = 0.0
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.runner = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='filter-jobs')
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='filter-job-dispatcher', daemon=True)
+                self.thread.start()
+
+    def notify(self):
+        self.start()
+        self.wakeup.set()
+
+    def stop(self, wait=False):
+        self.stopping.set()
+        self.wakeup.set()
+        if wait:
+            self.runner.shutdown(wait=True)
+
+    def run(self):
+        try:
+            while not self.stopping.is_set():
+                self.slots.acquire()
+                self.wakeup.clear()
+                try:
+                    if time.monotonic() >= self.next_requeue:
+                        self.next_requeue = time.monotonic() + self.requeue_interval
+                        requeue_stale_jobs()
+                    job = claim_next_job()
+                except DatabaseError:
+                    # For example when the server starts before its first migrate.
+                    logger.exception('Could not claim a filter job')
+                    job = None
+                if job is None:
+                    self.slots.release()
+                    self.wakeup.wait(self.poll_interval)
+                    continue
+                self.runner.submit(self._run_job, job)
+        finally:
+            connection.close()
+
+    def _run_job(self, job):
+        try:
+            run_job(job)
+        finally:
+            connection.close()
+            self.slots.release()
+
+
+def get_dispatcher():
+    global _dispatcher
+    with _lock:
+        if _dispatcher is None:
+            _dispatcher = JobDispatcher(getattr(settings, 'FILTER_JOB_CONCURRENCY', 2))
+    return _dispatcher
+
+
+def start_inline_worker():
+    """Start this process's dispatcher, so jobs queued before a restart run without waiting for a new one."""
+    if getattr(settings, 'FILTER_JOBS_INLINE_WORKER', True):
+        get_dispatcher().start()
@@ -0,0 +1,371 @@
+"""Load tests that replay filter traffic against a running server.
+
+``LocalServer`` starts ``manage.py runserver`` in a subprocess on a free
+port, with a scratch database and media directory, so a run never touches
+the real ones. ``run_load`` then drives closed-loop traffic: each simulated
+user POSTs an image to an endpoint picked from a weighted mix, waits for
+the answer and sends the next, for ``duration`` seconds at each
+concurrency step. Images are drawn from a weighted size distribution and
+made unique by bytes appended after the JPEG end marker, so they miss the
+result cache; ``repeat_ratio`` of the uploads resend an earlier image
+instead.
+
+An endpoint saturates at the first step where its error rate or p95
+latency passes the limits, or where its successful throughput grows by
+less than ``SCALING_GAIN`` over the best step before it. 503s from
+admission control count as errors and are also reported as ``rejected``;
+a status of 0 means no answer (refused, reset or timed out).
+"""
+import math
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, deque, namedtuple
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
+from urllib.parse import urlsplit
+
+import cv2
+from django.conf import settings
+
+from .benchmark import RESOLUTIONS, SEED, synthetic_image
+
+ENDPOINTS = {
+    'blackandwhite': '/filters/blackandwhite/',
+    'blur': '/filters/blur/',
+    'sketch': '/filters/sketch/',
+    'emboss': '/filters/emboss/',
+    'sharpen': '/filters/sharpen/',
+    'sepia': '/filters/sepia/',
+    'image-upload': '/filters/image-upload/',
+}
+DEFAULT_SIZES = {'vga': 0.5, '1080p': 0.35, '12mp': 0.15}
+# A step must add this much successful throughput to count as still scaling.
+SCALING_GAIN = 0.1
+# Earlier uploads kept for repeats.
+REPEAT_WINDOW = 64
+SETTINGS_TEMPLATE = '''from {module} import *
+
+DEBUG = False
+DATABASES = {{'default': dict(DATABASES['default'], NAME={database!r})}}
+MEDIA_ROOT = {media!r}
+'''
+
+Sample = namedtuple('Sample', ['endpoint', 'size', 'status', 'seconds'])
+
+
+def parse_weights(value, choices):
+    """``{name: weight}`` from ``name=weight,...``; a bare name weighs 1. Raises ``ValueError``."""
+    weights = {}
+    for item in value.split(','):
+        name, _, weight = item.strip().partition('=')
+        if not name:
+            continue
+        if name not in choices:
+            raise ValueError(f'Unknown name {name!r}; choose from {", ".join(choices)}.')
+        try:
+            weights[name] = float(weight) if weight else 1.0
+        except ValueError:
+            raise ValueError(f'The weight of {name} must be a number.')
+        if weights[name] < 0:
+            raise ValueError(f'The weight of {name} cannot be negative.')
+    weights = {name: weight for name, weight in weights.items() if weight > 0}
+    if not weights:
+        raise ValueError('At least one positive weight is needed.')
+    return weights
+
+
+def build_corpus(sizes, per_size=3, quality=90):
+    """``{size: [JPEG bytes, ...]}`` of synthetic images at each size."""
+    corpus = {}
+    for size in sizes:
+        width, height = RESOLUTIONS[size]
+        corpus[size] = [cv2.imencode('.jpg', synthetic_image(width, height, SEED + index),
+                                     [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+                        for index in range(per_size)]
+    return corpus
+
+
+class Traffic:
+    """Picks the endpoint and image of each request."""
+
+    def __init__(self, corpus, endpoints, sizes, repeat_ratio=0.2):
+        self.corpus = corpus
+        self.endpoints = list(endpoints)
+        self.endpoint_weights = list(endpoints.values())
+        self.sizes = list(sizes)
+        self.size_weights = list(sizes.values())
+        self.repeat_ratio = repeat_ratio
+        self.lock = threading.Lock()
+        self.sent = deque(maxlen=REPEAT_WINDOW)
+
+    def next(self, rng):
+        endpoint = rng.choices(self.endpoints, self.endpoint_weights)[0]
+        with self.lock:
+            if self.sent and rng.random() < self.repeat_ratio:
+                return (endpoint,) + self.sent[rng.randrange(len(self.sent))]
+        size = rng.choices(self.sizes, self.size_weights)[0]
+        # Decoders stop at the end marker, so the trailer only changes the content hash.
+        data = rng.choice(self.corpus[size]) + uuid.uuid4().bytes
+        with self.lock:
+            self.sent.append((size, data))
+        return endpoint, size, data
+
+
+def encode_multipart(field, filename, data):
+    boundary = uuid.uuid4().hex
+    body = b''.join([
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+        f'Content-Type: image/jpeg\r\n\r\n'.encode(),
+        data,
+        f'\r\n--{boundary}--\r\n'.encode(),
+    ])
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+def post(url, path, body, content_type, timeout):
+    """POST ``body`` and read the whole answer; returns its status, or 0 when there was none."""
+    parts = urlsplit(url)
+    connection_class = HTTPSConnection if parts.scheme == 'https' else HTTPConnection
+    connection = connection_class(parts.hostname, parts.port, timeout=timeout)
+    try:
+        connection.request('POST', parts.path.rstrip('/') + path, body,
+                           {'Content-Type': content_type, 'Connection': 'close'})
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    except (OSError, HTTPException):
+        return 0
+    finally:
+        connection.close()
+
+
+def run_step(url, traffic, users, duration, timeout=60, think_time=0, seed=SEED):
+    """Run ``users`` closed-loop users for ``duration`` seconds; returns the samples and elapsed seconds.
+
+    Requests still in flight at the deadline are waited for and counted.
+    """
+    samples = []
+    deadline = time.monotonic() + duration
+
+    def user(index):
+        rng = random.Random(seed + index)
+        while time.monotonic() < deadline:
+            endpoint, size, data = traffic.next(rng)
+            body, content_type = encode_multipart('image_file', f'{size}.jpg', data)
+            start = time.perf_counter()
+            status = post(url, ENDPOINTS[endpoint], body, content_type, timeout)
+            samples.append(Sample(endpoint, size, status, time.perf_counter() - start))
+            if think_time:
+                time.sleep(rng.expovariate(1 / think_time))
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=user, args=(index,), daemon=True) for index in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.monotonic() - start
+
+
+def percentile(latencies, fraction):
+    """Nearest-rank percentile of sorted ``latencies``, in milliseconds."""
+    if not latencies:
+        return None
+    return round(latencies[max(0, math.ceil(fraction * len(latencies)) - 1)] * 1000, 1)
+
+
+def summarize(samples, seconds):
+    latencies = sorted(sample.seconds for sample in samples)
+    ok = sum(200 <= sample.status < 300 for sample in samples)
+    statuses = Counter(str(sample.status) for sample in samples)
+    return {
+        'requests': len(samples),
+        'throughput': round(len(samples) / seconds, 2),
+        'ok_throughput': round(ok / seconds, 2),
+        'p50_ms': percentile(latencies, 0.5),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'error_rate': round((len(samples) - ok) / len(samples), 4) if samples else 0.0,
+        'rejected': statuses.get('503', 0),
+        'statuses': dict(sorted(statuses.items())),
+    }
+
+
+def run_load(url, traffic, steps, duration, timeout=60, think_time=0, warmup=0, seed=SEED, progress=None):
+    """Run each concurrency in ``steps`` in turn and return one result per step.
+
+    A ``warmup`` run at the first concurrency is made and discarded first,
+    so process pools and caches in the server are started.
+    """
+    if warmup:
+        run_step(url, traffic, steps[0], warmup, timeout, think_time, seed)
+    results = []
+    for users in steps:
+        samples, seconds = run_step(url, traffic, users, duration, timeout, think_time, seed + users * 1000)
+        result = {
+            'users': users,
+            'seconds': round(seconds, 2),
+            'overall': summarize(samples, seconds),
+            'endpoints': {name: summarize([sample for sample in samples if sample.endpoint == name], seconds)
+                          for name in traffic.endpoints},
+            'sizes': {size: summarize([sample for sample in samples if sample.size == size], seconds)
+                      for size in traffic.sizes},
+        }
+        results.append(result)
+        if progress:
+            progress(result)
+    return results
+
+
+def saturation_point(stats, max_error_rate=0.01, max_p95_ms=None):
+    """Where a series of ``(users, summary)`` stopped keeping up.
+
+    Returns the first saturated step's users and the reason (``errors``,
+    ``latency`` or ``throughput``), both ``None`` if it kept scaling, and the
+    best successful throughput seen before it.
+    """
+    best_users, best = None, None
+    for users, summary in stats:
+        if not summary['requests']:
+            continue
+        reason = None
+        if summary['error_rate'] > max_error_rate:
+            reason = 'errors'
+        elif max_p95_ms and summary['p95_ms'] > max_p95_ms:
+            reason = 'latency'
+        elif best is not None and summary['ok_throughput'] < best * (1 + SCALING_GAIN):
+            reason = 'throughput'
+        if reason:
+            return {'users': users, 'reason': reason, 'peak_users': best_users, 'peak_ok_throughput': best}
+        best_users, best = users, summary['ok_throughput']
+    return {'users': None, 'reason': None, 'peak_users': best_users, 'peak_ok_throughput': best}
+
+
+def saturation(results, max_error_rate=0.01, max_p95_ms=None):
+    """``saturation_point`` of the whole mix and of each endpoint."""
+    points = {'overall': saturation_point([(result['users'], result['overall']) for result in results],
+                                          max_error_rate, max_p95_ms)}
+    for name in results[0]['endpoints'] if results else ():
+        points[name] = saturation_point([(result['users'], result['endpoints'][name]) for result in results],
+                                        max_error_rate, max_p95_ms)
+    return points
+
+
+def compare(results, baseline, threshold=0.15, max_error_rate=0.01):
+    """Return the measurements in ``results`` more than ``threshold`` worse than ``baseline``.
+
+    Steps are matched by concurrency. Error rates regress when they rise by
+    more than ``max_error_rate``. Each regression is
+    ``((users, endpoint), metric, baseline value, current value)``.
+    """
+    previous = {result['users']: result for result in baseline}
+    regressions = []
+    for result in results:
+        old_step = previous.get(result['users'])
+        if old_step is None:
+            continue
+        for name, summary in [('overall', result['overall'])] + list(result['endpoints'].items()):
+            old = old_step['overall'] if name == 'overall' else old_step['endpoints'].get(name)
+            if not old or not old['requests'] or not summary['requests']:
+                continue
+            key = (result['users'], name)
+            if summary['ok_throughput'] < old['ok_throughput'] * (1 - threshold):
+                regressions.append((key, 'ok_throughput', old['ok_throughput'], summary['ok_throughput']))
+            for metric in ('p95_ms', 'p99_ms'):
+                if summary[metric] > old[metric] * (1 + threshold):
+                    regressions.append((key, metric, old[metric], summary[metric]))
+            if summary['error_rate'] > old['error_rate'] + max_error_rate:
+                regressions.append((key, 'error_rate', old['error_rate'], summary['error_rate']))
+    return regressions
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class LocalServer:
+    """``manage.py runserver`` on a free local port, on a scratch database and media directory.
+
+    runserver is a development server; to measure a production setup,
+    start it separately and point the load test at its URL.
+    """
+
+    def __init__(self, settings_module=None, startup_timeout=60):
+        self.settings_module = settings_module or os.environ.get('DJANGO_SETTINGS_MODULE', 'src.settings')
+        self.startup_timeout = startup_timeout
+        self.directory = None
+        self.process = None
+        self.log = None
+        self.url = None
+
+    def __enter__(self):
+        self.directory = tempfile.mkdtemp(prefix='loadtest-')
+        try:
+            self.start()
+        except BaseException:
+            self.stop()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        with open(os.path.join(self.directory, 'loadtest_settings.py'), 'w') as settings_file:
+            settings_file.write(SETTINGS_TEMPLATE.format(
+                module=self.settings_module, database=os.path.join(self.directory, 'db.sqlite3'),
+                media=os.path.join(self.directory, 'media')))
+        path = [self.directory, str(settings.BASE_DIR), os.environ.get('PYTHONPATH')]
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='loadtest_settings',
+                   PYTHONPATH=os.pathsep.join(item for item in path if item))
+        manage = os.path.join(settings.BASE_DIR, 'manage.py')
+        self.log = open(os.path.join(self.directory, 'server.log'), 'w+')
+        migrate = subprocess.run([sys.executable, manage, 'migrate', '--noinput'], env=env, stdout=self.log,
+                                 stderr=subprocess.STDOUT)
+        if migrate.returncode:
+            raise RuntimeError(f'Migrating the scratch database failed:\n{self.log_tail()}')
+
+        port = free_port()
+        self.url = f'http://127.0.0.1:{port}'
+        self.process = subprocess.Popen([sys.executable, manage, 'runserver', '--noreload', f'127.0.0.1:{port}'],
+                                        env=env, stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + self.startup_timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'The server exited during startup:\n{self.log_tail()}')
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError(f'The server did not start within {self.startup_timeout} seconds:\n{self.log_tail()}')
+
+    def log_tail(self, lines=20):
+        self.log.flush()
+        self.log.seek(0)
+        return ''.join(self.log.readlines()[-lines:])
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
@@ -0,0 +1,123 @@
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connections
+from django.test.utils import override_settings
+
+from filters.db import GroupCommitter, ResultRow, insert_results
+from filters.models import EnteredImage, FilterCacheEntry, FilteredImage
+
+TUNED_PRAGMAS = {'journal_mode': 'WAL', 'synchronous': 'NORMAL'}
+# The old write path: default journaling, Django's 5 second busy timeout and
+# one autocommitted INSERT per row.
+SCENARIOS = {
+    'baseline': {'pragmas': {}, 'timeout': 5, 'mode': 'autocommit'},
+    'wal': {'pragmas': TUNED_PRAGMAS, 'timeout': 20, 'mode': 'transaction'},
+    'group': {'pragmas': TUNED_PRAGMAS, 'timeout': 20, 'mode': 'group'},
+}
+
+
+class Command(BaseCommand):
+    help = ('Measure concurrent filter-result inserts on a scratch SQLite database, '
+            'comparing the old write path with WAL, per-request transactions and group commit.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                            help=f'Comma separated scenarios from {", ".join(SCENARIOS)}.')
+        parser.add_argument('--threads', type=int, default=8, help='Concurrent writers.')
+        parser.add_argument('--requests', type=int, default=200, help='Results written by each writer.')
+        parser.add_argument('--output', help='Write the results to this JSON file.')
+
+    def handle(self, *args, **options):
+        names = [name.strip() for name in options['scenarios'].split(',') if name.strip()]
+        unknown = [name for name in names if name not in SCENARIOS]
+        if unknown:
+            raise CommandError(f'Unknown scenarios: {", ".join(unknown)}.')
+
+        self.stdout.write(f'{"scenario":<10} {"writes":>7} {"seconds":>8} {"writes/s":>9} '
+                          f'{"p50 ms":>8} {"p95 ms":>8} {"errors":>7}')
+        results = []
+        with tempfile.TemporaryDirectory() as directory:
+            for name in names:
+                result = run_scenario(name, os.path.join(directory, f'{name}.sqlite3'), options['threads'],
+                                      options['requests'])
+                results.append(result)
+                self.stdout.write(
+                    f'{name:<10} {result["writes"]:>7} {result["seconds"]:>8.2f} {result["writes_per_second"]:>9.1f} '
+                    f'{result["p50_ms"]:>8.2f} {result["p95_ms"]:>8.2f} {result["errors"]:>7}')
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump({'threads': options['threads'], 'requests': options['requests'], 'results': results},
+                          output, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Wrote {len(results)} results to {options["output"]}.'))
+
+
+def run_scenario(name, path, threads, requests):
+    scenario = SCENARIOS[name]
+    alias = f'benchmark_{name}'
+    # Tables are created directly: some data migrations would touch the default database.
+    connections.settings[alias] = dict(connections.settings['default'], NAME=path, CONN_MAX_AGE=0,
+                                       OPTIONS={'timeout': scenario['timeout']})
+    with override_settings(FILTER_SQLITE_PRAGMAS=scenario['pragmas']):
+        with connections[alias].schema_editor() as editor:
+            for model in (EnteredImage, FilteredImage, FilterCacheEntry):
+                editor.create_model(model)
+        committer = GroupCommitter(using=alias)
+        latencies, errors = [], []
+
+        def work(worker):
+            try:
+                for index in range(requests):
+                    start = time.perf_counter()
+                    try:
+                        write_result(scenario['mode'], alias, committer, f'{worker}-{index}')
+                    except OperationalError:
+                        errors.append(1)
+                    latencies.append(time.perf_counter() - start)
+            finally:
+                connections[alias].close()
+
+        start = time.perf_counter()
+        workers = [threading.Thread(target=work, args=(worker,)) for worker in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        seconds = time.perf_counter() - start
+    connections[alias].close()
+    del connections.settings[alias]
+
+    writes = len(latencies) - len(errors)
+    latencies.sort()
+    return {
+        'scenario': name,
+        'writes': writes,
+        'errors': len(errors),
+        'seconds': round(seconds, 3),
+        'writes_per_second': round(writes / seconds, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 2),
+        'p95_ms': round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 2),
+    }
+
+
+def write_result(mode, alias, committer, key):
+    content_hash = uuid.uuid4().hex * 2
+    entered_image = EnteredImage(content_hash=content_hash, image_file=f'enteredImages/{key}.jpg')
+    filtered_image = FilteredImage(filter_used='blur', image_file=f'filteredImages/{key}_blurred.jpg')
+    if mode == 'autocommit':
+        entered_image.save(using=alias)
+        filtered_image.original_image = entered_image
+        filtered_image.save(using=alias)
+        FilterCacheEntry.objects.using(alias).create(content_hash=content_hash, filter_used='blur',
+                                                     filtered_image=filtered_image, size=1)
+    elif mode == 'transaction':
+        insert_results([ResultRow(entered_image, filtered_image, '', 1)], alias)
+    else:
+        committer.commit(ResultRow(entered_image, filtered_image, '', 1))
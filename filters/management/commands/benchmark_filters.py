@@ -0,0 +1,84 @@
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from filters.benchmark import (LEGACY_FILTER, MODES, RESOLUTIONS, compare, environment, load_samples,
+                               run_benchmarks)
+from filters.registry import FILTERS
+
+
+def name_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark every filter over synthetic and sample images and optionally compare against a baseline.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--filters', type=name_list,
+                            help=f'Filters to run (default: all registered filters and {LEGACY_FILTER}).')
+        parser.add_argument('--resolutions', type=name_list, default=['vga', '1080p', '12mp'],
+                            help=f'Resolutions to run, from {", ".join(RESOLUTIONS)} or "all".')
+        parser.add_argument('--modes', type=name_list, default=list(MODES), help='Image modes: L, RGB, RGBA.')
+        parser.add_argument('--samples', nargs='*',
+                            default=[os.path.join(settings.MEDIA_ROOT, 'enteredImages')],
+                            help='Sample image files or directories. Pass no value to skip the sample corpus.')
+        parser.add_argument('--sample-limit', type=int, default=2, help='Maximum number of distinct samples.')
+        parser.add_argument('--repeat', type=int, default=3, help='Timed runs per case; the median is reported.')
+        parser.add_argument('--no-persist', action='store_true', help='Skip the persist stage.')
+        parser.add_argument('--output', help='Write the results to this JSON file.')
+        parser.add_argument('--compare', help='Baseline JSON file written by an earlier --output run.')
+        parser.add_argument('--threshold', type=float, default=0.15,
+                            help='Relative slowdown that counts as a regression (default 0.15).')
+
+    def handle(self, *args, **options):
+        filters = options['filters'] or sorted(FILTERS) + [LEGACY_FILTER]
+        unknown = [name for name in filters if name not in FILTERS and name != LEGACY_FILTER]
+        if unknown:
+            raise CommandError(f'Unknown filters: {", ".join(unknown)}.')
+        resolutions = list(RESOLUTIONS) if options['resolutions'] == ['all'] else options['resolutions']
+        unknown = [name for name in resolutions if name not in RESOLUTIONS]
+        if unknown:
+            raise CommandError(f'Unknown resolutions: {", ".join(unknown)}.')
+        unknown = [mode for mode in options['modes'] if mode not in MODES]
+        if unknown:
+            raise CommandError(f'Unknown modes: {", ".join(unknown)}.')
+
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as baseline_file:
+                baseline = json.load(baseline_file)['results']
+
+        samples = load_samples([path for path in options['samples'] if os.path.exists(path)],
+                               options['sample_limit'])
+        self.stdout.write(f'{"filter":<26} {"corpus":<22} {"size":<6} {"mode":<5} '
+                          f'{"decode":>8} {"filter":>8} {"encode":>8} {"persist":>8} {"total":>9} '
+                          f'{"MP/s":>7} {"peak MB":>8}')
+        results = run_benchmarks(filters, resolutions, options['modes'], samples, options['repeat'],
+                                 not options['no_persist'], progress=self.write_result)
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump({'environment': environment(), 'results': results}, output, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Wrote {len(results)} results to {options["output"]}.'))
+
+        if baseline is not None:
+            regressions = compare(results, baseline, options['threshold'])
+            for (name, corpus, resolution, mode), metric, old, new in regressions:
+                self.stdout.write(self.style.ERROR(
+                    f'{name} {corpus} {resolution} {mode}: {metric} {old} -> {new} ({new / old - 1:+.0%})'))
+            if regressions:
+                raise CommandError(f'{len(regressions)} regressions against {options["compare"]}.')
+            self.stdout.write(self.style.SUCCESS(f'No regressions against {options["compare"]}.'))
+
+    def write_result(self, result):
+        def ms(stage):
+            value = result.get(f'{stage}_ms')
+            return '-' if value is None else f'{value:.1f}'
+
+        self.stdout.write(
+            f'{result["filter"]:<26} {result["corpus"][:22]:<22} {result["resolution"]:<6} {result["mode"]:<5} '
+            f'{ms("decode"):>8} {ms("filter"):>8} {ms("encode"):>8} {ms("persist"):>8} {ms("total"):>9} '
+            f'{result["megapixels_per_second"]:>7} {result["peak_memory_bytes"] / 2 ** 20:>8.1f}')
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from filters.cache import evict_cached_results
+
+
+class Command(BaseCommand):
+    help = 'Evict cached filter results past the configured age or size limit.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=int, help='Maximum age in seconds since a result was last used.')
+        parser.add_argument('--max-bytes', type=int, help='Maximum total size of cached results in bytes.')
+
+    def handle(self, *args, **options):
+        evicted = evict_cached_results(max_age=options['max_age'], max_bytes=options['max_bytes'])
+        self.stdout.write(self.style.SUCCESS(f'Evicted {evicted} cached filter results.'))
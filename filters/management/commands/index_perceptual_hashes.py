@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from filters.models import EnteredImage
+from filters.similarity import perceptual_hash
+
+
+class Command(BaseCommand):
+    help = 'Compute perceptual hashes for stored images that do not have one yet.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200, help='Rows to update per query.')
+
+    def handle(self, *args, **options):
+        pending, indexed, unreadable = [], 0, 0
+        for entered_image in EnteredImage.objects.filter(perceptual_hash='').exclude(image_file='').iterator():
+            try:
+                with entered_image.image_file.open('rb') as image_file:
+                    entered_image.perceptual_hash = perceptual_hash(image_file.read())
+            except OSError:
+                entered_image.perceptual_hash = ''
+            if not entered_image.perceptual_hash:
+                unreadable += 1
+                continue
+            pending.append(entered_image)
+            if len(pending) >= options['batch_size']:
+                indexed += EnteredImage.objects.bulk_update(pending, ['perceptual_hash'])
+                pending = []
+        if pending:
+            indexed += EnteredImage.objects.bulk_update(pending, ['perceptual_hash'])
+        self.stdout.write(self.style.SUCCESS(f'Indexed {indexed} images; {unreadable} could not be read.'))
@@ -0,0 +1,111 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from filters.benchmark import RESOLUTIONS, environment
+from filters.loadtest import (DEFAULT_SIZES, ENDPOINTS, LocalServer, Traffic, build_corpus, compare, parse_weights,
+                              run_load, saturation)
+
+
+def weights_text(weights):
+    return ','.join(f'{name}={weight:g}' for name, weight in weights.items())
+
+
+class Command(BaseCommand):
+    help = ('Replay a mix of filter requests at rising concurrency against a local server (or --url) and '
+            'report throughput, latency percentiles, error rates and saturation points.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='Load an already running server instead of starting one locally.')
+        parser.add_argument('--mix', default=','.join(ENDPOINTS),
+                            help=f'Endpoint weights as name=weight, from {", ".join(ENDPOINTS)} '
+                                 '(default: all equally).')
+        parser.add_argument('--sizes', default=weights_text(DEFAULT_SIZES),
+                            help=f'Image size weights as name=weight, from {", ".join(RESOLUTIONS)} '
+                                 f'(default {weights_text(DEFAULT_SIZES)}).')
+        parser.add_argument('--users', default='1,10,50,200', help='Comma separated concurrency steps.')
+        parser.add_argument('--duration', type=float, default=20, help='Seconds per concurrency step.')
+        parser.add_argument('--warmup', type=float, default=5, help='Unmeasured seconds before the first step.')
+        parser.add_argument('--think-time', type=float, default=0,
+                            help='Mean seconds each user waits between requests.')
+        parser.add_argument('--timeout', type=float, default=60, help='Seconds before a request counts as failed.')
+        parser.add_argument('--repeat-ratio', type=float, default=0.2,
+                            help='Share of uploads that resend an earlier image (default 0.2).')
+        parser.add_argument('--images-per-size', type=int, default=3, help='Distinct images at each size.')
+        parser.add_argument('--max-error-rate', type=float, default=0.01,
+                            help='Error rate at which an endpoint counts as saturated (default 0.01).')
+        parser.add_argument('--max-p95-ms', type=float, help='p95 latency at which an endpoint counts as saturated.')
+        parser.add_argument('--output', help='Write the results to this JSON file.')
+        parser.add_argument('--compare', help='Baseline JSON file written by an earlier --output run.')
+        parser.add_argument('--threshold', type=float, default=0.15,
+                            help='Relative slowdown that counts as a regression (default 0.15).')
+
+    def handle(self, *args, **options):
+        try:
+            mix = parse_weights(options['mix'], ENDPOINTS)
+            sizes = parse_weights(options['sizes'], RESOLUTIONS)
+            steps = [int(users) for users in options['users'].split(',') if users.strip()]
+        except ValueError as e:
+            raise CommandError(str(e))
+        if not steps or min(steps) < 1:
+            raise CommandError('--users needs one or more positive concurrency steps.')
+        if options['duration'] <= 0 or options['images_per_size'] < 1:
+            raise CommandError('--duration and --images-per-size must be positive.')
+        if not 0 <= options['repeat_ratio'] <= 1:
+            raise CommandError('--repeat-ratio must be between 0 and 1.')
+
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as baseline_file:
+                baseline = json.load(baseline_file)['steps']
+
+        traffic = Traffic(build_corpus(sizes, options['images_per_size']), mix, sizes, options['repeat_ratio'])
+        if options['url']:
+            results = self.run(options['url'], traffic, steps, options)
+        else:
+            try:
+                with LocalServer() as server:
+                    self.stdout.write(f'Started a scratch server at {server.url}.')
+                    results = self.run(server.url, traffic, steps, options)
+            except RuntimeError as e:
+                raise CommandError(str(e))
+
+        points = saturation(results, options['max_error_rate'], options['max_p95_ms'])
+        self.stdout.write(f'\n{"endpoint":<14} {"saturated at":>12} {"reason":<10} {"peak users":>10} {"peak ok/s":>9}')
+        for name, point in points.items():
+            self.stdout.write(f'{name:<14} {point["users"] or "-":>12} {point["reason"] or "-":<10} '
+                              f'{point["peak_users"] or "-":>10} {point["peak_ok_throughput"] or 0:>9.2f}')
+
+        if options['output']:
+            config = {'url': options['url'] or 'local', 'mix': mix, 'sizes': sizes, 'users': steps}
+            config.update({name: options[name] for name in ('duration', 'warmup', 'think_time', 'timeout',
+                                                            'repeat_ratio', 'images_per_size')})
+            with open(options['output'], 'w') as output:
+                json.dump({'environment': environment(), 'config': config, 'steps': results,
+                           'saturation': points}, output, indent=2)
+            self.stdout.write(self.style.SUCCESS(f'Wrote {len(results)} steps to {options["output"]}.'))
+
+        if baseline is not None:
+            regressions = compare(results, baseline, options['threshold'], options['max_error_rate'])
+            for (users, name), metric, old, new in regressions:
+                change = f' ({new / old - 1:+.0%})' if old else ''
+                self.stdout.write(self.style.ERROR(f'{users} users {name}: {metric} {old} -> {new}{change}'))
+            if regressions:
+                raise CommandError(f'{len(regressions)} regressions against {options["compare"]}.')
+            self.stdout.write(self.style.SUCCESS(f'No regressions against {options["compare"]}.'))
+
+    def run(self, url, traffic, steps, options):
+        self.stdout.write(f'{"users":>5} {"endpoint":<14} {"requests":>8} {"req/s":>8} {"ok/s":>8} '
+                          f'{"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"errors":>7} {"503s":>5}')
+        return run_load(url, traffic, steps, options['duration'], options['timeout'], options['think_time'],
+                        options['warmup'], progress=self.write_step)
+
+    def write_step(self, result):
+        def ms(value):
+            return '-' if value is None else f'{value:.1f}'
+
+        for name, summary in [('overall', result['overall'])] + list(result['endpoints'].items()):
+            self.stdout.write(
+                f'{result["users"]:>5} {name:<14} {summary["requests"]:>8} {summary["throughput"]:>8.2f} '
+                f'{summary["ok_throughput"]:>8.2f} {ms(summary["p50_ms"]):>8} {ms(summary["p95_ms"]):>8} '
+                f'{ms(summary["p99_ms"]):>8} {summary["error_rate"]:>7.1%} {summary["rejected"]:>5}')
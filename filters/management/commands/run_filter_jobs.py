@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from filters.jobs import JobDispatcher
+from filters.models import FilterJob
+
+
+class Command(BaseCommand):
+    help = 'Run queued asynchronous filter jobs on a local process pool.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=getattr(settings, 'FILTER_JOB_CONCURRENCY', 2),
+                            help='Maximum number of jobs running at once.')
+        parser.add_argument('--requeue-running', action='store_true',
+                            help='Put jobs left running by a stopped worker back in the queue first.')
+
+    def handle(self, *args, **options):
+        if options['requeue_running']:
+            requeued = FilterJob.objects.filter(status=FilterJob.RUNNING).update(status=FilterJob.QUEUED)
+            self.stdout.write(f'Requeued {requeued} jobs.')
+
+        dispatcher = JobDispatcher(options['concurrency'])
+        self.stdout.write(self.style.SUCCESS(f'Running filter jobs with concurrency {options["concurrency"]}.'))
+        try:
+            dispatcher.run()
+        except KeyboardInterrupt:
+            self.stdout.write('Waiting for running jobs to finish.')
+            dispatcher.stop(wait=True)
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.7 on 2026-10-18 18:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filters', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='enteredimage',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=64),
+        ),
+        migrations.CreateModel(
+            name='FilterCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(max_length=64)),
+                ('filter_used', models.CharField(max_length=255)),
+                ('params', models.CharField(blank=True, default='', max_length=255)),
+                ('size', models.PositiveBigIntegerField(default=0)),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('filtered_image', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='cache_entry', to='filters.filteredimage')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='filtercacheentry',
+            constraint=models.UniqueConstraint(fields=('content_hash', 'filter_used', 'params'), name='unique_filter_cache_key'),
+        ),
+    ]
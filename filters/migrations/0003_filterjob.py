@@ -0,0 +1,35 @@
+# Generated by Django 4.2.7 on 2026-10-18 18:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filters', '0002_filtercacheentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FilterJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=16)),
+                ('priority', models.IntegerField(default=0)),
+                ('pipeline', models.CharField(max_length=255)),
+                ('filter_used', models.CharField(max_length=255)),
+                ('suffix', models.CharField(max_length=64)),
+                ('params', models.CharField(blank=True, default='', max_length=255)),
+                ('error', models.TextField(blank=True, default='')),
+                ('entered_image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='filters.enteredimage')),
+                ('filtered_image', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='filters.filteredimage')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', '-priority', 'created_at'], name='filter_job_queue_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+from django.db import migrations
+
+
+def invalidate_sepia_results(apps, schema_editor):
+    # Sepia used to be applied as a 3x3 convolution kernel; results cached
+    # before it became a colour matrix must not be served again. The images
+    # and their files are deleted too, which drops their cache entries.
+    FilterCacheEntry = apps.get_model('filters', 'FilterCacheEntry')
+    FilteredImage = apps.get_model('filters', 'FilteredImage')
+    stale = FilteredImage.objects.filter(
+        pk__in=FilterCacheEntry.objects.filter(filter_used__contains='sepia').values('filtered_image'))
+    for filtered_image in stale.only('image_file'):
+        filtered_image.image_file.delete(save=False)
+    stale.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filters', '0003_filterjob'),
+    ]
+
+    operations = [
+        migrations.RunPython(invalidate_sepia_results, migrations.RunPython.noop),
+    ]
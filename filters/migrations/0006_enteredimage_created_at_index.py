@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 18:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filters', '0005_image_derivatives'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='enteredimage',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,43 @@
+import uuid
+
+from django.db import migrations, models
+
+
+def assign_uuids(apps, schema_editor):
+    for model_name in ('EnteredImage', 'FilteredImage'):
+        model = apps.get_model('filters', model_name)
+        rows = list(model.objects.only('pk'))
+        for row in rows:
+            row.uuid = uuid.uuid4()
+        model.objects.bulk_update(rows, ['uuid'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filters', '0006_enteredimage_created_at_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='enteredimage',
+            name='uuid',
+            field=models.UUIDField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='filteredimage',
+            name='uuid',
+            field=models.UUIDField(editable=False, null=True),
+        ),
+        migrations.RunPython(assign_uuids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='enteredimage',
+            name='uuid',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='filteredimage',
+            name='uuid',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+    ]
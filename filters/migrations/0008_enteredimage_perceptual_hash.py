@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 18:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filters', '0007_image_uuid'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='enteredimage',
+            name='perceptual_hash',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=16),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-18 19:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filters', '0008_enteredimage_perceptual_hash'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='filterjob',
+            name='pipeline',
+            field=models.TextField(),
+        ),
+    ]
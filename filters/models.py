@@ -1,9 +1,17 @@
+import uuid
+
 from django.db import models
 
 
 class EnteredImage(models.Model):
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     image_file = models.FileField(upload_to='enteredImages/', null=True, blank=True)
+    content_hash = models.CharField(max_length=64, blank=True, default='', db_index=True)
+    # dHash of the image as 16 hex digits; see similarity.py.
+    perceptual_hash = models.CharField(max_length=16, blank=True, default='', db_index=True)
+    derivatives = models.JSONField(default=dict, blank=True)
+    # Assigned before the row is written, so write-behind responses can return it.
+    uuid = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
 
     def __str__(self):
         return f'Entered image at {self.created_at}'
@@ -14,6 +22,62 @@ class FilteredImage(models.Model):
     image_file = models.FileField(upload_to='filteredImages/')
     original_image = models.ForeignKey(EnteredImage, on_delete=models.CASCADE)
     filter_used = models.CharField(max_length=255)
+    derivatives = models.JSONField(default=dict, blank=True)
+    uuid = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
 
     def __str__(self):
         return f'Filtered image at {self.created_at} with {self.filter_used} filter'
+
+
+class FilterCacheEntry(models.Model):
+    content_hash = models.CharField(max_length=64)
+    filter_used = models.CharField(max_length=255)
+    params = models.CharField(max_length=255, blank=True, default='')
+    filtered_image = models.OneToOneField(FilteredImage, on_delete=models.CASCADE, related_name='cache_entry')
+    size = models.PositiveBigIntegerField(default=0)
+    hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['content_hash', 'filter_used', 'params'], name='unique_filter_cache_key'),
+        ]
+
+    def __str__(self):
+        return f'Cached {self.filter_used} result for {self.content_hash[:12]}'
+
+
+class FilterJob(models.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED)
+    priority = models.IntegerField(default=0)
+    entered_image = models.ForeignKey(EnteredImage, on_delete=models.CASCADE)
+    filtered_image = models.ForeignKey(FilteredImage, on_delete=models.SET_NULL, null=True, blank=True)
+    # Pipeline text for the worker, which may include whole kernels.
+    pipeline = models.TextField()
+    filter_used = models.CharField(max_length=255)
+    suffix = models.CharField(max_length=64)
+    params = models.CharField(max_length=255, blank=True, default='')
+    error = models.TextField(blank=True, default='')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', '-priority', 'created_at'], name='filter_job_queue_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.filter_used} job {self.pk} ({self.status})'
@@ -0,0 +1,91 @@
+import cv2
+import numpy as np
+
+from .blur import gaussian_blur, kernel_size, tile_plan
+from .convolution import convolve as run_convolution, get_plan
+from .point_ops import brightness_op, contrast_op, gamma_op, grayscale_op, sepia_op
+from .registry import check_number, register
+
+
+EMBOSS_KERNEL = np.array([[0, -1, -1], [1, 0, -1], [1, 1, 0]], dtype=np.float32)
+SHARPEN_KERNEL = np.array([[-1, -1, -1], [-1, 9, -1], [-1, -1, -1]], dtype=np.float32)
+# PIL's ImageFilter.CONTOUR: 3x3 Laplacian with an offset of 255.
+CONTOUR_KERNEL = np.array([[-1, -1, -1], [-1, 8, -1], [-1, -1, -1]], dtype=np.float32)
+
+
+@register('black_and_white', suffix='bw', aliases=('grayscale', 'bw'), tiling=0, point_op=grayscale_op, cost=0.3)
+def black_and_white(image):
+    if image.ndim == 2:
+        return image.copy()
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+
+def blur_tiling(params, shape):
+    k = kernel_size(params.get('k', 35), params.get('radius'))
+    plan = tile_plan(k, shape, params.get('quality', 'balanced'), params.get('algorithm'))
+    if plan is None:
+        return None
+    rows, algorithm = plan
+    return rows, dict(params, algorithm=algorithm)
+
+
+@register('blur', label='blur_filter', inplace=True, scalable=('k', 'radius'), tiling=blur_tiling, cost=2.5)
+def blur(image, k=35, radius=None, quality='balanced', algorithm=None, dst=None):
+    return gaussian_blur(image, kernel_size(k, radius), quality, algorithm, dst=dst)
+
+
+@register('sketch', label='sketch_filter', tiling=1, cost=1.3)
+def sketch(image):
+    sketched = cv2.filter2D(image, -1, CONTOUR_KERNEL, delta=255)
+    # PIL leaves the one pixel border untouched.
+    sketched[0], sketched[-1] = image[0], image[-1]
+    sketched[:, 0], sketched[:, -1] = image[:, 0], image[:, -1]
+    return sketched
+
+
+@register('emboss', label='emboss_filter', kernel=EMBOSS_KERNEL, inplace=True)
+def emboss(image, dst=None):
+    return cv2.filter2D(image, -1, EMBOSS_KERNEL, dst=dst)
+
+
+@register('sharpen', label='sharpen_filter', kernel=SHARPEN_KERNEL, inplace=True, cost=1.3)
+def sharpen(image, dst=None):
+    return cv2.filter2D(image, -1, SHARPEN_KERNEL, dst=dst)
+
+
+@register('sepia', label='sepia_filter', inplace=True, tiling=0, point_op=sepia_op, cost=0.4)
+def sepia(image, dst=None):
+    return sepia_op().apply(image, dst=dst)
+
+
+def convolve_tiling(params, shape):
+    plan = get_plan(params['kernel'], params.get('normalize', False))
+    return plan.kernel.shape[0] // 2, params
+
+
+def convolve_kernel(kernel, normalize=False, delta=0.0):
+    # With a delta the result is not a plain correlation.
+    if check_number('delta', delta) != 0:
+        return None
+    return get_plan(kernel, normalize).kernel
+
+
+@register('convolve', label='convolution', suffix='convolved', kernel=convolve_kernel, tiling=convolve_tiling,
+          cost=4.0)
+def convolve(image, kernel, normalize=False, delta=0.0):
+    return run_convolution(image, get_plan(kernel, normalize), float(check_number('delta', delta)))
+
+
+@register('brightness', inplace=True, tiling=0, point_op=brightness_op)
+def brightness(image, amount=0, dst=None):
+    return brightness_op(amount).apply(image, dst=dst)
+
+
+@register('contrast', inplace=True, tiling=0, point_op=contrast_op)
+def contrast(image, factor=1.0, dst=None):
+    return contrast_op(factor).apply(image, dst=dst)
+
+
+@register('gamma', inplace=True, tiling=0, point_op=gamma_op)
+def gamma(image, gamma=1.0, dst=None):
+    return gamma_op(gamma).apply(image, dst=dst)
@@ -0,0 +1,123 @@
+import os
+
+from django.core.files.base import ContentFile
+
+from . import writer
+from .cache import maybe_evict_cached_results, params_key
+from .db import ResultRow, commit_result, insert_results
+from .derivatives import schedule_derivatives
+from .metrics import stage
+from .models import EnteredImage, FilteredImage
+from .similarity import schedule_perceptual_hash
+
+
+def store_original_image(image_file, content_hash='', perceptual_hash=''):
+    """Write ``image_file`` to storage and return its unsaved EnteredImage.
+
+    Without a ``perceptual_hash`` one is computed in the background once
+    the row is saved; see ``similarity.schedule_perceptual_hash``.
+    """
+    image_file.seek(0)
+    entered_image = EnteredImage(content_hash=content_hash, perceptual_hash=perceptual_hash)
+    with stage('storage'):
+        entered_image.image_file.save(image_file.name, image_file, save=False)
+    return entered_image
+
+
+def store_filtered_image(data, entered_image, filter_used, suffix, extension='.jpg'):
+    """Write a filtered result to storage and return its unsaved FilteredImage."""
+    name = os.path.splitext(os.path.basename(entered_image.image_file.name))[0]
+    filtered_image = FilteredImage(original_image=entered_image, filter_used=filter_used)
+    with stage('storage'):
+        filtered_image.image_file.save(f'{name}_{suffix}{extension}', ContentFile(data), save=False)
+    return filtered_image
+
+
+def save_original_image(image_file, content_hash='', perceptual_hash=''):
+    entered_image = store_original_image(image_file, content_hash, perceptual_hash)
+    with stage('db'):
+        entered_image.save()
+    schedule_derivatives(entered_image)
+    schedule_perceptual_hash(entered_image)
+    return entered_image
+
+
+def save_filtered_image(data, entered_image, filter_used, suffix, extension='.jpg'):
+    filtered_image = store_filtered_image(data, entered_image, filter_used, suffix, extension)
+    with stage('db'):
+        filtered_image.save()
+    schedule_derivatives(filtered_image, data)
+    return filtered_image
+
+
+def save_results(upload, content_hash, results, entered_image=None):
+    """Store an upload's filtered results and insert all their rows in one transaction.
+
+    ``results`` holds ``(encoded, filter_used, suffix, extension, params)``
+    tuples. The original is stored too unless ``entered_image`` is given.
+    Returns the EnteredImage and the FilteredImages, in order; a result
+    another request cached first is returned in place of this one's.
+    """
+    new_original = entered_image is None
+    if new_original:
+        with stage('storage'):
+            entered_image = upload.take_stored()
+        if entered_image is None:
+            entered_image = store_original_image(upload.image_file, content_hash, upload.known_perceptual_hash())
+        entered_image.content_hash = content_hash
+        entered_image.perceptual_hash = upload.known_perceptual_hash()
+    rows = [ResultRow(entered_image, store_filtered_image(encoded, entered_image, filter_used, suffix, extension),
+                      params_key(params), len(encoded))
+            for encoded, filter_used, suffix, extension, params in results]
+    with stage('db'):
+        filtered_images = insert_results(rows)
+    if new_original:
+        schedule_derivatives(entered_image)
+        schedule_perceptual_hash(entered_image)
+    for row, filtered_image, (encoded, *_) in zip(rows, filtered_images, results):
+        if filtered_image is row.filtered_image:
+            schedule_derivatives(filtered_image, encoded)
+    with stage('cache'):
+        maybe_evict_cached_results()
+    return entered_image, filtered_images
+
+
+def store_original_in_background(upload):
+    """Start writing ``upload`` to storage while it is filtered, unless write-behind will store it."""
+    if not writer.enabled():
+        upload.start_store()
+
+
+def save_result(upload, content_hash, encoded, filter_used, suffix, extension='.jpg', params=None):
+    """Store an upload and its filtered result, and cache the result.
+
+    Both files are stored first; the three rows are then inserted in one
+    transaction (see ``db.commit_result``). In write-behind mode this only
+    queues the writes and returns unsaved instances; see ``writer``.
+    """
+    with stage('storage'):
+        entered_image = upload.take_stored()
+    if entered_image is None and writer.enabled():
+        cache_key = (content_hash, filter_used, params_key(params))
+        pending = writer.get_writer().submit(
+            upload.name, upload.data, content_hash, encoded, filter_used, suffix, extension, cache_key,
+            upload.known_perceptual_hash())
+        if pending is not None:
+            return pending
+
+    if entered_image is None:
+        entered_image = store_original_image(upload.image_file, content_hash, upload.known_perceptual_hash())
+    entered_image.content_hash = content_hash
+    entered_image.perceptual_hash = upload.known_perceptual_hash()
+    filtered_image = store_filtered_image(encoded, entered_image, filter_used, suffix, extension)
+    with stage('db'):
+        cached = commit_result(ResultRow(entered_image, filtered_image, params_key(params), len(encoded)))
+    schedule_derivatives(entered_image)
+    schedule_perceptual_hash(entered_image)
+    if cached is not filtered_image:
+        # A concurrent request cached the same result first.
+        return entered_image, cached
+    schedule_derivatives(filtered_image, encoded)
+    with stage('cache'):
+        maybe_evict_cached_results()
+    return entered_image, filtered_image
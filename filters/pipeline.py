@@ -0,0 +1,251 @@
+import hashlib
+import inspect
+import json
+import re
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from . import engine
+from .point_ops import PointOp
+from .registry import FilterError, get_filter
+
+
+MAX_STAGES = 16
+# Hex digits of a list value's SHA-256 kept in pipeline labels.
+DIGEST_LENGTH = 16
+# Fusing only pays off while the combined kernel stays small.
+MAX_FUSED_KERNEL_SIZE = 11
+# Fusing skips the rounding between stages. Below this total gain the second
+# stage turns that into less than one level of difference.
+MAX_FUSED_GAIN = 1.5
+
+Stage = namedtuple('Stage', ['spec', 'params'])
+
+STAGE_RE = re.compile(r'^(?P<name>\w+)\s*(?:\((?P<params>[^()]*)\))?$')
+
+
+def parse_pipeline(text):
+    """Parse ``'grayscale -> blur(k=15) -> sharpen'`` into a list of stages."""
+    parts = [part.strip() for part in re.split(r'->|\|', text or '')]
+    if not any(parts):
+        raise FilterError('Pipeline is empty.')
+    if len(parts) > MAX_STAGES:
+        raise FilterError(f'Pipelines are limited to {MAX_STAGES} stages.')
+
+    stages = []
+    for part in parts:
+        match = STAGE_RE.match(part)
+        if match is None:
+            raise FilterError(f'Invalid pipeline stage: {part!r}.')
+        spec = get_filter(match.group('name'))
+        params = parse_params(match.group('params') or '')
+        engine.check_params(spec, params)
+        stages.append(Stage(spec, params))
+    return stages
+
+
+def param_names(spec):
+    """Names of the parameters a filter accepts from requests."""
+    return [name for name in list(inspect.signature(spec.func).parameters)[1:] if name != 'dst']
+
+
+def parse_params(text):
+    params = {}
+    for item in filter(None, (item.strip() for item in split_params(text))):
+        key, sep, value = item.partition('=')
+        if not sep or not key.strip().isidentifier() or not value.strip():
+            raise FilterError(f'Invalid stage parameter: {item!r}.')
+        params[key.strip()] = parse_value(value.strip())
+    return params
+
+
+def split_params(text):
+    # Commas inside a list value such as ``kernel=[[1,2],[3,4]]`` do not separate parameters.
+    items, depth, start = [], 0, 0
+    for index, char in enumerate(text):
+        if char == '[':
+            depth += 1
+        elif char == ']':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            items.append(text[start:index])
+            start = index + 1
+    items.append(text[start:])
+    return items
+
+
+def parse_value(value):
+    """A number, a list written as JSON, or the text itself."""
+    if value.startswith('['):
+        try:
+            return json.loads(value)
+        except ValueError:
+            raise FilterError(f'Invalid list value: {value!r}.')
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+
+def format_value(value):
+    if isinstance(value, (list, tuple)):
+        return json.dumps(value, separators=(',', ':'))
+    return str(value)
+
+
+def describe(stages):
+    """Canonical label, used as ``filter_used`` and as the cache key.
+
+    List values such as convolution kernels are replaced by a digest of
+    their text, so labels fit the 255 character columns. Use ``serialize``
+    for text that ``parse_pipeline`` can read back.
+    """
+    return _join(stages, label_value)
+
+
+def serialize(stages):
+    """Text that ``parse_pipeline`` reads back into ``stages``, for jobs and worker processes."""
+    return _join(stages, format_value)
+
+
+def label_value(value):
+    if isinstance(value, (list, tuple)):
+        return 'sha256:' + hashlib.sha256(format_value(value).encode()).hexdigest()[:DIGEST_LENGTH]
+    return str(value)
+
+
+def _join(stages, formatter):
+    return ' -> '.join(
+        stage.spec.name + (f'({", ".join(f"{k}={formatter(v)}" for k, v in sorted(stage.params.items()))})'
+                           if stage.params else '')
+        for stage in stages
+    )
+
+
+def fuse(stages):
+    """Merge runs of adjacent kernel filters into a single correlation kernel
+    and runs of adjacent point filters into a single ``PointOp``.
+
+    Returns a list of steps, each a kernel array, a ``PointOp`` or a stage.
+    Fused steps skip the uint8 rounding and clipping between stages, so
+    kernels are only merged when the first cannot clip (see ``can_fuse``),
+    and matrices likewise (see ``PointOp.then``). Each merged step stays
+    within one level of running its stages one by one. A stage that merged
+    with nothing stays a stage, so it keeps its own implementation.
+    """
+    steps = []
+    # The stage behind each step, or None once the step merges several.
+    sources = []
+    for stage in stages:
+        kernel = stage_kernel(stage)
+        previous = steps[-1] if steps else None
+        if stage.spec.point_op is not None:
+            op = stage.spec.point_op(**stage.params)
+            fused = previous.then(op) if isinstance(previous, PointOp) else None
+            if fused is not None:
+                steps[-1], sources[-1] = fused, None
+            else:
+                steps.append(op)
+                sources.append(stage)
+            continue
+        if kernel is not None and isinstance(previous, np.ndarray) and can_fuse(previous, kernel):
+            fused = combine_kernels(previous, kernel)
+            if max(fused.shape) <= MAX_FUSED_KERNEL_SIZE:
+                steps[-1], sources[-1] = fused, None
+                continue
+        steps.append(kernel.astype(np.float32) if kernel is not None else stage)
+        sources.append(stage)
+    return [source if source is not None else step for step, source in zip(steps, sources)]
+
+
+def stage_kernel(stage):
+    """The correlation kernel ``stage`` amounts to, or None."""
+    kernel = stage.spec.kernel
+    if callable(kernel):
+        return kernel(**stage.params)
+    return kernel if not stage.params else None
+
+
+def can_fuse(first, second):
+    """Whether correlating with ``first`` and then ``second`` can run as one kernel.
+
+    A kernel with no negative weights summing to at most 1 never leaves
+    0-255, so skipping its clip changes nothing. Emboss and sharpen do
+    clip: fused, they were off by up to 255 levels.
+    """
+    return bool((first >= 0).all() and first.sum() <= 1 + 1e-6 and np.abs(second).sum() <= MAX_FUSED_GAIN)
+
+
+def combine_kernels(first, second):
+    """Kernel equal to correlating with ``first`` and then with ``second``."""
+    height, width = first.shape
+    combined = np.zeros((height + second.shape[0] - 1, width + second.shape[1] - 1), dtype=np.float32)
+    for (y, x), weight in np.ndenumerate(second):
+        combined[y:y + height, x:x + width] += weight * first
+    return combined
+
+
+def scale_stages(stages, scale):
+    """Shrink kernel-size parameters by ``scale``, keeping them odd and at least 1."""
+    scaled = []
+    for spec, params in stages:
+        params = dict(params)
+        if spec.scalable and scale != 1:
+            defaults = inspect.signature(spec.func).parameters
+            for name in spec.scalable:
+                value = params.get(name, defaults[name].default)
+                # Values that are not numbers are left for the filter to reject.
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                size = max(1, round(value * scale))
+                params[name] = size if size % 2 else size + 1
+        scaled.append(Stage(spec, params))
+    return scaled
+
+
+def prepare(data, stages, max_dimension=None):
+    """Decode ``data`` for ``stages``, as a preview if ``max_dimension`` is given."""
+    if not max_dimension:
+        return engine.decode(data), stages
+    image, scale = engine.decode_preview(data, max_dimension)
+    return image, scale_stages(stages, scale)
+
+
+def run_pipeline(image, stages, tiled=None):
+    """Run ``stages`` over ``image``, reusing its buffer wherever possible.
+
+    ``image`` is owned by the pipeline and may be overwritten. Very large
+    images, or any image when ``tiled`` is true, are processed in strips
+    (see ``tiling.run_tiled``) when every stage allows it.
+    """
+    from .tiling import run_tiled, should_tile
+
+    if should_tile(image, tiled):
+        output = run_tiled(image, stages)
+        if output is not None:
+            return output
+    return run_steps(image, fuse(stages))
+
+
+def run_steps(image, steps):
+    for step in steps:
+        if isinstance(step, np.ndarray):
+            image = cv2.filter2D(image, -1, step, dst=image)
+        elif isinstance(step, PointOp):
+            image = step.apply(image, dst=image)
+        else:
+            image = engine.apply_inplace(image, step.spec.name, **step.params)
+    return image
+
+
+def process(data, text, max_dimension=None, tiled=None, encode_options=None):
+    """Decode, run the pipeline described by ``text`` and encode.
+
+    Only takes plain values so it can be sent to a worker process.
+    """
+    image, stages = prepare(data, parse_pipeline(text), max_dimension)
+    return engine.encode(run_pipeline(image, stages, tiled), **(encode_options or {}))
@@ -0,0 +1,118 @@
+"""Per-pixel operations that can be merged into a single pass.
+
+A ``PointOp`` is either a 256 entry lookup table applied to every channel
+or an affine colour matrix (``cv2.transform``) over BGR pixels. Adjacent
+tables compose into one table and adjacent matrices multiply into one
+matrix, so a run of point filters in a pipeline costs one pass. Composed
+tables are exact. Multiplied matrices skip the uint8 rounding and
+clipping in between, so they are only merged when the first never leaves
+0-255 (true of grayscale, not of sepia) and the second's gain is at most
+``MAX_MERGED_GAIN``. The merged op then stays within one level of running
+the two one by one.
+"""
+from functools import lru_cache
+
+import cv2
+import numpy as np
+
+from .registry import FilterError, check_number
+
+
+# Rows are output channels and columns input channels, both in BGR order.
+SEPIA_MATRIX = np.array([
+    [0.131, 0.534, 0.272],
+    [0.168, 0.686, 0.349],
+    [0.189, 0.769, 0.393],
+], dtype=np.float32)
+GRAYSCALE_MATRIX = np.array([[0.114, 0.587, 0.299]], dtype=np.float32)
+# The largest sum of absolute weights in any row of the second merged matrix.
+MAX_MERGED_GAIN = 1.5
+
+
+class PointOp:
+    def __init__(self, lut=None, matrix=None):
+        self.lut = lut
+        if matrix is not None and matrix.shape[1] == 3:
+            matrix = np.hstack([matrix, np.zeros((matrix.shape[0], 1), dtype=np.float32)])
+        self.matrix = matrix
+
+    def then(self, other):
+        """The single op equal to ``self`` followed by ``other``, or None."""
+        if self.lut is not None and other.lut is not None:
+            return PointOp(lut=other.lut[self.lut])
+        if (self.matrix is not None and other.matrix is not None and stays_in_range(self.matrix)
+                and np.abs(other.matrix[:, :3]).sum(axis=1).max() <= MAX_MERGED_GAIN):
+            channels = self.matrix.shape[0]
+            second = _for_channels(other.matrix, channels)
+            linear = second[:, :channels] @ self.matrix[:, :3]
+            offset = second[:, :channels] @ self.matrix[:, 3] + second[:, channels]
+            return PointOp(matrix=np.hstack([linear, offset[:, None]]).astype(np.float32))
+        return None
+
+    def apply(self, image, dst=None):
+        if self.lut is not None:
+            return cv2.LUT(image, self.lut, dst=dst)
+        channels = 1 if image.ndim == 2 else image.shape[2]
+        matrix = _for_channels(self.matrix, channels)
+        if matrix.shape[0] != channels:
+            dst = None
+        return cv2.transform(image, matrix, dst=dst)
+
+
+def stays_in_range(matrix):
+    """Whether ``matrix`` maps every pixel in 0-255 into 0-255, so clipping its output changes nothing."""
+    weights, offset = matrix[:, :3], matrix[:, 3]
+    low = offset + np.minimum(weights, 0).sum(axis=1) * 255
+    high = offset + np.maximum(weights, 0).sum(axis=1) * 255
+    return bool((low >= -1e-3).all() and (high <= 255 + 1e-3).all())
+
+
+def _for_channels(matrix, channels):
+    # A grayscale pixel stands for equal B, G and R values, so its single
+    # input column is the sum of the three colour columns.
+    if channels == 3:
+        return matrix
+    if channels == 1:
+        return np.hstack([matrix[:, :3].sum(axis=1, keepdims=True), matrix[:, 3:]])
+    raise FilterError(f'Point operations need 1 or 3 channels, not {channels}.')
+
+
+def brightness_op(amount=0):
+    return _brightness_op(check_number('amount', amount))
+
+
+def contrast_op(factor=1.0):
+    return _contrast_op(check_number('factor', factor))
+
+
+def gamma_op(gamma=1.0):
+    if not check_number('gamma', gamma) > 0:
+        raise FilterError('gamma must be greater than 0.')
+    return _gamma_op(gamma)
+
+
+@lru_cache(maxsize=64)
+def _brightness_op(amount):
+    return PointOp(lut=_to_lut(np.arange(256, dtype=np.float32) + amount))
+
+
+@lru_cache(maxsize=64)
+def _contrast_op(factor):
+    return PointOp(lut=_to_lut((np.arange(256, dtype=np.float32) - 128) * factor + 128))
+
+
+@lru_cache(maxsize=64)
+def _gamma_op(gamma):
+    return PointOp(lut=_to_lut(255 * (np.arange(256, dtype=np.float32) / 255) ** (1 / gamma)))
+
+
+def sepia_op():
+    return PointOp(matrix=SEPIA_MATRIX)
+
+
+def grayscale_op():
+    return PointOp(matrix=GRAYSCALE_MATRIX)
+
+
+def _to_lut(values):
+    return np.clip(np.rint(values), 0, 255).astype(np.uint8)
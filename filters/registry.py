@@ -0,0 +1,69 @@
+import math
+from collections import namedtuple
+
+
+FilterSpec = namedtuple('FilterSpec', [
+    'name', 'func', 'label', 'suffix', 'kernel', 'inplace', 'scalable', 'tiling', 'point_op', 'default_format', 'cost',
+])
+
+FILTERS = {}
+ALIASES = {}
+
+
+class FilterError(ValueError):
+    pass
+
+
+def check_number(name, value):
+    """Return ``value`` if it is a finite int or float.
+
+    Request values that are not numbers arrive as text or lists.
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise FilterError(f'{name} must be a number.')
+    return value
+
+
+def register(name, label=None, suffix=None, aliases=(), kernel=None, inplace=False, scalable=(), tiling=None,
+             point_op=None, default_format='jpeg', cost=1.0):
+    """Register ``func(image, **params) -> image`` under ``name``.
+
+    Filter callables receive a contiguous uint8 array in OpenCV channel order
+    (BGR or single-channel) and must return a new array without modifying it.
+    ``label`` is what gets recorded as ``FilteredImage.filter_used`` and
+    ``suffix`` is appended to the output file name.
+
+    Filters that are a plain ``cv2.filter2D`` correlation pass their
+    ``kernel`` so pipelines can fuse them: either the array, or
+    ``kernel(**params)`` returning it, or None when those parameters do more
+    than correlate. ``inplace`` filters also accept a
+    ``dst`` array and may be called with ``dst=image``. ``scalable`` names
+    the odd kernel-size parameters to scale when filtering a downscaled
+    preview, so it looks like the full-size result.
+
+    ``tiling`` lets the filter run on horizontal strips: either the number of
+    rows of context each output row depends on, or
+    ``tiling(params, shape) -> (rows, params)`` returning None when the
+    filter cannot be tiled for that image. Kernel filters get it from their
+    kernel; filters without it always run on the whole image.
+
+    Per-pixel filters pass ``point_op(**params) -> PointOp`` so pipelines
+    can merge runs of them into one pass. ``default_format`` is used when
+    the client does not ask for an output format. ``cost`` is the CPU time
+    per pixel relative to a 3x3 kernel, used for admission control.
+    """
+    def decorator(func):
+        FILTERS[name] = FilterSpec(
+            name, func, label or name, suffix or name, kernel, inplace, scalable, tiling, point_op, default_format,
+            cost)
+        for alias in aliases:
+            ALIASES[alias] = name
+        return func
+    return decorator
+
+
+def get_filter(name):
+    try:
+        return FILTERS[ALIASES.get(name, name)]
+    except KeyError:
+        raise FilterError(f'Unknown filter: {name}.')
@@ -1,17 +1,62 @@
+from django.urls import reverse
 from rest_framework import serializers
 
-from filters.models import EnteredImage, FilteredImage
+from filters.derivatives import DERIVATIVE_DIR
+from filters.models import EnteredImage, FilteredImage, FilterJob
+
+
+class DerivativesField(serializers.ReadOnlyField):
+    """Map each derivative size to the URL it is served from."""
+
+    def to_representation(self, value):
+        prefix = DERIVATIVE_DIR + '/'
+        return {size: reverse('image-derivative', args=[name[len(prefix):]]) for size, name in value.items()}
 
 
 class EnteredImageSerializer(serializers.ModelSerializer):
+    derivatives = DerivativesField()
 
     class Meta:
         model = EnteredImage
         fields = '__all__'
+        read_only_fields = ('content_hash', 'perceptual_hash')
 
 
 class FilteredImageSerializer(serializers.ModelSerializer):
+    derivatives = DerivativesField()
 
     class Meta:
         model = FilteredImage
         fields = '__all__'
+
+
+class EnteredImageListSerializer(EnteredImageSerializer):
+    """Listing serializer that can drop fields and embed each image's filtered images.
+
+    ``fields`` limits the output to the named fields; ``embed`` may contain
+    ``'filtered_images'``, which expects ``filteredimage_set`` to be prefetched.
+    """
+    filtered_images = FilteredImageSerializer(source='filteredimage_set', many=True, read_only=True)
+
+    EMBEDDABLE = ('filtered_images',)
+
+    def __init__(self, *args, fields=None, embed=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        for name in self.EMBEDDABLE:
+            if name not in embed:
+                self.fields.pop(name)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+    @classmethod
+    def selectable_fields(cls):
+        return list(cls(embed=cls.EMBEDDABLE).fields)
+
+
+class FilterJobSerializer(serializers.ModelSerializer):
+    filtered_image = FilteredImageSerializer(read_only=True)
+
+    class Meta:
+        model = FilterJob
+        fields = '__all__'
@@ -0,0 +1,220 @@
+"""Perceptual hashes and a near-duplicate index over stored uploads.
+
+Every ``EnteredImage`` gets a 64-bit difference hash (dHash) of its
+content, which changes little when an image is re-encoded, resized or
+slightly recoloured. It is computed on the derivative pool once the row
+is committed (see ``schedule_perceptual_hash``), so requests do not
+decode the upload twice; only near-duplicate lookups hash it up front.
+
+Each process keeps a BK-tree of the hashes. It is built on first use and
+then catches up on rows with a higher id before every search, so searches
+only visit the branches within the requested Hamming distance instead of
+scanning every row. Rows that had no hash yet are checked again at most
+every ``RECHECK_INTERVAL`` seconds, which picks up hashes written later by
+the background pool, ``SimilarImagesView`` or ``index_perceptual_hashes``.
+Deleted images stay in the tree and are dropped when the rows are fetched.
+"""
+import logging
+import threading
+import time
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.db import connection, transaction
+
+from . import engine
+from .models import EnteredImage
+from .registry import FilterError
+from .workers import get_derivative_pool
+
+logger = logging.getLogger(__name__)
+
+HASH_SIZE = 8
+# Decoding at this size is enough for an 8x8 hash and lets JPEGs use DCT scaling.
+DECODE_DIMENSION = 256
+RECHECK_INTERVAL = 5.0
+# Ids per query when checking rows that had no hash.
+RECHECK_BATCH = 500
+
+_lock = threading.Lock()
+_index = None
+
+
+def dhash(image):
+    """64-bit difference hash of a decoded image, as 16 hex digits."""
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(image, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return f'{int.from_bytes(np.packbits(bits).tobytes(), "big"):016x}'
+
+
+def perceptual_hash(data):
+    """dHash of encoded image bytes, or ``''`` if they cannot be decoded."""
+    try:
+        image, _ = engine.decode_preview(data, DECODE_DIMENSION)
+    except FilterError:
+        return ''
+    return dhash(image)
+
+
+def hash_image_file(image_file):
+    image_file.seek(0)
+    value = perceptual_hash(image_file.read())
+    image_file.seek(0)
+    return value
+
+
+def schedule_perceptual_hash(entered_image, data=None):
+    """Hash ``entered_image`` on the derivative pool once its row is committed, unless it has a hash already.
+
+    ``data`` is the file's content if the caller still holds it; otherwise
+    the stored file is read.
+    """
+    if entered_image.perceptual_hash or not entered_image.image_file:
+        return
+    transaction.on_commit(lambda: get_derivative_pool().submit(_hash_stored_image, entered_image, data))
+
+
+def _hash_stored_image(entered_image, data):
+    try:
+        if data is None:
+            with entered_image.image_file.open('rb') as image_file:
+                data = image_file.read()
+        value = perceptual_hash(data)
+        if value:
+            EnteredImage.objects.filter(pk=entered_image.pk, perceptual_hash='').update(perceptual_hash=value)
+            entered_image.perceptual_hash = value
+    except Exception:
+        logger.exception('Could not hash entered image %s', entered_image.pk)
+    finally:
+        connection.close()
+
+
+def distance(first, second):
+    return (int(first, 16) ^ int(second, 16)).bit_count()
+
+
+class BKTree:
+    """Burkhard-Keller tree over 64-bit integers under Hamming distance."""
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, value, key):
+        # A node is [value, keys, children by distance].
+        if self.root is None:
+            self.root = [value, [key], {}]
+            return
+        node = self.root
+        while True:
+            d = (value ^ node[0]).bit_count()
+            if d == 0:
+                node[1].append(key)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [value, [key], {}]
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        """``(distance, key)`` pairs within ``max_distance`` of ``value``, nearest first."""
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            d = (value ^ node[0]).bit_count()
+            if d <= max_distance:
+                found.extend((d, key) for key in node[1])
+            # By the triangle inequality only these children can hold matches.
+            for child_distance, child in node[2].items():
+                if d - max_distance <= child_distance <= d + max_distance:
+                    stack.append(child)
+        found.sort()
+        return found
+
+
+class ImageIndex:
+    def __init__(self, recheck_interval=RECHECK_INTERVAL):
+        self.tree = BKTree()
+        self.last_id = 0
+        # Rows seen without a hash, and when to look at them again.
+        self.unhashed = set()
+        self.recheck_interval = recheck_interval
+        self.next_recheck = 0.0
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        with self.lock:
+            if self.unhashed and time.monotonic() >= self.next_recheck:
+                self.next_recheck = time.monotonic() + self.recheck_interval
+                self.recheck()
+            rows = EnteredImage.objects.filter(id__gt=self.last_id).order_by('id').values_list('id', 'perceptual_hash')
+            for pk, value in rows.iterator():
+                if value:
+                    self.tree.add(int(value, 16), pk)
+                else:
+                    self.unhashed.add(pk)
+                self.last_id = pk
+
+    def recheck(self):
+        pending = sorted(self.unhashed)
+        for start in range(0, len(pending), RECHECK_BATCH):
+            batch = pending[start:start + RECHECK_BATCH]
+            values = dict(EnteredImage.objects.filter(id__in=batch).values_list('id', 'perceptual_hash'))
+            for pk in batch:
+                value = values.get(pk)
+                # Deleted rows are dropped too.
+                if value != '':
+                    self.unhashed.discard(pk)
+                if value:
+                    self.tree.add(int(value, 16), pk)
+
+    def search(self, value, max_distance):
+        self.refresh()
+        with self.lock:
+            return self.tree.search(int(value, 16), max_distance)
+
+
+def get_index():
+    global _index
+    with _lock:
+        if _index is None:
+            _index = ImageIndex()
+    return _index
+
+
+def find_similar(value, max_distance, limit=None, exclude=None):
+    """Stored EnteredImages within ``max_distance`` of the hash ``value``, as ``(distance, image)`` pairs."""
+    if not value:
+        return []
+    matches = [(d, pk) for d, pk in get_index().search(value, max_distance) if pk != exclude]
+    if limit is not None:
+        matches = matches[:limit]
+    images = EnteredImage.objects.in_bulk([pk for _, pk in matches])
+    return [(d, images[pk]) for d, pk in matches if pk in images]
+
+
+def near_duplicate_distance():
+    return getattr(settings, 'FILTER_NEAR_DUPLICATE_DISTANCE', None)
+
+
+def get_similar_cached_result(value, filter_used, params=None):
+    """A cached result for a stored near-duplicate of the image with hash ``value``, or None.
+
+    Only used when ``FILTER_NEAR_DUPLICATE_DISTANCE`` is set; the nearest
+    image with a cached result for the same filter and params wins.
+    """
+    from .cache import get_cached_result
+
+    max_distance = near_duplicate_distance()
+    if max_distance is None or not value:
+        return None
+    for _, entered_image in find_similar(value, max_distance, limit=16):
+        if entered_image.content_hash:
+            filtered_image = get_cached_result(entered_image.content_hash, filter_used, params)
+            if filtered_image is not None:
+                return filtered_image
+    return None
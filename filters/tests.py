@@ -1,3 +1,1373 @@
-from django.test import TestCase
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import BytesIO
+from unittest import mock
 
-# Create your tests here.
+import cv2
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.core.files.base import ContentFile
+from django.db import DatabaseError, connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from PIL import Image, ImageFilter, ImageOps
+
+from . import cache, db, engine, jobs, metrics, similarity, writer
+from .benchmark import synthetic_image
+from .blur import MAX_ERROR, MAX_KERNEL_SIZE, MAX_MEAN_ERROR, gaussian_blur
+from .admission import AdmissionController, Cost, Overloaded, estimate
+from .db import ResultRow, insert_results
+from .formats import negotiate
+from .models import EnteredImage, FilterCacheEntry, FilteredImage, FilterJob
+from .persistence import store_filtered_image
+from .pipeline import MAX_STAGES, describe, fuse, parse_pipeline, run_pipeline, scale_stages, serialize
+from .point_ops import PointOp, brightness_op, contrast_op, gamma_op, grayscale_op, sepia_op
+from .registry import FilterError, get_filter
+from .tiling import run_tiled
+
+
+def run_one_by_one(image, stages):
+    for stage in stages:
+        image = engine.apply(image, stage.spec.name, **stage.params)
+    return image
+
+
+def max_difference(first, second):
+    return int(np.abs(first.astype(np.int16) - second.astype(np.int16)).max())
+
+
+class MediaRootMixin:
+    """Store files in a temporary MEDIA_ROOT that is removed after each test."""
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def stored_files(self, folder):
+        directory = os.path.join(self.media_root, folder)
+        return sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+
+    def use_own_derivative_pool(self):
+        """Run background work on a pool that finishes before the media root is removed."""
+        pool = ThreadPoolExecutor(max_workers=1)
+        pool_patch = mock.patch('filters.workers._derivative_pool', pool)
+        pool_patch.start()
+        self.addCleanup(pool_patch.stop)
+        self.addCleanup(pool.shutdown)
+
+
+@override_settings(FILTER_DERIVATIVE_SIZES=(), FILTER_WRITE_BEHIND=False, FILTER_GROUP_COMMIT=False)
+class EngineParityTests(SimpleTestCase):
+    """The engine's filters against the PIL and OpenCV code the views used to run.
+
+    Sepia is left out: it became a colour matrix on purpose.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.image = synthetic_image(320, 240)
+        cls.rgb = Image.fromarray(cv2.cvtColor(cls.image, cv2.COLOR_BGR2RGB))
+
+    def assert_matches(self, name, old, max_error=0, **params):
+        if old.ndim == 3:
+            old = cv2.cvtColor(old, cv2.COLOR_RGB2BGR)
+        self.assertLessEqual(max_difference(engine.apply(self.image.copy(), name, **params), old), max_error)
+
+    def test_black_and_white(self):
+        self.assert_matches('black_and_white', np.array(ImageOps.grayscale(self.rgb)), max_error=1)
+
+    def test_blur(self):
+        old = cv2.GaussianBlur(np.array(self.rgb), (35, 35), 0)
+        self.assert_matches('blur', old, quality='exact')
+        self.assert_matches('blur', old, max_error=MAX_ERROR)
+
+    def test_sketch(self):
+        self.assert_matches('sketch', np.array(self.rgb.filter(ImageFilter.CONTOUR)))
+
+    def test_kernel_filters(self):
+        for name, kernel in (('emboss', [[0, -1, -1], [1, 0, -1], [1, 1, 0]]),
+                             ('sharpen', [[-1, -1, -1], [-1, 9, -1], [-1, -1, -1]])):
+            with self.subTest(name=name):
+                self.assert_matches(name, cv2.filter2D(np.array(self.rgb), -1, np.array(kernel)))
+
+    def test_decode_matches_pil(self):
+        data = engine.encode(self.image, format='png')
+        self.assertTrue(np.array_equal(engine.decode(data), self.image))
+        jpeg = engine.encode(self.image)
+        self.assertLessEqual(max_difference(engine.decode(jpeg), np.array(Image.open(BytesIO(jpeg)))[..., ::-1]), 1)
+
+    def test_unreadable_upload(self):
+        with self.assertRaises(FilterError):
+            engine.decode(b'not an image')
+
+
+class FilterCacheTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.data = jpeg_bytes(synthetic_image(64, 48))
+
+    def post(self, path='/filters/sepia/', data=None):
+        upload = ContentFile(data or self.data, name='car.jpg')
+        return self.client.post(path, {'image_file': upload})
+
+    def test_miss_then_hit(self):
+        first = self.post()
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(FilterCacheEntry.objects.count(), 1)
+        self.assertEqual(len(self.stored_files('filteredImages')), 1)
+
+        second = self.post()
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.json()['filtered_image']['id'], first.json()['filtered_image']['id'])
+        self.assertEqual(FilteredImage.objects.count(), 1)
+        self.assertEqual(EnteredImage.objects.count(), 1)
+        self.assertEqual(FilterCacheEntry.objects.get().hits, 1)
+        self.assertEqual(len(self.stored_files('filteredImages')), 1)
+
+    def test_different_filters_and_images_miss(self):
+        self.post()
+        self.post('/filters/emboss/')
+        self.post(data=jpeg_bytes(synthetic_image(48, 64)))
+        self.assertEqual(FilterCacheEntry.objects.count(), 3)
+        self.assertEqual(len(self.stored_files('filteredImages')), 3)
+
+    def test_missing_file_is_a_miss(self):
+        self.post()
+        filtered_image = FilteredImage.objects.get()
+        filtered_image.image_file.storage.delete(filtered_image.image_file.name)
+        self.assertIsNone(cache.get_cached_result(filtered_image.original_image.content_hash, 'sepia_filter'))
+        self.assertEqual(FilterCacheEntry.objects.count(), 0)
+
+    def test_eviction_removes_rows_and_files(self):
+        for path in ('/filters/sepia/', '/filters/emboss/', '/filters/sharpen/'):
+            self.post(path)
+        entries = list(FilterCacheEntry.objects.order_by('pk'))
+        # The first result is the least recently used.
+        long_ago = entries[0].last_used_at.replace(year=2000)
+        FilterCacheEntry.objects.filter(pk=entries[0].pk).update(last_used_at=long_ago)
+        keep = sum(entry.size for entry in entries[1:])
+
+        self.assertEqual(cache.evict_cached_results(max_age=None, max_bytes=keep), 1)
+        self.assertEqual(sorted(FilterCacheEntry.objects.values_list('pk', flat=True)),
+                         [entry.pk for entry in entries[1:]])
+        self.assertFalse(FilteredImage.objects.filter(pk=entries[0].filtered_image_id).exists())
+        self.assertEqual(sorted(self.stored_files('filteredImages')),
+                         sorted(os.path.basename(entry.filtered_image.image_file.name) for entry in entries[1:]))
+
+        self.assertEqual(cache.evict_cached_results(max_age=60, max_bytes=None), 0)
+        FilterCacheEntry.objects.update(last_used_at=long_ago)
+        self.assertEqual(cache.evict_cached_results(max_age=60, max_bytes=None), 2)
+        self.assertEqual(self.stored_files('filteredImages'), [])
+
+    def test_eviction_after_new_results_is_throttled(self):
+        with mock.patch.object(cache, 'evict_cached_results', return_value=0) as evict, \
+                mock.patch.object(cache, '_last_eviction', None):
+            for path in ('/filters/sepia/', '/filters/emboss/', '/filters/sharpen/'):
+                self.post(path)
+        self.assertEqual(evict.call_count, 1)
+
+    def racing_row(self, entered_image, params=''):
+        filtered_image = store_filtered_image(b'late', entered_image, 'sepia_filter', 'sepia')
+        return ResultRow(entered_image, filtered_image, params, 4)
+
+    def test_losing_a_race_discards_the_result(self):
+        winner_id = self.post().json()['filtered_image']['id']
+        entered_image = EnteredImage.objects.get()
+        row, other = self.racing_row(entered_image), self.racing_row(entered_image, params='{"k":3}')
+        self.assertEqual(len(self.stored_files('filteredImages')), 3)
+        with self.captureOnCommitCallbacks(execute=True):
+            cached, other_cached = insert_results([row, other])
+        self.assertEqual(cached.pk, winner_id)
+        self.assertEqual(cached.original_image, entered_image)
+        self.assertIs(other_cached, other.filtered_image)
+        self.assertFalse(FilteredImage.objects.filter(image_file=row.filtered_image.image_file.name).exists())
+        self.assertEqual(FilteredImage.objects.count(), 2)
+        self.assertEqual(len(self.stored_files('filteredImages')), 2)
+
+    def test_racing_rows_in_one_batch(self):
+        self.post()
+        entered_image = EnteredImage.objects.get()
+        FilterCacheEntry.objects.all().delete()
+        first, second = self.racing_row(entered_image), self.racing_row(entered_image)
+        with self.captureOnCommitCallbacks(execute=True):
+            cached = insert_results([first, second])
+        self.assertEqual(cached, [first.filtered_image, first.filtered_image])
+        self.assertEqual(FilterCacheEntry.objects.get().filtered_image, first.filtered_image)
+        self.assertEqual(sorted(self.stored_files('filteredImages')),
+                         sorted(os.path.basename(image.image_file.name) for image in FilteredImage.objects.all()))
+
+    def test_cache_result_returns_the_winner(self):
+        winner_id = self.post().json()['filtered_image']['id']
+        entered_image = EnteredImage.objects.get()
+        late = store_filtered_image(b'late', entered_image, 'sepia_filter', 'sepia')
+        late.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            cached = cache.cache_result(entered_image.content_hash, 'sepia_filter', late)
+        self.assertEqual(cached.pk, winner_id)
+        self.assertEqual(FilteredImage.objects.count(), 1)
+        self.assertEqual(len(self.stored_files('filteredImages')), 1)
+
+
+@override_settings(FILTER_DERIVATIVE_SIZES=(), FILTER_BATCH_WRITE_SIZE=2)
+class BatchFilterTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.images = [jpeg_bytes(synthetic_image(64, 48, seed=seed)) for seed in range(3)]
+
+    def post(self, files, **data):
+        return self.client.post('/filters/batch/', dict(data, image_files=[
+            ContentFile(content, name=f'image{index}.jpg') for index, content in enumerate(files)]))
+
+    def ndjson(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        return sorted((json.loads(line) for line in lines), key=lambda result: result['index'])
+
+    def test_ndjson_reports_every_image(self):
+        results = self.ndjson(self.post(self.images + [b'junk'], filter='sepia'))
+        self.assertEqual([result['index'] for result in results], [0, 1, 2, 3])
+        self.assertIn('error', results[3])
+        self.assertEqual({result['name'] for result in results[:3]}, {'image0.jpg', 'image1.jpg', 'image2.jpg'})
+        self.assertEqual(FilterCacheEntry.objects.count(), 3)
+        self.assertEqual(len(self.stored_files('filteredImages')), 3)
+        self.assertEqual({result['filtered_image']['filter_used'] for result in results[:3]}, {'sepia_filter'})
+
+    def test_zip_output(self):
+        response = self.post(self.images, pipeline='grayscale -> blur(k=5)', output='zip', format='png')
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        archive = zipfile.ZipFile(BytesIO(b''.join(response.streaming_content)))
+        names = archive.namelist()
+        self.assertEqual(names[-1], 'manifest.ndjson')
+        self.assertEqual(len(names), 4)
+        manifest = [json.loads(line) for line in archive.read('manifest.ndjson').decode().splitlines()]
+        for result in manifest:
+            stored = os.path.basename(result['filtered_image']['image_file'])
+            self.assertIn(stored, names)
+            self.assertEqual(Image.open(BytesIO(archive.read(stored))).format, 'PNG')
+
+    def test_repeated_images_share_one_result(self):
+        # Only the discarded file's deletion should run here, not background hashing.
+        with mock.patch('filters.batch.schedule_perceptual_hash'), self.captureOnCommitCallbacks(execute=True):
+            results = self.ndjson(self.post([self.images[0]] * 3, filter='emboss'))
+        self.assertEqual(len({result['filtered_image']['id'] for result in results}), 1)
+        self.assertEqual(FilteredImage.objects.count(), 1)
+        self.assertEqual(len(self.stored_files('filteredImages')), 1)
+        response = self.post([self.images[0]] * 2, filter='emboss', output='zip')
+        self.assertEqual(len(zipfile.ZipFile(BytesIO(b''.join(response.streaming_content))).namelist()), 2)
+
+    def archive(self, members):
+        buffer = BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as archive:
+            for name, content in members:
+                archive.writestr(name, content)
+        return ContentFile(buffer.getvalue(), name='images.zip')
+
+    def test_archive_input(self):
+        upload = self.archive([('a/one.jpg', self.images[0]), ('__MACOSX/a/._one.jpg', b'x'), ('b/', b'')])
+        results = self.ndjson(self.client.post('/filters/batch/', {'archive': upload, 'filter': 'sharpen'}))
+        self.assertEqual([result['name'] for result in results], ['one.jpg'])
+
+    def test_archive_limits(self):
+        cases = [
+            ({'FILTER_BATCH_MAX_FILE_BYTES': 1000}, [('big.jpg', b'0' * 1001)]),
+            ({'FILTER_BATCH_MAX_BYTES': 1500}, [('a.jpg', b'0' * 1000), ('b.jpg', b'0' * 1000)]),
+            ({'FILTER_BATCH_MAX_FILES': 1}, [('a.jpg', b'0'), ('b.jpg', b'0')]),
+        ]
+        for limits, members in cases:
+            with self.subTest(limits=limits), override_settings(**limits):
+                upload = self.archive(members)
+                response = self.client.post('/filters/batch/', {'archive': upload, 'filter': 'sepia'})
+                self.assertEqual(response.status_code, 400)
+        self.assertEqual(EnteredImage.objects.count(), 0)
+
+    def test_bad_requests(self):
+        for data in ({'filter': 'sepia'}, {'filter': 'nope', 'image_files': [ContentFile(b'x', name='a.jpg')]},
+                     {'filter': 'convolve', 'image_files': [ContentFile(b'x', name='a.jpg')]},
+                     {'filter': 'sepia', 'archive': ContentFile(b'not a zip', name='a.zip')}):
+            with self.subTest(data=sorted(data)):
+                self.assertEqual(self.client.post('/filters/batch/', data).status_code, 400)
+
+
+class FusionTests(SimpleTestCase):
+    BLUR = 'convolve(kernel=[[1,2,1],[2,4,2],[1,2,1]], normalize=true)'
+    STAGES = ['emboss', 'sharpen', 'sepia', 'black_and_white', 'brightness(amount=40)', 'contrast(factor=1.5)',
+              'gamma(gamma=2.2)', BLUR, 'convolve(kernel=[[0,1,0],[1,1,1],[0,1,0]], normalize=true)']
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.image = synthetic_image(320, 240)
+
+    def test_fused_pairs_match_running_stages_one_by_one(self):
+        for first, second in itertools.product(self.STAGES, repeat=2):
+            with self.subTest(pipeline=f'{first} -> {second}'):
+                stages = parse_pipeline(f'{first} -> {second}')
+                fused = run_pipeline(self.image.copy(), stages)
+                self.assertLessEqual(max_difference(fused, run_one_by_one(self.image.copy(), stages)), 1)
+
+    def test_normalized_convolutions_fuse(self):
+        stages = parse_pipeline(f'{self.BLUR} -> convolve(kernel=[[1,1,1,1,1]], normalize=true) -> {self.BLUR}')
+        [step] = fuse(stages)
+        self.assertEqual(step.shape, (5, 9))
+        expected = run_one_by_one(self.image.copy(), stages)
+        self.assertLessEqual(max_difference(run_pipeline(self.image.copy(), stages), expected), 1)
+        self.assertLessEqual(max_difference(run_tiled(self.image.copy(), stages, tile_rows=50), expected), 1)
+
+    def test_clipping_kernels_are_not_fused(self):
+        for text in ('emboss -> sharpen', 'sharpen -> sharpen', 'emboss -> emboss', f'emboss -> {self.BLUR}',
+                     f'{self.BLUR} -> sharpen', f'{self.BLUR} -> convolve(kernel=[[1]], delta=10)'):
+            with self.subTest(pipeline=text):
+                self.assertEqual(len(fuse(parse_pipeline(text))), 2)
+
+    def test_sepia_is_not_merged_into_a_following_matrix(self):
+        self.assertIsNone(sepia_op().then(sepia_op()))
+        self.assertIsNotNone(grayscale_op().then(sepia_op()))
+        image = self.image.copy()
+        merged = grayscale_op().then(sepia_op()).apply(image)
+        one_by_one = sepia_op().apply(grayscale_op().apply(image))
+        self.assertLessEqual(max_difference(merged, one_by_one), 1)
+
+    def test_lookup_tables_compose_exactly(self):
+        stages = parse_pipeline('brightness(amount=40) -> contrast(factor=1.5) -> gamma(gamma=2.2)')
+        [step] = fuse(stages)
+        self.assertIsInstance(step, PointOp)
+        self.assertEqual(max_difference(step.apply(self.image.copy()), run_one_by_one(self.image.copy(), stages)), 0)
+
+    def test_lone_point_filters_keep_their_own_implementation(self):
+        steps = fuse(parse_pipeline('black_and_white -> brightness(amount=10)'))
+        self.assertNotIsInstance(steps[0], PointOp)
+
+    def test_point_filters_reject_non_numeric_parameters(self):
+        for op, value in ((brightness_op, 'foo'), (contrast_op, [1]), (gamma_op, 'x'), (gamma_op, 0),
+                          (brightness_op, float('nan'))):
+            with self.subTest(op=op.__name__, value=value):
+                with self.assertRaises(FilterError):
+                    op(value)
+
+
+def jpeg_bytes(image, exif=None):
+    output = BytesIO()
+    Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB)).save(output, 'JPEG', quality=95, exif=exif or b'')
+    return output.getvalue()
+
+
+class ConvolutionParameterTests(SimpleTestCase):
+    KERNEL = np.round(np.random.default_rng(0).normal(size=(21, 21)), 3).tolist()
+
+    def test_pipelines_round_trip_through_serialize(self):
+        stages = parse_pipeline(f'convolve(kernel={json.dumps(self.KERNEL)}, normalize=true, delta=4) -> sepia')
+        self.assertEqual(stages[0].params['kernel'], self.KERNEL)
+        self.assertEqual([(stage.spec, stage.params) for stage in parse_pipeline(serialize(stages))],
+                         [(stage.spec, stage.params) for stage in stages])
+
+    def test_labels_key_kernels_by_digest(self):
+        label = describe(parse_pipeline(f'convolve(kernel={json.dumps(self.KERNEL)}) -> sepia'))
+        self.assertLessEqual(len(label), 255)
+        self.assertRegex(label, r'^convolve\(kernel=sha256:[0-9a-f]{16}\) -> sepia$')
+        other = [[value + 1 for value in row] for row in self.KERNEL]
+        self.assertNotEqual(describe(parse_pipeline(f'convolve(kernel={json.dumps(other)}) -> sepia')), label)
+
+    def test_delta_must_be_a_number(self):
+        image = synthetic_image(64, 48)
+        for delta in ('abc', [1], float('inf'), True):
+            with self.subTest(delta=delta):
+                with self.assertRaises(FilterError):
+                    engine.apply(image.copy(), 'convolve', kernel=[[1]], delta=delta)
+        self.assertEqual(engine.apply(image.copy(), 'convolve', kernel=[[1]], delta=-4.5).shape, image.shape)
+
+
+def line_grid(width, height, spacing=8):
+    grid = np.zeros((height, width, 3), dtype=np.uint8)
+    grid[::spacing] = 255
+    grid[:, ::spacing] = 255
+    return grid
+
+
+class PipelineParsingTests(SimpleTestCase):
+    def test_stages_and_parameters(self):
+        stages = parse_pipeline('grayscale -> blur(k=15, algorithm=box) | brightness(amount=-20.5)')
+        self.assertEqual([stage.spec.name for stage in stages], ['black_and_white', 'blur', 'brightness'])
+        self.assertEqual(stages[1].params, {'k': 15, 'algorithm': 'box'})
+        self.assertEqual(stages[2].params, {'amount': -20.5})
+
+    def test_invalid_pipelines(self):
+        for text in ('', ' -> ', 'nope', 'blur(k)', 'blur(size=3)', 'convolve(kernel=[1,2)',
+                     ' -> '.join(['sepia'] * (MAX_STAGES + 1))):
+            with self.subTest(text=text):
+                with self.assertRaises(FilterError):
+                    parse_pipeline(text)
+
+
+class BlurErrorTests(SimpleTestCase):
+    """The approximate blurs against a floating-point Gaussian of the same kernel size."""
+
+    def assert_within_bounds(self, image, max_mean_error):
+        for k in range(17, 302, 24):
+            reference = cv2.GaussianBlur(image.astype(np.float64), (k, k), 0)
+            for algorithm in ('box', 'downsample'):
+                with self.subTest(k=k, algorithm=algorithm):
+                    error = np.abs(gaussian_blur(image.copy(), k, algorithm=algorithm) - reference)
+                    self.assertLessEqual(error.max(), MAX_ERROR)
+                    self.assertLess(error.mean(), max_mean_error)
+
+    def test_synthetic_image(self):
+        # An odd size, so the downsampled blur has to pad to whole blocks.
+        self.assert_within_bounds(synthetic_image(641, 479), MAX_MEAN_ERROR)
+
+    def test_one_pixel_line_grid(self):
+        self.assert_within_bounds(line_grid(640, 480), 2 * MAX_MEAN_ERROR)
+
+
+class BlurParameterTests(TestCase):
+    def test_kernel_size_and_radius_are_checked(self):
+        image = synthetic_image(64, 48)
+        for params in ({'k': MAX_KERNEL_SIZE + 2}, {'k': 2000001, 'quality': 'exact'}, {'k': 14}, {'k': True},
+                       {'k': '15'}, {'radius': MAX_KERNEL_SIZE // 2 + 1}, {'radius': 'abc'}, {'radius': -1},
+                       {'radius': 2.5}):
+            with self.subTest(params=params):
+                with self.assertRaises(FilterError):
+                    engine.apply(image.copy(), 'blur', **params)
+        self.assertEqual(engine.apply(image.copy(), 'blur', radius=MAX_KERNEL_SIZE // 2).shape, image.shape)
+
+    def test_invalid_radius_is_a_bad_request(self):
+        for text in ('blur(radius=abc)', f'blur(k={MAX_KERNEL_SIZE + 2})'):
+            with self.subTest(pipeline=text):
+                response = self.client.post('/filters/pipeline/', {
+                    'pipeline': text, 'image_file': ContentFile(jpeg_bytes(synthetic_image(64, 48)), name='a.jpg')})
+                self.assertEqual(response.status_code, 400)
+
+
+class ProcessOnlyTests(MediaRootMixin, SimpleTestCase):
+    """Process-only requests store nothing; SimpleTestCase fails any database query."""
+
+    def setUp(self):
+        super().setUp()
+        self.image = synthetic_image(96, 64)
+        self.data = jpeg_bytes(self.image)
+
+    def post(self, path, **data):
+        return self.client.post(f'{path}?process_only=1', dict(data, image_file=ContentFile(self.data, 'car.jpg')))
+
+    def test_returns_the_encoded_result(self):
+        response = self.post('/filters/sharpen/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response['Content-Disposition'], 'inline; filename="car_sharpen.jpg"')
+        self.assertEqual(response.content, engine.encode(engine.apply(engine.decode(self.data), 'sharpen')))
+        self.assertEqual(os.listdir(self.media_root), [])
+
+    def test_pipelines_formats_and_previews(self):
+        response = self.post('/filters/pipeline/', pipeline='grayscale -> brightness(amount=10)', format='png',
+                             max_dimension=48)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertTrue(response['Content-Disposition'].endswith('_pipeline_48.png"'))
+        self.assertEqual(engine.decode(response.content).shape, (32, 48))
+
+    def test_unreadable_upload(self):
+        self.data = b'junk'
+        self.assertEqual(self.post('/filters/sepia/').status_code, 400)
+        self.assertEqual(self.post('/filters/pipeline/', pipeline='nope').status_code, 400)
+
+
+class DerivativeViewTests(MediaRootMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        for name in ('derivatives/enteredImages/car_0123_128.jpg', 'enteredImages/car.jpg'):
+            os.makedirs(os.path.dirname(os.path.join(self.media_root, name)), exist_ok=True)
+            with open(os.path.join(self.media_root, name), 'wb') as image_file:
+                image_file.write(b'jpeg')
+
+    def test_serves_derivatives(self):
+        response = self.client.get('/filters/derivatives/enteredImages/car_0123_128.jpg')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'jpeg')
+
+    def test_does_not_serve_files_outside_the_derivatives_directory(self):
+        for name in ('../enteredImages/car.jpg', 'enteredImages/../../enteredImages/car.jpg',
+                     '..%2FenteredImages/car.jpg', '..\\enteredImages\\car.jpg'):
+            with self.subTest(name=name):
+                self.assertEqual(self.client.get(f'/filters/derivatives/{name}').status_code, 404)
+
+
+class ImageListTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        start = timezone.now() - timedelta(hours=1)
+        cls.images = []
+        for index in range(7):
+            entered_image = EnteredImage.objects.create(content_hash=f'hash{index}')
+            # Two uploads share a timestamp; the id breaks the tie.
+            created_at = start + timedelta(seconds=min(index, 5))
+            EnteredImage.objects.filter(pk=entered_image.pk).update(created_at=created_at)
+            cls.images.append(entered_image)
+        for filter_used in ('sepia_filter', 'emboss_filter'):
+            FilteredImage.objects.create(original_image=cls.images[-1], filter_used=filter_used,
+                                         image_file=f'filteredImages/{filter_used}.jpg')
+
+    def get_all(self, url):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids += [image['id'] for image in response.json()['results']]
+            url = response.json()['next']
+        return ids
+
+    def test_pages_are_newest_first_and_stable(self):
+        expected = [image.pk for image in reversed(self.images)]
+        self.assertEqual(self.get_all('/filters/image-upload/?page_size=3'), expected)
+        first_page = self.client.get('/filters/image-upload/?page_size=3').json()
+        # Uploads after the first page do not shift later pages.
+        EnteredImage.objects.create()
+        url = first_page['next']
+        self.assertEqual(self.get_all(url), expected[3:])
+        self.assertEqual(len(self.client.get('/filters/image-upload/?page_size=1000').json()['results']), 8)
+
+    def test_fields(self):
+        response = self.client.get('/filters/image-upload/?fields=id,content_hash')
+        self.assertEqual(response.json()['results'][0], {'id': self.images[-1].pk, 'content_hash': 'hash6'})
+        self.assertEqual(self.client.get('/filters/image-upload/?fields=id,secret').status_code, 400)
+
+    def test_embed(self):
+        results = self.client.get('/filters/image-upload/?embed=filtered_images&fields=id,filtered_images').json()
+        self.assertEqual([image['filter_used'] for image in results['results'][0]['filtered_images']],
+                         ['sepia_filter', 'emboss_filter'])
+        self.assertEqual(results['results'][1]['filtered_images'], [])
+        self.assertNotIn('filtered_images', self.client.get('/filters/image-upload/').json()['results'][0])
+        self.assertEqual(self.client.get('/filters/image-upload/?embed=jobs').status_code, 400)
+
+    def test_query_count_does_not_grow_with_the_page(self):
+        with self.assertNumQueries(2):
+            self.client.get('/filters/image-upload/?embed=filtered_images')
+
+
+class MetricsTests(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        for name in ('_histograms', '_counters'):
+            patcher = mock.patch.object(metrics, name, {})
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def post(self, path='/filters/sepia/?process_only=1', data=None):
+        upload = ContentFile(data or jpeg_bytes(synthetic_image(64, 48)), name='car.jpg')
+        return self.client.post(path, {'image_file': upload})
+
+    def test_timings(self):
+        timings = metrics.Timings()
+        with mock.patch('time.perf_counter', side_effect=[0, 0.002, 1, 1.0005, 2, 2.004]):
+            for name in ('decode', 'filter', 'decode'):
+                with timings.stage(name):
+                    pass
+        self.assertEqual(timings.server_timing(0.01), 'decode;dur=6.0, filter;dur=0.5, total;dur=10.0')
+        # Outside a timed request stages cost nothing.
+        with metrics.stage('decode'):
+            pass
+
+    def test_render(self):
+        timings = metrics.Timings()
+        timings.stages = {'filter': 0.003}
+        metrics.observe('a"b', 200, timings, 0.3)
+        metrics.observe('a"b', 400, timings, 60)
+        text = metrics.render()
+        self.assertIn('filter_stage_duration_seconds_bucket{filter="a\\"b",stage="filter",le="0.0025"} 0', text)
+        self.assertIn('filter_stage_duration_seconds_bucket{filter="a\\"b",stage="filter",le="0.005"} 2', text)
+        self.assertIn('filter_request_duration_seconds_bucket{filter="a\\"b",le="0.5"} 1', text)
+        self.assertIn('filter_request_duration_seconds_bucket{filter="a\\"b",le="30.0"} 1', text)
+        self.assertIn('filter_request_duration_seconds_bucket{filter="a\\"b",le="+Inf"} 2', text)
+        self.assertIn('filter_request_duration_seconds_sum{filter="a\\"b"} 60.3', text)
+        self.assertIn('filter_requests_total{filter="a\\"b",status="400"} 1', text)
+        self.assertIn('# TYPE filter_requests_total counter', text)
+
+    def test_requests_are_timed(self):
+        response = self.post()
+        stages = [item.split(';')[0] for item in response['Server-Timing'].split(', ')]
+        self.assertEqual(stages, ['admission', 'decode', 'filter', 'encode', 'total'])
+        self.assertEqual(self.post(data=b'junk').status_code, 400)
+
+        response = self.client.get('/filters/metrics/')
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        text = response.content.decode()
+        self.assertIn('filter_requests_total{filter="sepia",status="200"} 1', text)
+        self.assertIn('filter_requests_total{filter="sepia",status="400"} 1', text)
+        self.assertIn('filter_stage_duration_seconds_count{filter="sepia",stage="encode"} 1', text)
+
+    @override_settings(FILTER_METRICS_ENABLED=False)
+    def test_disabled(self):
+        self.assertNotIn('Server-Timing', self.post())
+        self.assertEqual(self.client.get('/filters/metrics/').status_code, 404)
+        self.assertEqual(metrics._counters, {})
+
+
+class NegotiateTests(SimpleTestCase):
+    def test_accept_headers(self):
+        cases = [
+            (None, 'jpeg'),
+            ('*/*', 'jpeg'),
+            ('application/json', 'jpeg'),
+            ('image/webp', 'webp'),
+            ('image/png;q=0.5, image/webp;q=0.9', 'webp'),
+            ('image/webp, image/png', 'webp'),
+            ('image/webp, image/jpeg', 'jpeg'),
+            ('image/webp;q=0.5, image/jpeg;q=0.5', 'jpeg'),
+            ('image/png;q=nonsense', 'jpeg'),
+            ('IMAGE/PNG', 'png'),
+        ]
+        for accept, expected in cases:
+            with self.subTest(accept=accept):
+                self.assertEqual(negotiate(accept), expected)
+        self.assertEqual(negotiate('*/*', default='png'), 'png')
+
+
+class EncodeTests(MediaRootMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.image = synthetic_image(96, 64)
+
+    def test_formats_and_options(self):
+        for options, expected in (({'format': 'png'}, 'PNG'), ({'format': 'webp'}, 'WEBP'),
+                                  ({'quality': 50}, 'JPEG'), ({'progressive': True}, 'JPEG')):
+            with self.subTest(options=options):
+                decoded = Image.open(BytesIO(engine.encode(self.image, **options)))
+                self.assertEqual((decoded.format, decoded.size), (expected, (96, 64)))
+        self.assertIn('progression', Image.open(BytesIO(engine.encode(self.image, progressive=True))).info)
+        self.assertTrue(np.array_equal(engine.decode(engine.encode(self.image, format='png')), self.image))
+        self.assertLess(len(engine.encode(self.image, quality=20)), len(engine.encode(self.image, quality=95)))
+        for options in ({'format': 'gif'}, {'quality': 0}, {'quality': 101}):
+            with self.subTest(options=options):
+                with self.assertRaises(FilterError):
+                    engine.encode(self.image, **options)
+
+    def post(self, headers=None, **data):
+        upload = ContentFile(jpeg_bytes(self.image), name='car.jpg')
+        return self.client.post('/filters/sepia/?process_only=1', dict(data, image_file=upload), headers=headers)
+
+    def test_requests_pick_the_format(self):
+        self.assertEqual(self.post({'Accept': 'image/webp'})['Content-Type'], 'image/webp')
+        self.assertEqual(self.post({'Accept': 'image/webp'}, format='png')['Content-Type'], 'image/png')
+        self.assertEqual(self.post({'Accept': 'application/json'})['Content-Type'], 'image/jpeg')
+        for data in ({'format': 'gif'}, {'output_quality': 'high'}, {'output_quality': 0}):
+            with self.subTest(data=data):
+                self.assertEqual(self.post(**data).status_code, 400)
+
+
+class DecodePreviewTests(SimpleTestCase):
+    def test_ignores_exif_orientation_like_a_full_decode(self):
+        # Bright left half; Orientation 6 would rotate it to the top.
+        image = np.zeros((400, 800, 3), dtype=np.uint8)
+        image[:, :400] = 255
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        data = jpeg_bytes(image, exif.tobytes())
+        preview, scale = engine.decode_preview(data, 200)
+        self.assertEqual(preview.shape, (100, 200, 3))
+        self.assertEqual(scale, 0.25)
+        expected = cv2.resize(engine.decode(data), (200, 100), interpolation=cv2.INTER_AREA)
+        self.assertLessEqual(max_difference(preview, expected), 8)
+
+    def test_reduced_decode_matches_a_full_decode(self):
+        data = jpeg_bytes(synthetic_image(1600, 1200))
+        preview, scale = engine.decode_preview(data, 400)
+        expected = cv2.resize(engine.decode(data), (400, 300), interpolation=cv2.INTER_AREA)
+        self.assertEqual(preview.shape, expected.shape)
+        self.assertLess(np.abs(preview.astype(np.int16) - expected).mean(), 2)
+
+    def test_other_formats_and_small_images(self):
+        image = synthetic_image(1000, 500)
+        preview, scale = engine.decode_preview(engine.encode(image, format='png'), 300)
+        self.assertEqual((preview.shape, scale), ((150, 300, 3), 0.3))
+        expected = cv2.resize(image, (300, 150), interpolation=cv2.INTER_AREA)
+        self.assertLess(np.abs(preview.astype(np.int16) - expected).mean(), 2)
+        self.assertEqual(engine.decode_preview(jpeg_bytes(image), 1000)[1], 1)
+        with self.assertRaises(FilterError):
+            engine.decode_preview(b'junk', 100)
+
+    def test_kernel_sizes_scale_with_the_preview(self):
+        [blur] = scale_stages(parse_pipeline('blur(k=35)'), 0.25)
+        self.assertEqual(blur.params, {'k': 9})
+        self.assertEqual(scale_stages(parse_pipeline('blur'), 0.5)[0].params, {'k': 19})
+        self.assertEqual(scale_stages(parse_pipeline('blur(k=3)'), 0.01)[0].params, {'k': 1})
+
+
+class TilingTests(SimpleTestCase):
+    EXACT = [
+        'sketch', 'emboss -> sharpen', 'black_and_white -> sketch', 'emboss -> blur(k=9) -> sketch',
+        'sepia -> brightness(amount=20) -> gamma(gamma=2)', 'blur(k=15)', 'blur(k=61)', 'blur(k=151, algorithm=box)',
+        'convolve(kernel=[[0,-1,0],[-1,5,-1],[0,-1,0]])',
+    ]
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Not a multiple of the strip height, so the last strip is short.
+        cls.image = synthetic_image(320, 250)
+
+    def tiled_and_whole(self, text):
+        tiled = run_tiled(self.image.copy(), parse_pipeline(text), tile_rows=64)
+        return tiled, run_pipeline(self.image.copy(), parse_pipeline(text), tiled=False)
+
+    def test_tiled_matches_whole_image(self):
+        for text in self.EXACT:
+            with self.subTest(pipeline=text):
+                tiled, whole = self.tiled_and_whole(text)
+                self.assertEqual(max_difference(tiled, whole), 0)
+
+    def test_fft_convolution_differs_by_rounding_only(self):
+        kernel = np.round(np.random.default_rng(0).normal(size=(25, 25)), 2).tolist()
+        tiled, whole = self.tiled_and_whole(f'convolve(kernel={json.dumps(kernel)}, normalize=true)')
+        self.assertLessEqual(max_difference(tiled, whole), 1)
+
+    def test_downsampled_blur_is_not_tiled(self):
+        self.assertIsNone(run_tiled(self.image.copy(), parse_pipeline('blur(k=151, algorithm=downsample)')))
+
+
+def video_bytes(frames=5, width=96, height=64, fps=10):
+    with tempfile.NamedTemporaryFile(suffix='.mp4') as clip:
+        writer = cv2.VideoWriter(clip.name, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+        for index in range(frames):
+            writer.write(synthetic_image(width, height, seed=index))
+        writer.release()
+        return clip.read()
+
+
+def read_video(data):
+    with tempfile.NamedTemporaryFile(suffix='.mp4') as clip:
+        clip.write(data)
+        clip.flush()
+        capture = cv2.VideoCapture(clip.name)
+        frames = []
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            frames.append(frame)
+        capture.release()
+    return frames
+
+
+class VideoFilterTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.clip = video_bytes()
+
+    def post(self, data=None, **extra):
+        return self.client.post('/filters/video/', dict(data or {}, video_file=ContentFile(self.clip, name='clip.mp4')),
+                                **extra)
+
+    def filtered_frames(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'video/mp4')
+        return read_video(b''.join(response.streaming_content))
+
+    def test_filters_every_frame(self):
+        response = self.post({'filter': 'sepia'})
+        self.assertEqual(response['X-Video-Frames'], '5')
+        self.assertIn('clip_sepia.mp4', response['Content-Disposition'])
+        frames = self.filtered_frames(response)
+        self.assertEqual(len(frames), 5)
+        self.assertEqual(frames[0].shape, (64, 96, 3))
+
+    def test_pipeline_and_stride(self):
+        response = self.post({'pipeline': 'black_and_white -> blur(k=5)', 'stride': 2})
+        self.assertEqual(response['X-Video-Frames'], '3')
+        self.assertEqual(len(self.filtered_frames(response)), 3)
+
+    def test_preview_is_shrunk(self):
+        response = self.post({'filter': 'sepia', 'preview': 1, 'max_dimension': 48})
+        frames = self.filtered_frames(response)
+        self.assertEqual(len(frames), 5)
+        self.assertEqual(frames[0].shape, (32, 48, 3))
+
+    def test_accepts_video_accept_headers(self):
+        for accept in ('video/mp4', 'video/*', 'image/webp'):
+            with self.subTest(accept=accept):
+                self.filtered_frames(self.post({'filter': 'sepia'}, HTTP_ACCEPT=accept))
+
+    def test_bad_requests(self):
+        for data in ({'filter': 'nope'}, {'filter': 'convolve'}, {'filter': 'sepia', 'stride': 0},
+                     {'pipeline': 'blur(radius=abc)'}):
+            with self.subTest(data=data):
+                self.assertEqual(self.post(data).status_code, 400)
+        self.assertEqual(self.client.post('/filters/video/', {'filter': 'sepia'}).status_code, 400)
+        junk = ContentFile(b'junk', name='a.mp4')
+        self.assertEqual(self.client.post('/filters/video/', {'filter': 'sepia', 'video_file': junk}).status_code, 400)
+
+
+@override_settings(FILTER_JOBS_INLINE_WORKER=False, FILTER_DERIVATIVE_SIZES=())
+class FilterJobTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.entered_image = EnteredImage(content_hash='a' * 64)
+        self.entered_image.image_file.save('car.jpg', ContentFile(jpeg_bytes(synthetic_image(64, 48))))
+
+    def enqueue(self, text, priority=0):
+        return jobs.enqueue_job(self.entered_image, parse_pipeline(text), describe(parse_pipeline(text)), 'pipeline',
+                                priority=priority)
+
+    def test_enqueue(self):
+        job = self.enqueue('convolve(kernel=[[0,1,0],[1,1,1],[0,1,0]], normalize=true) -> sepia', priority=3)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.priority), (FilterJob.QUEUED, 3))
+        self.assertEqual(serialize(parse_pipeline(job.pipeline)), job.pipeline)
+        self.assertIn('sha256:', job.filter_used)
+
+    def test_claims_highest_priority_then_oldest(self):
+        low, first, second, high = (self.enqueue('sepia'), self.enqueue('emboss', 1), self.enqueue('sharpen', 1),
+                                    self.enqueue('blur', 5))
+        claimed = [jobs.claim_next_job() for _ in range(5)]
+        self.assertEqual([job.pk if job else None for job in claimed], [high.pk, first.pk, second.pk, low.pk, None])
+        self.assertEqual(set(FilterJob.objects.values_list('status', flat=True)), {FilterJob.RUNNING})
+
+    def test_requeues_only_stale_running_jobs(self):
+        stale, fresh = self.enqueue('sepia'), self.enqueue('emboss')
+        FilterJob.objects.filter(pk=stale.pk).update(status=FilterJob.RUNNING,
+                                                     started_at=timezone.now() - timedelta(hours=1))
+        FilterJob.objects.filter(pk=fresh.pk).update(status=FilterJob.RUNNING, started_at=timezone.now())
+        self.assertEqual(jobs.requeue_stale_jobs(stale_after=600), 1)
+        self.assertEqual(FilterJob.objects.get(pk=stale.pk).status, FilterJob.QUEUED)
+        self.assertEqual(FilterJob.objects.get(pk=fresh.pk).status, FilterJob.RUNNING)
+
+    def test_run_job_and_status_endpoint(self):
+        job = self.enqueue('sepia -> blur(k=5)')
+        response = self.client.get(f'/filters/jobs/{job.pk}/')
+        self.assertEqual((response.status_code, response.json()['status']), (200, FilterJob.QUEUED))
+
+        with ThreadPoolExecutor(1) as pool, mock.patch.object(jobs, 'get_process_pool', return_value=pool):
+            jobs.run_job(jobs.claim_next_job())
+        response = self.client.get(f'/filters/jobs/{job.pk}/')
+        self.assertEqual(response.json()['status'], FilterJob.DONE)
+        self.assertEqual(response.json()['filtered_image']['original_image'], self.entered_image.pk)
+        self.assertEqual(len(self.stored_files('filteredImages')), 1)
+        self.assertEqual(FilterCacheEntry.objects.get().filter_used, job.filter_used)
+
+    def test_failed_job(self):
+        job = self.enqueue('sepia')
+        FilterJob.objects.filter(pk=job.pk).update(pipeline='nope')
+        with ThreadPoolExecutor(1) as pool, mock.patch.object(jobs, 'get_process_pool', return_value=pool), \
+                self.assertLogs('filters.jobs', 'ERROR'):
+            jobs.run_job(jobs.claim_next_job())
+        job.refresh_from_db()
+        self.assertEqual(job.status, FilterJob.FAILED)
+        self.assertIn('Unknown filter', job.error)
+        self.assertEqual(self.client.get('/filters/jobs/999999/').status_code, 404)
+
+
+@override_settings(FILTER_JOBS_INLINE_WORKER=False, FILTER_DERIVATIVE_SIZES=())
+class JobDispatcherTests(MediaRootMixin, TransactionTestCase):
+    def test_runs_jobs_left_from_before_a_restart(self):
+        entered_image = EnteredImage()
+        entered_image.image_file.save('car.jpg', ContentFile(jpeg_bytes(synthetic_image(64, 48))))
+        queued = FilterJob.objects.create(entered_image=entered_image, pipeline='sepia', filter_used='sepia_filter',
+                                          suffix='sepia')
+        stale = FilterJob.objects.create(entered_image=entered_image, pipeline='emboss', filter_used='emboss_filter',
+                                         suffix='emboss', status=FilterJob.RUNNING,
+                                         started_at=timezone.now() - timedelta(hours=1))
+
+        dispatcher = jobs.JobDispatcher(1, poll_interval=0.05)
+        with ThreadPoolExecutor(1) as pool, mock.patch.object(jobs, 'get_process_pool', return_value=pool):
+            dispatcher.start()
+            deadline = time.monotonic() + 20
+            while (FilterJob.objects.filter(status=FilterJob.DONE).count() < 2
+                   and time.monotonic() < deadline):
+                time.sleep(0.05)
+            dispatcher.stop(wait=True)
+            dispatcher.thread.join()
+        self.assertEqual(FilterJob.objects.get(pk=queued.pk).status, FilterJob.DONE)
+        self.assertEqual(FilterJob.objects.get(pk=stale.pk).status, FilterJob.DONE)
+
+    def test_server_startup_starts_the_dispatcher(self):
+        with mock.patch.object(jobs, 'get_dispatcher') as get_dispatcher:
+            jobs.start_inline_worker()
+            get_dispatcher.assert_not_called()
+            with override_settings(FILTER_JOBS_INLINE_WORKER=True):
+                jobs.start_inline_worker()
+            get_dispatcher.return_value.start.assert_called_once_with()
+
+
+class BKTreeTests(SimpleTestCase):
+    def test_search_matches_brute_force(self):
+        rng = np.random.default_rng(0)
+        values = [int(value) for value in rng.integers(0, 2 ** 63, 300, dtype=np.int64)]
+        # Near neighbours of a few values, and an exact duplicate.
+        values += [values[0] ^ 1, values[0] ^ 0b1011, values[1] ^ (1 << 40), values[2]]
+        tree = similarity.BKTree()
+        for key, value in enumerate(values):
+            tree.add(value, key)
+        for query in values[:5] + [0]:
+            for max_distance in (0, 3, 10, 30):
+                with self.subTest(query=query, max_distance=max_distance):
+                    expected = sorted(((query ^ value).bit_count(), key) for key, value in enumerate(values)
+                                      if (query ^ value).bit_count() <= max_distance)
+                    self.assertEqual(tree.search(query, max_distance), expected)
+
+    def test_empty_tree(self):
+        self.assertEqual(similarity.BKTree().search(0, 64), [])
+
+    def test_hash_survives_reencoding_and_resizing(self):
+        image = synthetic_image(640, 480)
+        value = similarity.perceptual_hash(jpeg_bytes(image))
+        smaller = cv2.resize(image, (320, 240), interpolation=cv2.INTER_AREA)
+        self.assertLessEqual(similarity.distance(value, similarity.perceptual_hash(jpeg_bytes(smaller))), 4)
+        other = similarity.perceptual_hash(jpeg_bytes(synthetic_image(640, 480, seed=7)))
+        self.assertGreater(similarity.distance(value, other), 10)
+        self.assertEqual(similarity.perceptual_hash(b'junk'), '')
+
+
+class ImageIndexTests(TestCase):
+    def test_picks_up_new_rows_and_later_hashes(self):
+        index = similarity.ImageIndex(recheck_interval=0)
+        first = EnteredImage.objects.create(perceptual_hash='0' * 16)
+        self.assertEqual(index.search('0' * 16, 0), [(0, first.pk)])
+
+        unhashed = EnteredImage.objects.create()
+        deleted = EnteredImage.objects.create()
+        self.assertEqual(index.search('f' * 16, 0), [])
+        self.assertEqual(index.unhashed, {unhashed.pk, deleted.pk})
+
+        # Backfilled later, e.g. by index_perceptual_hashes.
+        EnteredImage.objects.filter(pk=unhashed.pk).update(perceptual_hash='f' * 16)
+        deleted.delete()
+        self.assertEqual(index.search('f' * 16, 1), [(0, unhashed.pk)])
+        self.assertEqual(index.unhashed, set())
+
+    def test_rechecks_are_throttled(self):
+        index = similarity.ImageIndex(recheck_interval=60)
+        unhashed = EnteredImage.objects.create()
+        index.refresh()
+        index.refresh()
+        EnteredImage.objects.filter(pk=unhashed.pk).update(perceptual_hash='f' * 16)
+        self.assertEqual(index.search('f' * 16, 0), [])
+        index.next_recheck = 0
+        self.assertEqual(index.search('f' * 16, 0), [(0, unhashed.pk)])
+
+
+@override_settings(FILTER_DERIVATIVE_SIZES=())
+class SimilarImagesViewTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        # Each test gets an index over its own rows.
+        index_patch = mock.patch.object(similarity, '_index', similarity.ImageIndex(recheck_interval=0))
+        index_patch.start()
+        self.addCleanup(index_patch.stop)
+        self.image = synthetic_image(320, 240)
+        self.stored = []
+        for image in (self.image, cv2.resize(self.image, (160, 120)), synthetic_image(320, 240, seed=7)):
+            data = jpeg_bytes(image)
+            entered_image = EnteredImage(perceptual_hash=similarity.perceptual_hash(data))
+            entered_image.image_file.save('image.jpg', ContentFile(data))
+            self.stored.append(entered_image)
+
+    def result_ids(self, response):
+        self.assertEqual(response.status_code, 200)
+        return [result['entered_image']['id'] for result in response.json()['results']]
+
+    def test_similar_to_a_stored_image(self):
+        original, resized, other = self.stored
+        response = self.client.get(f'/filters/images/{original.uuid}/similar/')
+        self.assertEqual(self.result_ids(response), [resized.pk])
+        self.assertEqual(response.json()['perceptual_hash'], original.perceptual_hash)
+        response = self.client.get(f'/filters/images/{original.uuid}/similar/', {'distance': 64})
+        self.assertEqual(self.result_ids(response), [resized.pk, other.pk])
+
+    def test_hashes_stored_images_without_one(self):
+        original, resized, _ = self.stored
+        EnteredImage.objects.filter(pk=resized.pk).update(perceptual_hash='')
+        self.assertEqual(self.result_ids(self.client.get(f'/filters/images/{resized.uuid}/similar/')), [original.pk])
+        self.assertNotEqual(EnteredImage.objects.get(pk=resized.pk).perceptual_hash, '')
+        # Now indexed as well.
+        self.assertIn(resized.pk, self.result_ids(self.client.get(f'/filters/images/{original.uuid}/similar/')))
+
+    def test_similar_to_an_upload(self):
+        upload = ContentFile(jpeg_bytes(self.image), name='query.jpg')
+        response = self.client.post('/filters/similar/', {'image_file': upload, 'limit': 1})
+        self.assertEqual(self.result_ids(response), [self.stored[0].pk])
+
+    def test_bad_requests(self):
+        self.assertEqual(self.client.post('/filters/similar/', {}).status_code, 400)
+        self.assertEqual(self.client.post('/filters/similar/', {'image_file': ContentFile(b'junk', name='a.jpg')})
+                         .status_code, 400)
+        for params in ({'distance': 65}, {'distance': 'x'}, {'limit': 0}):
+            with self.subTest(params=params):
+                response = self.client.get(f'/filters/images/{self.stored[0].uuid}/similar/', params)
+                self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get('/filters/images/00000000-0000-0000-0000-000000000000/similar/')
+                         .status_code, 404)
+
+
+@override_settings(FILTER_DERIVATIVE_SIZES=(), FILTER_WRITE_BEHIND=False)
+class PerceptualHashCostTests(MediaRootMixin, TestCase):
+    def post(self, path):
+        return self.client.post(path, {'image_file': ContentFile(jpeg_bytes(synthetic_image(64, 48)), name='a.jpg')})
+
+    def test_requests_only_hash_for_near_duplicate_lookups(self):
+        with mock.patch('filters.ingest.perceptual_hash', return_value='0' * 16) as perceptual_hash:
+            with override_settings(FILTER_NEAR_DUPLICATE_DISTANCE=None):
+                self.assertEqual(self.post('/filters/sepia/').status_code, 200)
+                self.assertEqual(self.post('/filters/image-upload/').status_code, 201)
+            perceptual_hash.assert_not_called()
+            with override_settings(FILTER_NEAR_DUPLICATE_DISTANCE=4):
+                self.assertEqual(self.post('/filters/emboss/').status_code, 200)
+            perceptual_hash.assert_called_once()
+        # The lookup's hash is stored with the row instead of being computed again.
+        self.assertEqual(EnteredImage.objects.exclude(perceptual_hash='').count(), 1)
+
+
+@override_settings(FILTER_DERIVATIVE_SIZES=(), FILTER_WRITE_BEHIND=False, FILTER_NEAR_DUPLICATE_DISTANCE=None)
+class BackgroundHashTests(MediaRootMixin, TransactionTestCase):
+    def test_stored_uploads_are_hashed_in_the_background(self):
+        data = jpeg_bytes(synthetic_image(64, 48))
+        response = self.client.post('/filters/sepia/', {'image_file': ContentFile(data, name='a.jpg')})
+        self.assertEqual(response.status_code, 200)
+        deadline = time.monotonic() + 10
+        while (not EnteredImage.objects.exclude(perceptual_hash='').exists()
+               and time.monotonic() < deadline):
+            time.sleep(0.02)
+        self.assertEqual(EnteredImage.objects.get().perceptual_hash, similarity.perceptual_hash(data))
+
+
+@override_settings(FILTER_WRITE_BEHIND=True, FILTER_DERIVATIVE_SIZES=(), FILTER_NEAR_DUPLICATE_DISTANCE=None)
+class WriteBehindTests(MediaRootMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.use_own_derivative_pool()
+        self.writer = writer.WriteBehindWriter(batch_size=4, interval=0.05)
+        writer_patch = mock.patch.object(writer, '_writer', self.writer)
+        writer_patch.start()
+        self.addCleanup(writer_patch.stop)
+        self.addCleanup(self.writer.flush, 10)
+        self.data = jpeg_bytes(synthetic_image(64, 48))
+
+    def post(self, path='/filters/sepia/'):
+        return self.client.post(path, {'image_file': ContentFile(self.data, name='car.jpg')})
+
+    def hold_writes(self):
+        """Block the writer until the returned event is set."""
+        released = threading.Event()
+        insert = writer.insert_results
+
+        def held_insert(rows):
+            released.wait(10)
+            return insert(rows)
+        insert_patch = mock.patch.object(writer, 'insert_results', side_effect=held_insert)
+        insert_patch.start()
+        self.addCleanup(insert_patch.stop)
+        self.addCleanup(released.set)
+        return released
+
+    def test_pending_results_are_served_until_written(self):
+        released = self.hold_writes()
+        response = self.post()
+        self.assertEqual(response.status_code, 200)
+        filtered = response.json()['filtered_image']
+        self.assertIsNone(filtered['id'])
+        self.assertEqual(response['Location'], f'/filters/images/{filtered["uuid"]}/')
+        self.assertEqual(FilteredImage.objects.count(), 0)
+
+        record = self.client.get(f'/filters/images/{filtered["uuid"]}/').json()
+        self.assertTrue(record['pending'])
+        self.assertEqual(record['filtered_image']['uuid'], filtered['uuid'])
+        entered_uuid = response.json()['entered_image']['uuid']
+        self.assertEqual(b''.join(self.client.get(f'/filters/images/{entered_uuid}/file/')), self.data)
+        pending_bytes = self.client.get(f'/filters/images/{filtered["uuid"]}/file/').content
+        # A repeated request reads its own write.
+        self.assertEqual(self.post().json()['filtered_image']['uuid'], filtered['uuid'])
+
+        released.set()
+        self.writer.flush(10)
+        record = self.client.get(f'/filters/images/{filtered["uuid"]}/').json()
+        self.assertFalse(record['pending'])
+        self.assertIsNotNone(record['filtered_image']['id'])
+        self.assertEqual(FilterCacheEntry.objects.get().filtered_image.uuid.hex, filtered['uuid'].replace('-', ''))
+        self.assertEqual(b''.join(self.client.get(f'/filters/images/{filtered["uuid"]}/file/')), pending_bytes)
+        self.assertEqual(self.client.get('/filters/images/00000000-0000-0000-0000-000000000000/').status_code, 404)
+
+    def test_full_queue_writes_synchronously(self):
+        self.writer.max_pending = 0
+        response = self.post()
+        self.assertIsNotNone(response.json()['filtered_image']['id'])
+        self.assertEqual(FilteredImage.objects.count(), 1)
+
+    def test_write_errors_are_logged(self):
+        for error in (DatabaseError('locked'), RuntimeError('closed')):
+            with self.subTest(error=error):
+                item = self.pending_write()
+                with mock.patch.object(writer, 'insert_results', side_effect=error), \
+                        self.assertLogs('filters.writer', 'ERROR'):
+                    self.writer.write([item])
+                self.assertEqual(self.writer.by_uuid, {})
+
+    def test_pool_shut_down_at_exit_still_writes_rows(self):
+        with mock.patch.object(writer, 'schedule_derivatives', side_effect=RuntimeError('shut down')), \
+                self.assertLogs('filters.writer', 'WARNING'):
+            self.writer.write([self.pending_write()])
+        self.assertEqual(FilteredImage.objects.count(), 1)
+        self.assertEqual(len(self.stored_files('filteredImages')), 1)
+
+    def pending_write(self):
+        entered_image = EnteredImage(content_hash='hash')
+        entered_image.image_file.name = 'enteredImages/car.jpg'
+        filtered_image = FilteredImage(original_image=entered_image, filter_used='sepia_filter')
+        filtered_image.image_file.name = 'filteredImages/car_sepia.jpg'
+        item = writer.PendingWrite(entered_image, self.data, filtered_image, b'x', ('hash', 'sepia_filter', ''))
+        self.writer.by_uuid[entered_image.uuid] = self.writer.by_uuid[filtered_image.uuid] = item
+        return item
+
+
+@override_settings(FILTER_DERIVATIVE_SIZES=(), FILTER_WRITE_BEHIND=False, FILTER_NEAR_DUPLICATE_DISTANCE=None)
+class AsyncFilterViewTests(MediaRootMixin, TestCase):
+    KERNEL = [[1, 2, 1], [2, 4, 2], [1, 2, 1]]
+
+    def setUp(self):
+        super().setUp()
+        self.data = jpeg_bytes(synthetic_image(96, 64))
+
+    async def post(self, path, **data):
+        return await self.async_client.post(path, dict(data, image_file=ContentFile(self.data, name='car.jpg')))
+
+    async def test_miss_then_hit(self):
+        first = await self.post('/filters/async/sepia/')
+        self.assertEqual(first.status_code, 200)
+        self.assertIn('process', first['Server-Timing'])
+        filtered = first.json()['filtered_image']
+        self.assertEqual(filtered['filter_used'], 'sepia_filter')
+        second = await self.post('/filters/async/sepia/')
+        self.assertEqual(second.json()['filtered_image']['id'], filtered['id'])
+        self.assertEqual(await FilteredImage.objects.acount(), 1)
+        stored = await FilteredImage.objects.aget()
+        expected = engine.encode(engine.apply(engine.decode(self.data), 'sepia'))
+        with stored.image_file.open('rb') as image_file:
+            self.assertEqual(image_file.read(), expected)
+
+    async def test_results_are_shared_with_the_sync_views(self):
+        kernel = json.dumps(self.KERNEL)
+        sync = await sync_to_async(self.client.post)('/filters/convolve/', {
+            'image_file': ContentFile(self.data, name='car.jpg'), 'kernel': kernel, 'normalize': 'true'})
+        response = await self.post('/filters/async/convolve/', kernel=kernel, normalize='true')
+        self.assertEqual(response.json()['filtered_image']['id'], sync.json()['filtered_image']['id'])
+        pipeline_text = 'grayscale -> brightness(amount=10)'
+        sync = await sync_to_async(self.client.post)('/filters/pipeline/', {
+            'image_file': ContentFile(self.data, name='car.jpg'), 'pipeline': pipeline_text})
+        response = await self.post('/filters/async/pipeline/', pipeline=pipeline_text)
+        self.assertEqual(response.json()['filtered_image']['id'], sync.json()['filtered_image']['id'])
+
+    async def test_process_only(self):
+        response = await self.post('/filters/async/pipeline/?process_only=1', pipeline='emboss -> sepia',
+                                   format='png')
+        self.assertEqual(response['Content-Type'], 'image/png')
+        expected = run_one_by_one(engine.decode(self.data), parse_pipeline('emboss -> sepia'))
+        self.assertTrue(np.array_equal(engine.decode(response.content), expected))
+        self.assertEqual(await EnteredImage.objects.acount(), 0)
+
+    async def test_errors(self):
+        self.assertEqual((await self.async_client.post('/filters/async/sepia/', {})).status_code, 400)
+        self.assertEqual((await self.post('/filters/async/nope/')).status_code, 400)
+        self.assertEqual((await self.post('/filters/async/convolve/')).status_code, 400)
+        self.data = b'junk'
+        self.assertEqual((await self.post('/filters/async/sepia/')).status_code, 400)
+
+    async def test_overloaded(self):
+        with mock.patch('filters.async_views.aadmit', side_effect=Overloaded(7)):
+            response = await self.post('/filters/async/sepia/')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '7')
+
+
+class GroupCommitterTests(SimpleTestCase):
+    def commit_concurrently(self, committer, rows):
+        results, errors = {}, []
+
+        def commit(row):
+            try:
+                results[row] = committer.commit(row)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=commit, args=(row,)) for row in rows]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, errors
+
+    def test_every_row_is_written_once_in_shared_batches(self):
+        batches = []
+
+        def insert_results(rows, using):
+            time.sleep(0.01)
+            batches.append(list(rows))
+            return [-row for row in rows]
+
+        with mock.patch.object(db, 'insert_results', insert_results):
+            results, errors = self.commit_concurrently(db.GroupCommitter(max_batch=8), list(range(40)))
+        self.assertEqual(errors, [])
+        self.assertEqual(results, {row: -row for row in range(40)})
+        self.assertEqual(sorted(row for batch in batches for row in batch), list(range(40)))
+        self.assertLess(len(batches), 40)
+        self.assertLessEqual(max(len(batch) for batch in batches), 8)
+
+    def test_errors_reach_every_row_in_the_batch(self):
+        def insert_results(rows, using):
+            time.sleep(0.01)
+            raise ValueError('disk full')
+
+        with mock.patch.object(db, 'insert_results', insert_results):
+            results, errors = self.commit_concurrently(db.GroupCommitter(), list(range(10)))
+        self.assertEqual(len(errors), 10)
+        self.assertTrue(all(isinstance(e, ValueError) for e in errors))
+
+
+@override_settings(FILTER_DERIVATIVE_SIZES=())
+class GroupCommitDatabaseTests(MediaRootMixin, TransactionTestCase):
+    def commit_concurrently(self, make_row, count):
+        committer = db.GroupCommitter(max_batch=4)
+        results = {}
+
+        def commit(index):
+            try:
+                results[index] = committer.commit(make_row(index))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=commit, args=(index,)) for index in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_commits_insert_all_rows(self):
+        def make_row(index):
+            entered_image = EnteredImage(content_hash=f'{index:064x}')
+            return ResultRow(entered_image, FilteredImage(filter_used='sepia_filter'), '', 10)
+
+        results = self.commit_concurrently(make_row, 12)
+        self.assertEqual(EnteredImage.objects.count(), 12)
+        self.assertEqual(FilteredImage.objects.count(), 12)
+        self.assertEqual(FilterCacheEntry.objects.count(), 12)
+        self.assertEqual({result.pk for result in results.values()},
+                         set(FilteredImage.objects.values_list('pk', flat=True)))
+
+    def test_identical_results_get_the_first_one(self):
+        entered_image = EnteredImage.objects.create(content_hash='0' * 64, image_file='enteredImages/car.jpg')
+
+        def make_row(index):
+            filtered_image = store_filtered_image(b'result', entered_image, 'sepia_filter', 'sepia')
+            return ResultRow(entered_image, filtered_image, '', 6)
+
+        results = self.commit_concurrently(make_row, 8)
+        winner = FilterCacheEntry.objects.get().filtered_image
+        self.assertEqual({result.pk for result in results.values()}, {winner.pk})
+        self.assertEqual(FilteredImage.objects.count(), 1)
+        self.assertEqual(self.stored_files('filteredImages'), [os.path.basename(winner.image_file.name)])
+
+
+@override_settings(FILTER_DERIVATIVE_SIZES=(), FILTER_WRITE_BEHIND=False)
+class MultiFilterTests(MediaRootMixin, TestCase):
+    def post(self, filters):
+        upload = ContentFile(jpeg_bytes(synthetic_image(64, 48)), name='car.jpg')
+        return self.client.post('/filters/multi/', {'image_file': upload, 'filters': filters})
+
+    def test_results_share_one_original(self):
+        response = self.post('sepia,emboss')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(EnteredImage.objects.count(), 1)
+        self.assertEqual(FilterCacheEntry.objects.count(), 2)
+        self.assertEqual({image['original_image'] for image in response.json()['filtered_images']},
+                         {response.json()['entered_image']['id']})
+
+    def test_cached_results_are_reused(self):
+        first = self.post('sepia')
+        response = self.post(['emboss', 'sepia'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['filtered_images'][1]['id'], first.json()['filtered_images'][0]['id'])
+        self.assertEqual(FilteredImage.objects.count(), 2)
+        self.assertEqual(self.post('sepia,nope').status_code, 400)
+
+
+class AdmissionControllerTests(SimpleTestCase):
+    def controller(self, **kwargs):
+        options = dict(cpu_budget=10, memory_budget=1000, fast_lane_pixels=100, fast_lane_share=0.2,
+                       queue_timeout=1.0, max_queue=4)
+        options.update(kwargs)
+        return AdmissionController(**options)
+
+    def test_waits_for_room_then_admits(self):
+        controller = self.controller()
+        first = controller.acquire(Cost(1000, 6, 100))
+        admitted = threading.Event()
+
+        def second():
+            controller.release(controller.acquire(Cost(1000, 6, 100)))
+            admitted.set()
+
+        thread = threading.Thread(target=second)
+        thread.start()
+        self.assertFalse(admitted.wait(0.1))
+        controller.release(first)
+        self.assertTrue(admitted.wait(1))
+        thread.join()
+
+    def test_overloaded_after_the_queue_timeout(self):
+        controller = self.controller(queue_timeout=0.05)
+        ticket = controller.acquire(Cost(1000, 8, 100))
+        with self.assertRaises(Overloaded) as raised:
+            controller.acquire(Cost(1000, 8, 100))
+        self.assertGreaterEqual(raised.exception.retry_after, 1)
+        self.assertEqual(len(controller.standard.waiting), 0)
+        controller.release(ticket)
+
+    def test_overloaded_when_the_queue_is_full(self):
+        controller = self.controller(max_queue=0)
+        with self.assertRaises(Overloaded):
+            controller.acquire(Cost(1000, 1, 1))
+
+    def test_oversized_requests_run_alone(self):
+        controller = self.controller()
+        ticket = controller.acquire(Cost(1000, 100, 10 ** 6))
+        self.assertEqual(controller.standard.running, 1)
+        controller.release(ticket)
+        self.assertEqual((controller.standard.cpu, controller.standard.memory, controller.standard.running), (0, 0, 0))
+
+    def test_small_images_skip_a_busy_standard_lane(self):
+        controller = self.controller(queue_timeout=0.05)
+        large = controller.acquire(Cost(1000, 8, 100))
+        small = controller.acquire(Cost(50, 1, 10))
+        self.assertIs(small.lane, controller.fast)
+        controller.release(small)
+        controller.release(large)
+
+    def test_estimate_reads_the_header(self):
+        image_file = BytesIO(jpeg_bytes(synthetic_image(400, 300)))
+        sepia, blur = get_filter('sepia'), get_filter('blur')
+        cost = estimate(image_file, [sepia])
+        self.assertEqual(cost.pixels, 120000)
+        self.assertEqual(image_file.tell(), 0)
+        self.assertGreater(estimate(image_file, [sepia, blur]).cpu, cost.cpu)
+        self.assertEqual(estimate(image_file, [sepia], max_dimension=200).pixels, 30000)
+        self.assertGreater(estimate(image_file, [sepia], outputs=3).memory, cost.memory)
+        with self.assertRaises(FilterError):
+            estimate(BytesIO(b'junk'), [sepia])
+
+    def test_views_answer_503(self):
+        controller = self.controller(max_queue=0)
+        upload = ContentFile(jpeg_bytes(synthetic_image(64, 48)), name='car.jpg')
+        with mock.patch('filters.admission.get_controller', return_value=controller):
+            response = self.client.post('/filters/sepia/?process_only=1', {'image_file': upload})
+        self.assertEqual(response.status_code, 503)
+        self.assertGreaterEqual(int(response['Retry-After']), 1)
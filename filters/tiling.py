@@ -0,0 +1,81 @@
+import tempfile
+
+import numpy as np
+
+from .pipeline import Stage, fuse, run_steps, stage_kernel
+from .point_ops import PointOp
+
+
+TILE_ROWS = 512
+# Whole-image processing is used below this size unless tiling is asked for.
+TILE_MIN_PIXELS = 40000000
+
+
+def plan_tiles(stages, shape):
+    """Return the fused steps pinned for tiling and the total halo, or None."""
+    steps = []
+    halo = 0
+    for step in fuse(stages):
+        if isinstance(step, np.ndarray):
+            rows = step.shape[0] // 2
+        elif isinstance(step, PointOp):
+            rows = 0
+        else:
+            plan = stage_tiling(step, shape)
+            if plan is None:
+                return None
+            rows, params = plan
+            step = Stage(step.spec, params)
+        steps.append(step)
+        halo += rows
+    return steps, halo
+
+
+def stage_tiling(stage, shape):
+    tiling = stage.spec.tiling
+    kernel = stage_kernel(stage) if tiling is None else None
+    if kernel is not None:
+        tiling = kernel.shape[0] // 2
+    if tiling is None:
+        return None
+    if callable(tiling):
+        return tiling(stage.params, shape)
+    return tiling, stage.params
+
+
+def should_tile(image, tiled=None):
+    if tiled is not None:
+        return tiled
+    return image.shape[0] * image.shape[1] >= TILE_MIN_PIXELS
+
+
+def run_tiled(image, stages, tile_rows=TILE_ROWS, scratch_dir=None):
+    """Run ``stages`` over horizontal strips of ``image``.
+
+    Each strip is read with enough rows above and below for every stage's
+    kernel (the halo), so the kept rows match whole-image processing pixel
+    for pixel. Results are written strip by strip into a memory-mapped
+    scratch file, so intermediates only ever hold one strip. Returns None
+    when a stage cannot be tiled.
+    """
+    plan = plan_tiles(stages, image.shape)
+    if plan is None:
+        return None
+    steps, halo = plan
+
+    height = image.shape[0]
+    output = None
+    for top in range(0, height, tile_rows):
+        bottom = min(top + tile_rows, height)
+        start, stop = max(0, top - halo), min(height, bottom + halo)
+        # Steps may work in place, so each strip needs its own copy.
+        strip = run_steps(image[start:stop].copy(), steps)
+        if output is None:
+            output = scratch_array((height,) + strip.shape[1:], strip.dtype, scratch_dir)
+        output[top:bottom] = strip[top - start:bottom - start]
+    return output
+
+
+def scratch_array(shape, dtype, scratch_dir=None):
+    # The file is unlinked straight away and lives as long as the mapping.
+    return np.memmap(tempfile.TemporaryFile(dir=scratch_dir), dtype=dtype, mode='w+', shape=shape)
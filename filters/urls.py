@@ -1,14 +1,33 @@
 from django.urls import path
-from .views import (ImageUploadView, ImageToBlackAndWhite, BlurFilter,
-                    ImageSketchFilter, EmbossFilter, SharpenFilter, SepiaFilter)
+from .async_views import AsyncFilterView, AsyncPipelineFilterView
+from .views import (ImageUploadView, FilterView, MultiFilterView, PipelineFilterView,
+                    BatchFilterView, ConvolutionFilterView, VideoFilterView, FilterJobView, DerivativeView,
+                    MetricsView, ImageRecordView, ImageRecordFileView, SimilarImagesView)
 
 urlpatterns = [
     path('image-upload/', ImageUploadView.as_view(), name='image-upload'),
-    path('blackandwhite/', ImageToBlackAndWhite.as_view(), name='image-filter-black-and-white'),
-    path('blur/', BlurFilter.as_view(), name='image-filter-blur'),
-    path('sketch/', ImageSketchFilter.as_view(), name='image-sketch-filter'),
-    path('emboss/', EmbossFilter.as_view(), name='image-emboss'),
-    path('sharpen/', SharpenFilter.as_view(), name='image-sharpen'),
-    path('sepia/', SepiaFilter.as_view(), name='image-sepia')
+    path('blackandwhite/', FilterView.as_view(filter_name='black_and_white'), name='image-filter-black-and-white'),
+    path('blur/', FilterView.as_view(filter_name='blur'), name='image-filter-blur'),
+    path('sketch/', FilterView.as_view(filter_name='sketch'), name='image-sketch-filter'),
+    path('emboss/', FilterView.as_view(filter_name='emboss'), name='image-emboss'),
+    path('sharpen/', FilterView.as_view(filter_name='sharpen'), name='image-sharpen'),
+    path('sepia/', FilterView.as_view(filter_name='sepia'), name='image-sepia'),
+    path('brightness/', FilterView.as_view(filter_name='brightness'), name='image-brightness'),
+    path('contrast/', FilterView.as_view(filter_name='contrast'), name='image-contrast'),
+    path('gamma/', FilterView.as_view(filter_name='gamma'), name='image-gamma'),
+    path('convolve/', ConvolutionFilterView.as_view(), name='image-convolve'),
+    path('multi/', MultiFilterView.as_view(), name='image-multi-filter'),
+    path('pipeline/', PipelineFilterView.as_view(), name='image-pipeline-filter'),
+    path('batch/', BatchFilterView.as_view(), name='image-batch-filter'),
+    path('video/', VideoFilterView.as_view(), name='video-filter'),
+    path('jobs/<int:pk>/', FilterJobView.as_view(), name='filter-job'),
+    path('derivatives/<path:name>', DerivativeView.as_view(), name='image-derivative'),
+    path('metrics/', MetricsView.as_view(), name='filter-metrics'),
+    path('images/<uuid:uuid>/', ImageRecordView.as_view(), name='image-record'),
+    path('images/<uuid:uuid>/file/', ImageRecordFileView.as_view(), name='image-record-file'),
+    path('images/<uuid:uuid>/similar/', SimilarImagesView.as_view(), name='image-similar'),
+    path('similar/', SimilarImagesView.as_view(), name='similar-images'),
+    path('async/pipeline/', AsyncPipelineFilterView.as_view(), name='image-async-pipeline-filter'),
+    path('async/<str:filter_name>/', AsyncFilterView.as_view(), name='image-async-filter'),
 
 ]
@@ -0,0 +1,104 @@
+"""Filter video clips frame by frame.
+
+Frames are read from ``cv2.VideoCapture`` one at a time, filtered on the
+shared thread pool (OpenCV releases the GIL) and written to
+``cv2.VideoWriter`` in their original order. At most ``window`` frames are
+in flight, so memory use does not grow with the length of the clip.
+"""
+import time
+from collections import deque, namedtuple
+
+import cv2
+import numpy as np
+
+from .pipeline import fuse, run_steps, scale_stages
+from .registry import FilterError
+
+CODEC = 'mp4v'
+CONTENT_TYPE = 'video/mp4'
+EXTENSION = '.mp4'
+
+VideoResult = namedtuple('VideoResult', ['frames', 'source_frames', 'fps', 'width', 'height', 'seconds'])
+
+
+def filter_video(source_path, output_path, stages, pool, window, stride=1, max_seconds=None, max_dimension=None,
+                 frame_limit=None):
+    """Filter every ``stride``-th frame of ``source_path`` into ``output_path``.
+
+    Reading stops after ``max_seconds`` of the clip; a clip longer than
+    ``frame_limit`` frames is rejected with ``FilterError``. With
+    ``max_dimension`` frames are shrunk to fit and kernel sizes scaled to
+    match, as for image previews.
+    """
+    capture = cv2.VideoCapture(source_path)
+    if not capture.isOpened():
+        raise FilterError('Uploaded file is not a readable video.')
+    writer = None
+    pending = deque()
+    start = time.perf_counter()
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+        width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        max_frames = round(fps * max_seconds) if max_seconds else None
+        size, scale = fit(width, height, max_dimension)
+        steps = fuse(scale_stages(stages, scale))
+
+        def process(frame):
+            if size != (width, height):
+                frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+            return run_steps(frame, steps)
+
+        frames = source_frames = 0
+        while max_frames is None or source_frames < max_frames:
+            if source_frames % stride:
+                # Skipped frames are only demuxed, never decoded.
+                ok, frame = capture.grab(), None
+            else:
+                ok, frame = capture.read()
+            if not ok:
+                break
+            source_frames += 1
+            if frame_limit and source_frames > frame_limit:
+                raise FilterError(f'Videos are limited to {frame_limit} frames.')
+            if frame is None:
+                continue
+            pending.append(pool.submit(process, frame))
+            if len(pending) >= window:
+                writer = write_frame(writer, output_path, fps / stride, pending.popleft().result())
+                frames += 1
+        while pending:
+            writer = write_frame(writer, output_path, fps / stride, pending.popleft().result())
+            frames += 1
+    finally:
+        for future in pending:
+            future.cancel()
+        capture.release()
+        if writer is not None:
+            writer.release()
+
+    if not frames:
+        raise FilterError('Uploaded video has no frames.')
+    return VideoResult(frames, source_frames, fps / stride, size[0], size[1], time.perf_counter() - start)
+
+
+def fit(width, height, max_dimension=None):
+    """Output frame size and the scale factor from the source size."""
+    longest = max(width, height)
+    if not max_dimension or longest <= max_dimension:
+        return (width, height), 1.0
+    scale = max_dimension / longest
+    return (max(2, round(width * scale)) // 2 * 2, max(2, round(height * scale)) // 2 * 2), scale
+
+
+def write_frame(writer, output_path, fps, frame):
+    # The writer is opened on the first frame, once the filters have decided
+    # whether the output is grayscale.
+    if writer is None:
+        height, width = frame.shape[:2]
+        writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*CODEC), fps, (width, height),
+                                 isColor=frame.ndim == 3)
+        if not writer.isOpened():
+            raise FilterError('Could not encode the filtered video.')
+    writer.write(np.ascontiguousarray(frame))
+    return writer
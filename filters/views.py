@@ -1,379 +1,664 @@
-import cv2
-import numpy as np
+import mimetypes
+import os
+import posixpath
+import tempfile
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import default_storage
+from django.db.models import Prefetch
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.views import View
 from rest_framework import status
+from rest_framework.exceptions import NotAcceptable
+from rest_framework.negotiation import DefaultContentNegotiation
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from io import BytesIO
-from django.core.files.uploadedfile import InMemoryUploadedFile
 
-from .models import EnteredImage, FilteredImage
-from .serializers import EnteredImageSerializer, FilteredImageSerializer
-from PIL import Image, ImageOps, ImageFilter
+from . import convolution, engine, metrics, video
+from .admission import Overloaded, admit
+from .batch import ndjson_stream, read_batch_inputs, run_batch, zip_stream
+from .cache import get_cached_result, hash_upload
+from .derivatives import DERIVATIVE_DIR, schedule_derivatives
+from .formats import get_format, negotiate
+from .ingest import open_upload
+from .jobs import enqueue_job
+from .metrics import TimedViewMixin, stage
+from .models import EnteredImage, FilteredImage, FilterJob
+from .pagination import ImageCursorPagination
+from .persistence import save_original_image, save_result, save_results, store_original_in_background
+from .pipeline import (Stage, describe, param_names, parse_pipeline, parse_value, prepare, run_pipeline,
+                       scale_stages)
+from .registry import FilterError, get_filter
+from .serializers import (EnteredImageListSerializer, EnteredImageSerializer, FilteredImageSerializer,
+                          FilterJobSerializer)
+from .similarity import (find_similar, get_similar_cached_result, hash_image_file, near_duplicate_distance,
+                         schedule_perceptual_hash)
+from .workers import get_thread_pool, thread_pool_size
+from .writer import find_pending
 
 
 class ImageUploadView(APIView):
     def get(self, request):
+        """List uploads newest first, one cursor page at a time.
+
+        ``?fields=id,image_file`` limits the fields returned and
+        ``?embed=filtered_images`` nests each upload's filtered images.
+        """
+        try:
+            fields = parse_field_list(request, 'fields', EnteredImageListSerializer.selectable_fields())
+            embed = parse_field_list(request, 'embed', EnteredImageListSerializer.EMBEDDABLE) or ()
+        except FilterError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
         entered_images = EnteredImage.objects.all()
-        serializer = EnteredImageSerializer(entered_images, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        if fields is not None:
+            columns = {field.name for field in EnteredImage._meta.concrete_fields}
+            entered_images = entered_images.only('id', 'created_at', *(name for name in fields if name in columns))
+        if 'filtered_images' in embed:
+            entered_images = entered_images.prefetch_related(
+                Prefetch('filteredimage_set', queryset=FilteredImage.objects.order_by('created_at', 'id')))
+
+        paginator = ImageCursorPagination()
+        page = paginator.paginate_queryset(entered_images, request, view=self)
+        serializer = EnteredImageListSerializer(page, many=True, fields=fields, embed=embed)
+        return paginator.get_paginated_response(serializer.data)
 
     def post(self, request):
         entered_image_serializer = EnteredImageSerializer(data=request.data)
         if entered_image_serializer.is_valid():
-            entered_image_serializer.save()
+            image_file = request.FILES.get('image_file')
+            entered_image = entered_image_serializer.save(content_hash=hash_upload(image_file) if image_file else '')
+            schedule_derivatives(entered_image)
+            schedule_perceptual_hash(entered_image)
             return Response({'Successfully uploaded'}, status=status.HTTP_201_CREATED)
         return Response(entered_image_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class ImageToBlackAndWhite(APIView):
-    def post(self, request, *args, **kwargs):
-        image_file = request.FILES.get('image_file')
+class ImageContentNegotiation(DefaultContentNegotiation):
+    """Let ``Accept: image/webp`` or ``video/mp4`` through to views that return media or JSON about it.
 
-        if not image_file:
-            return Response({'error': 'No image file provided.'}, status=status.HTTP_400_BAD_REQUEST)
+    The views pick the media format themselves; the renderer is only used
+    for JSON answers such as errors.
+    """
 
+    def select_renderer(self, request, renderers, format_suffix=None):
         try:
-            entered_image = self.save_original_image(image_file)
-            filtered_image = self.apply_black_and_white_filter(entered_image.image_file)
-            filtered_image_obj = self.save_filtered_image(filtered_image, entered_image, 'black_and_white')
-
-            entered_image_serializer = EnteredImageSerializer(entered_image)
-            filtered_image_serializer = FilteredImageSerializer(filtered_image_obj)
+            return super().select_renderer(request, renderers, format_suffix)
+        except NotAcceptable:
+            return renderers[0], renderers[0].media_type
 
-            return Response({
-                'entered_image': entered_image_serializer.data,
-                'filtered_image': filtered_image_serializer.data
-            }, status=status.HTTP_200_OK)
 
-        except Exception as e:
-            return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+class FilterView(TimedViewMixin, APIView):
+    filter_name = None
+    content_negotiation_class = ImageContentNegotiation
 
-    def save_original_image(self, image_file):
-        entered_image = EnteredImage.objects.create(image_file=image_file)
-        return entered_image
+    def get_metrics_name(self):
+        return self.filter_name
 
-    def apply_black_and_white_filter(self, image_file):
-        original_image = Image.open(image_file)
-        black_and_white_image = ImageOps.grayscale(original_image)
+    def get_stages(self, request):
+        spec = get_filter(self.filter_name)
+        params = {}
+        for name in param_names(spec):
+            value = request.query_params.get(name, request.data.get(name))
+            if value not in (None, ''):
+                params[name] = parse_value(str(value))
+        return [Stage(spec, params)]
 
-        output_buffer = BytesIO()
-        black_and_white_image.save(output_buffer, format='JPEG')
-        output_buffer.seek(0)
+    def get_output(self, stages):
+        """Return the ``filter_used`` label, file suffix, cache params and default format for ``stages``."""
+        spec, params = stages[0]
+        return spec.label, spec.suffix, params, spec.default_format
 
-        black_and_white_file = InMemoryUploadedFile(
-            output_buffer,
-            'image',
-            f'{image_file.name.split(".")[0]}_bw.jpg',
-            'image/jpeg',
-            output_buffer.tell(),
-            None
-        )
-
-        return black_and_white_file
-
-    def save_filtered_image(self, filtered_image, entered_image, filter_used):
-        filtered_image_obj = FilteredImage.objects.create(
-            image_file=filtered_image,
-            original_image=entered_image,
-            filter_used=filter_used
-        )
-        return filtered_image_obj
-
-
-class BlurFilter(APIView):
     def post(self, request, *args, **kwargs):
         image_file = request.FILES.get('image_file')
 
         if not image_file:
             return Response({'error': 'Image file is required.'}, status=status.HTTP_400_BAD_REQUEST)
 
+        upload = open_upload(image_file)
         try:
-            entered_image = self.save_original_image(image_file)
-            filtered_image = self.apply_blur_filter(entered_image.image_file)
-            filtered_image_obj = self.save_filtered_image(filtered_image, entered_image, 'blur_filter')
+            stages = self.get_stages(request)
+            filter_used, suffix, params, default_format = self.get_output(stages)
+            max_dimension = parse_max_dimension(request)
+            if max_dimension:
+                params = dict(params or {}, max_dimension=max_dimension)
+                suffix = f'{suffix}_{max_dimension}'
+            output_format, options = parse_encode_options(request, default_format)
+            if options:
+                params = dict(params or {}, output=options)
+
+            if is_flag_set(request, 'process_only'):
+                return self.process_only(upload, stages, suffix, max_dimension, parse_tiled(request), options)
+
+            with stage('hash'):
+                content_hash = upload.sha256()
+            with stage('cache'):
+                filtered_image_obj = get_cached_result(content_hash, filter_used, params)
+
+            if filtered_image_obj is None and near_duplicate_distance() is not None:
+                with stage('similar'):
+                    filtered_image_obj = get_similar_cached_result(upload.perceptual_hash(), filter_used, params)
+
+            if filtered_image_obj is None and is_flag_set(request, 'async'):
+                entered_image = save_original_image(image_file, content_hash, upload.known_perceptual_hash())
+                job = enqueue_job(entered_image, stages, filter_used, suffix, params,
+                                  priority=parse_priority(request))
+                return Response({'job': FilterJobSerializer(job).data}, status=status.HTTP_202_ACCEPTED,
+                                headers={'Location': reverse('filter-job', args=[job.pk]), 'Vary': 'Accept'})
+
+            if filtered_image_obj is None:
+                with admit(image_file, [item.spec for item in stages], max_dimension):
+                    store_original_in_background(upload)
+                    with stage('decode'):
+                        image, stages = prepare(upload.data, stages, max_dimension)
+                    with stage('filter'):
+                        filtered_image = run_pipeline(image, stages, parse_tiled(request))
+                    with stage('encode'):
+                        encoded = engine.encode(filtered_image, **options)
+                    # Free the buffers before handing back the budget.
+                    del image, filtered_image
+                _, filtered_image_obj = save_result(upload, content_hash, encoded, filter_used, suffix,
+                                                    output_format.extension, params)
+
+            entered_image = filtered_image_obj.original_image
 
             entered_image_serializer = EnteredImageSerializer(entered_image)
             filtered_image_serializer = FilteredImageSerializer(filtered_image_obj)
 
+            headers = {'Vary': 'Accept'}
+            if filtered_image_obj.pk is None:
+                # Still queued for write-behind; the record view serves it until it is stored.
+                headers['Location'] = reverse('image-record', args=[filtered_image_obj.uuid])
             return Response({
                 'entered_image': entered_image_serializer.data,
                 'filtered_image': filtered_image_serializer.data
-            }, status=status.HTTP_200_OK)
+            }, status=status.HTTP_200_OK, headers=headers)
 
+        except Overloaded as e:
+            return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            headers={'Retry-After': str(e.retry_after)})
+        except FilterError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        finally:
+            upload.close()
+
+    def process_only(self, upload, stages, suffix, max_dimension=None, tiled=None, encode_options=None):
+        """Filter straight from the upload and return the encoded image, storing nothing."""
+        encode_options = encode_options or {}
+        output_format = get_format(encode_options.get('format', 'jpeg'))
+        with admit(upload.image_file, [item.spec for item in stages], max_dimension):
+            with stage('decode'):
+                image, stages = prepare(upload.data, stages, max_dimension)
+            with stage('filter'):
+                filtered_image = run_pipeline(image, stages, tiled)
+            with stage('encode'):
+                encoded = engine.encode(filtered_image, **encode_options)
+            del image, filtered_image
+        response = HttpResponse(encoded, content_type=output_format.content_type)
+        name = os.path.splitext(os.path.basename(upload.name))[0].replace('"', '')
+        response['Content-Disposition'] = f'inline; filename="{name}_{suffix}{output_format.extension}"'
+        response['Vary'] = 'Accept'
+        return response
+
+
+class MultiFilterView(TimedViewMixin, APIView):
+    content_negotiation_class = ImageContentNegotiation
+
+    def get_metrics_name(self):
+        return 'multi'
 
-    def save_original_image(self, image_file):
-        entered_image = EnteredImage.objects.create(image_file=image_file)
-        return entered_image
-
-    def apply_blur_filter(self, image_file):
-        original_image = Image.open(image_file)
-
-        blur_effect_img = cv2.GaussianBlur(np.array(original_image), (35, 35), 0)
-
-        blur_image = Image.fromarray(blur_effect_img)
-
-        output_buffer = BytesIO()
-        blur_image.save(output_buffer, format='JPEG')
-        output_buffer.seek(0)
-
-        filtered_image = InMemoryUploadedFile(
-            output_buffer,
-            'image',
-            f'{image_file.name.split(".")[0]}_blur.jpg',
-            'image/jpeg',
-            output_buffer.tell(),
-            None
-        )
-
-        return filtered_image
-
-    def save_filtered_image(self, filtered_image, entered_image, filter_used):
-        filtered_image_obj = FilteredImage.objects.create(
-            image_file=filtered_image,
-            original_image=entered_image,
-            filter_used=filter_used
-        )
-        return filtered_image_obj
-
-
-class ImageSketchFilter(APIView):
     def post(self, request, *args, **kwargs):
         image_file = request.FILES.get('image_file')
+        filter_names = parse_filter_list(request.data)
 
         if not image_file:
             return Response({'error': 'Image file is required.'}, status=status.HTTP_400_BAD_REQUEST)
+        if not filter_names:
+            return Response({'error': 'At least one filter is required.'}, status=status.HTTP_400_BAD_REQUEST)
 
+        upload = open_upload(image_file)
         try:
-            entered_image = self.save_original_image(image_file)
-            filtered_image = self.apply_sketch_filter(entered_image.image_file)
-            filtered_image_obj = self.save_filtered_image(filtered_image, entered_image)
-
-            entered_image_serializer = EnteredImageSerializer(entered_image)
-            filtered_image_serializer = FilteredImageSerializer(filtered_image_obj)
+            specs = []
+            for name in filter_names:
+                spec = get_filter(name)
+                if spec not in specs:
+                    specs.append(spec)
+            max_dimension = parse_max_dimension(request)
+            outputs, params = {}, {}
+            for spec in specs:
+                outputs[spec.name] = parse_encode_options(request, spec.default_format)
+                params[spec.name] = {'max_dimension': max_dimension} if max_dimension else {}
+                if outputs[spec.name][1]:
+                    params[spec.name]['output'] = outputs[spec.name][1]
+
+            with stage('hash'):
+                content_hash = upload.sha256()
+            with stage('cache'):
+                filtered_image_objs = {
+                    spec.name: get_cached_result(content_hash, spec.label, params[spec.name]) for spec in specs
+                }
+
+            # Every result must hang off the same EnteredImage, so only cached
+            # results for the first matching upload are reused, and only once
+            # they are stored.
+            entered_image = next((obj.original_image for obj in filtered_image_objs.values() if obj and obj.pk),
+                                 None)
+            for name, obj in filtered_image_objs.items():
+                if obj is not None and (obj.pk is None or obj.original_image_id != entered_image.id):
+                    filtered_image_objs[name] = None
+
+            missing = [spec for spec in specs if filtered_image_objs[spec.name] is None]
+            if missing:
+                with admit(image_file, missing, max_dimension, outputs=len(missing)):
+                    if entered_image is None:
+                        upload.start_store()
+                    with stage('decode'):
+                        if max_dimension:
+                            image, scale = engine.decode_preview(upload.data, max_dimension)
+                        else:
+                            image, scale = engine.decode(upload.data), 1.0
+                    pool = get_thread_pool()
+                    futures = []
+                    # Filters run and encode concurrently, so they are timed as one stage.
+                    with stage('filter_encode'):
+                        for spec in missing:
+                            [(_, stage_params)] = scale_stages([Stage(spec, {})], scale)
+                            futures.append((spec, pool.submit(engine.apply_and_encode, image, spec.name,
+                                                              outputs[spec.name][1], **stage_params)))
+                        encoded = [(spec, future.result()) for spec, future in futures]
+                    del image
+
+                results = [(data, spec.label, f'{spec.suffix}_{max_dimension}' if max_dimension else spec.suffix,
+                            outputs[spec.name][0].extension, params[spec.name]) for spec, data in encoded]
+                entered_image, saved = save_results(upload, content_hash, results, entered_image)
+                for (spec, _), filtered_image_obj in zip(encoded, saved):
+                    filtered_image_objs[spec.name] = filtered_image_obj
 
             return Response({
-                'entered_image': entered_image_serializer.data,
-                'filtered_image': filtered_image_serializer.data
-            }, status=status.HTTP_200_OK)
-
+                'entered_image': EnteredImageSerializer(entered_image).data,
+                'filtered_images': FilteredImageSerializer(
+                    [filtered_image_objs[spec.name] for spec in specs], many=True).data
+            }, status=status.HTTP_200_OK, headers={'Vary': 'Accept'})
+
+        except Overloaded as e:
+            return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            headers={'Retry-After': str(e.retry_after)})
+        except FilterError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        finally:
+            upload.close()
 
-    def save_original_image(self, image_file):
-        entered_image = EnteredImage.objects.create(image_file=image_file)
-        return entered_image
-
-    def apply_sketch_filter(self, image_file):
-        original_image = Image.open(image_file)
-        sketch_image = original_image.filter(ImageFilter.CONTOUR)
-
-        output_buffer = BytesIO()
-        sketch_image.save(output_buffer, format='JPEG')
-        output_buffer.seek(0)
-
-        filtered_image = InMemoryUploadedFile(
-            output_buffer,
-            'image',
-            f'{image_file.name.split(".")[0]}_sketch.jpg',
-            'image/jpeg',
-            output_buffer.tell(),
-            None
-        )
-
-        return filtered_image
-
-    def save_filtered_image(self, filtered_image, entered_image):
-        filtered_image_obj = FilteredImage.objects.create(
-            image_file=filtered_image,
-            original_image=entered_image,
-            filter_used='sketch_filter'
-        )
-        return filtered_image_obj
-
-
-class EmbossFilter(APIView):
-    def post(self, request, *args, **kwargs):
-        image_file = request.FILES.get('image_file')
-
-        if not image_file:
-            return Response({'error': 'Image file is required.'}, status=status.HTTP_400_BAD_REQUEST)
-
-        try:
-            entered_image = self.save_original_image(image_file)
-            filtered_image = self.apply_emboss_filter(entered_image.image_file)
-            filtered_image_obj = self.save_filtered_image(filtered_image, entered_image)
-
-            entered_image_serializer = EnteredImageSerializer(entered_image)
-            filtered_image_serializer = FilteredImageSerializer(filtered_image_obj)
-
-            return Response({
-                'entered_image': entered_image_serializer.data,
-                'filtered_image': filtered_image_serializer.data
-            }, status=status.HTTP_200_OK)
-
-        except Exception as e:
-            return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    def save_original_image(self, image_file):
-        entered_image = EnteredImage.objects.create(image_file=image_file)
-        return entered_image
+class PipelineFilterView(FilterView):
+    def get_metrics_name(self):
+        return 'pipeline'
 
-    def apply_emboss_filter(self, image_file):
-        original_image = Image.open(image_file)
+    def get_stages(self, request):
+        return parse_pipeline(request.data.get('pipeline'))
 
-        original_image_np = np.array(original_image)
+    def get_output(self, stages):
+        return describe(stages), 'pipeline', None, 'jpeg'
 
-        emboss_kernel = np.array([[0, -1, -1], [1, 0, -1], [1, 1, 0]])
 
-        emboss_effect_img = cv2.filter2D(original_image_np, -1, emboss_kernel)
+class ConvolutionFilterView(FilterView):
+    """Correlate with a user-defined ``kernel``, sent as a list of rows or its JSON text.
 
-        emboss_image = Image.fromarray(emboss_effect_img)
+    Results are cached under the analysed kernel's hash, and the
+    ``X-Kernel-Strategy`` header says how it ran; see ``convolution``.
+    """
+    filter_name = 'convolve'
 
-        output_buffer = BytesIO()
-        emboss_image.save(output_buffer, format='JPEG')
-        output_buffer.seek(0)
+    def get_stages(self, request):
+        stages = super().get_stages(request)
+        [(spec, params)] = stages
+        if 'kernel' not in params:
+            raise FilterError('kernel is required.')
+        self.plan = convolution.get_plan(params['kernel'], params.get('normalize', False))
+        return stages
 
-        filtered_image = InMemoryUploadedFile(
-            output_buffer,
-            'image',
-            f'{image_file.name.split(".")[0]}_emboss.jpg',
-            'image/jpeg',
-            output_buffer.tell(),
-            None
-        )
+    def get_output(self, stages):
+        label, suffix, params, default_format = super().get_output(stages)
+        params = dict(params, kernel=self.plan.digest)
+        params.pop('normalize', None)
+        return label, suffix, params, default_format
 
-        return filtered_image
+    def post(self, request, *args, **kwargs):
+        self.plan = None
+        response = super().post(request, *args, **kwargs)
+        if self.plan is not None:
+            response['X-Kernel-Strategy'] = self.plan.strategy
+        return response
 
-    def save_filtered_image(self, filtered_image, entered_image):
-        filtered_image_obj = FilteredImage.objects.create(
-            image_file=filtered_image,
-            original_image=entered_image,
-            filter_used='emboss_filter'
-        )
-        return filtered_image_obj
 
+class BatchFilterView(APIView):
+    content_negotiation_class = ImageContentNegotiation
 
-class SharpenFilter(APIView):
     def post(self, request, *args, **kwargs):
-        image_file = request.FILES.get('image_file')
-
-        if not image_file:
-            return Response({'error': 'Image file is required.'}, status=status.HTTP_400_BAD_REQUEST)
-
         try:
-            entered_image = self.save_original_image(image_file)
-            filtered_image = self.apply_sharpen_filter(entered_image.image_file)
-            filtered_image_obj = self.save_filtered_image(filtered_image, entered_image, 'sharpen_filter')
+            if request.data.get('pipeline'):
+                stages = parse_pipeline(request.data.get('pipeline'))
+                filter_used, suffix, default_format = describe(stages), 'pipeline', 'jpeg'
+            else:
+                spec = get_filter(request.data.get('filter', ''))
+                # Filters with required parameters, such as convolve, need a pipeline.
+                engine.check_params(spec, {})
+                stages = [Stage(spec, {})]
+                filter_used, suffix, default_format = spec.label, spec.suffix, spec.default_format
+            max_dimension = parse_max_dimension(request)
+            if max_dimension:
+                suffix = f'{suffix}_{max_dimension}'
+            _, options = parse_encode_options(request, default_format)
+            inputs = read_batch_inputs(request)
+        except FilterError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        def serialize(result):
+            if 'error' in result:
+                return {'index': result['index'], 'name': result['name'], 'error': result['error']}
+            return {
+                'index': result['index'],
+                'name': result['name'],
+                'entered_image': EnteredImageSerializer(result['entered_image']).data,
+                'filtered_image': FilteredImageSerializer(result['filtered_image']).data
+            }
+
+        results = run_batch(inputs, stages, filter_used, suffix, max_dimension, options)
+        if request.data.get('output') == 'zip':
+            response = StreamingHttpResponse(zip_stream(results, serialize), content_type='application/zip')
+            response['Content-Disposition'] = 'attachment; filename="filtered.zip"'
+            return response
+        return StreamingHttpResponse(ndjson_stream(results, serialize), content_type='application/x-ndjson')
+
+
+class VideoFilterView(TimedViewMixin, APIView):
+    """Filter a video clip with one ``filter`` or a ``pipeline`` and return the result as MP4.
+
+    ``stride`` keeps every n-th frame; ``preview`` keeps the first
+    ``FILTER_VIDEO_PREVIEW_SECONDS`` at a reduced size. Nothing is stored.
+    """
+    content_negotiation_class = ImageContentNegotiation
+
+    def get_metrics_name(self):
+        return 'video'
 
-            entered_image_serializer = EnteredImageSerializer(entered_image)
-            filtered_image_serializer = FilteredImageSerializer(filtered_image_obj)
+    def post(self, request, *args, **kwargs):
+        video_file = request.FILES.get('video_file')
 
-            return Response({
-                'entered_image': entered_image_serializer.data,
-                'filtered_image': filtered_image_serializer.data
-            }, status=status.HTTP_200_OK)
+        if not video_file:
+            return Response({'error': 'Video file is required.'}, status=status.HTTP_400_BAD_REQUEST)
 
+        output_path = None
+        try:
+            if request.data.get('pipeline'):
+                stages = parse_pipeline(request.data.get('pipeline'))
+                suffix = 'pipeline'
+            else:
+                spec = get_filter(request.data.get('filter', ''))
+                # Filters with required parameters, such as convolve, need a pipeline.
+                engine.check_params(spec, {})
+                stages = [Stage(spec, {})]
+                suffix = spec.suffix
+            stride = parse_stride(request)
+            max_dimension = parse_max_dimension(request)
+            max_seconds = None
+            if is_flag_set(request, 'preview'):
+                max_seconds = getattr(settings, 'FILTER_VIDEO_PREVIEW_SECONDS', 3)
+                max_dimension = max_dimension or getattr(settings, 'FILTER_VIDEO_PREVIEW_DIMENSION', 480)
+
+            with tempfile.NamedTemporaryFile(suffix=video.EXTENSION, delete=False) as output:
+                output_path = output.name
+            with open_video_path(video_file) as source_path, stage('video'):
+                result = video.filter_video(
+                    source_path, output_path, stages, get_thread_pool(), 2 * thread_pool_size(), stride=stride,
+                    max_seconds=max_seconds, max_dimension=max_dimension,
+                    frame_limit=getattr(settings, 'FILTER_VIDEO_MAX_FRAMES', None))
+            output = open(output_path, 'rb')
+        except FilterError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        finally:
+            if output_path is not None:
+                # An open output stays readable after it is unlinked.
+                os.unlink(output_path)
+
+        name = os.path.splitext(os.path.basename(video_file.name))[0].replace('"', '')
+        response = FileResponse(output, content_type=video.CONTENT_TYPE)
+        response['Content-Disposition'] = f'inline; filename="{name}_{suffix}{video.EXTENSION}"'
+        response['X-Video-Frames'] = str(result.frames)
+        response['X-Video-FPS'] = f'{result.fps:.2f}'
+        response['X-Filter-FPS'] = f'{result.frames / result.seconds:.1f}'
+        return response
+
+
+class FilterJobView(APIView):
+    def get(self, request, pk):
+        job = get_object_or_404(FilterJob.objects.select_related('filtered_image'), pk=pk)
+        return Response(FilterJobSerializer(job).data, status=status.HTTP_200_OK)
+
+
+class DerivativeView(View):
+    """Serve a derivative file. Names include a content digest, so they never change."""
+
+    def get(self, request, name):
+        # Only files under DERIVATIVE_DIR are served, whatever ``..`` the name contains.
+        path = posixpath.normpath(f'{DERIVATIVE_DIR}/{name}')
+        if not path.startswith(f'{DERIVATIVE_DIR}/') or '\\' in name:
+            raise Http404
+        try:
+            image_file = default_storage.open(path, 'rb')
+        except (FileNotFoundError, SuspiciousFileOperation):
+            raise Http404
+        response = FileResponse(image_file, content_type='image/jpeg')
+        response['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
+
+
+class ImageRecordView(APIView):
+    """Look up an original or filtered image by uuid, including ones still queued for write-behind."""
+
+    def get(self, request, uuid):
+        pending = find_pending(uuid)
+        if pending is not None:
+            instance = pending.entered_image if pending.entered_image.uuid == uuid else pending.filtered_image
+        else:
+            instance = (EnteredImage.objects.filter(uuid=uuid).first()
+                        or get_object_or_404(FilteredImage, uuid=uuid))
+        if isinstance(instance, EnteredImage):
+            data = {'entered_image': EnteredImageSerializer(instance).data}
+        else:
+            data = {'filtered_image': FilteredImageSerializer(instance).data}
+        data['pending'] = pending is not None
+        return Response(data, status=status.HTTP_200_OK)
+
+
+class SimilarImagesView(APIView):
+    """Stored uploads that look like a stored image (GET) or an uploaded one (POST), nearest first.
+
+    ``distance`` is the largest Hamming distance between perceptual hashes
+    to accept, out of 64 bits.
+    """
+
+    def get(self, request, uuid):
+        entered_image = get_object_or_404(EnteredImage, uuid=uuid)
+        if not entered_image.perceptual_hash and entered_image.image_file:
+            with entered_image.image_file.open('rb') as image_file:
+                entered_image.perceptual_hash = hash_image_file(image_file)
+            entered_image.save(update_fields=['perceptual_hash'])
+        return self.respond(request, entered_image.perceptual_hash, exclude=entered_image.pk)
 
-    def save_original_image(self, image_file):
-        entered_image = EnteredImage.objects.create(image_file=image_file)
-        return entered_image
-
-    def apply_sharpen_filter(self, image_file):
-        original_image = Image.open(image_file)
-
-        sharpen_kernel = np.array([[-1, -1, -1], [-1, 9, -1], [-1, -1, -1]])
-
-        original_image_np = np.array(original_image)
-
-        sharpen_effect_img = cv2.filter2D(original_image_np, -1, sharpen_kernel)
-
-        sharpen_image = Image.fromarray(sharpen_effect_img)
-
-        output_buffer = BytesIO()
-        sharpen_image.save(output_buffer, format='JPEG')
-        output_buffer.seek(0)
-
-        filtered_image = InMemoryUploadedFile(
-            output_buffer,
-            'image',
-            f'{image_file.name.split(".")[0]}_sharpen.jpg',
-            'image/jpeg',
-            output_buffer.tell(),
-            None
-        )
-
-        return filtered_image
-
-    def save_filtered_image(self, filtered_image, entered_image, filter_used):
-        filtered_image_obj = FilteredImage.objects.create(
-            image_file=filtered_image,
-            original_image=entered_image,
-            filter_used=filter_used
-        )
-        return filtered_image_obj
-
-
-class SepiaFilter(APIView):
-    def post(self, request, *args, **kwargs):
+    def post(self, request):
         image_file = request.FILES.get('image_file')
-
         if not image_file:
             return Response({'error': 'Image file is required.'}, status=status.HTTP_400_BAD_REQUEST)
+        with open_upload(image_file) as upload:
+            return self.respond(request, upload.perceptual_hash())
 
+    def respond(self, request, value, exclude=None):
+        if not value:
+            return Response({'error': 'Image could not be read.'}, status=status.HTTP_400_BAD_REQUEST)
         try:
-            entered_image = self.save_original_image(image_file)
-            filtered_image = self.apply_sepia_filter(entered_image.image_file)
-            filtered_image_obj = self.save_filtered_image(filtered_image, entered_image, 'sepia_filter')
-
-            entered_image_serializer = EnteredImageSerializer(entered_image)
-            filtered_image_serializer = FilteredImageSerializer(filtered_image_obj)
-
-            return Response({
-                'entered_image': entered_image_serializer.data,
-                'filtered_image': filtered_image_serializer.data
-            }, status=status.HTTP_200_OK)
-
-        except Exception as e:
-            return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-
-    def save_original_image(self, image_file):
-        entered_image = EnteredImage.objects.create(image_file=image_file)
-        return entered_image
-
-    def apply_sepia_filter(self, image_file):
-        original_image = Image.open(image_file)
-
-        sepia_kernel = np.array([[0.272, 0.534, 0.131], [0.349, 0.686, 0.168], [0.393, 0.769, 0.189]])
-
-        original_image_np = np.array(original_image)
-
-        sepia_effect_img = cv2.filter2D(original_image_np, -1, sepia_kernel)
+            max_distance = parse_bounded_int(request, 'distance', getattr(settings, 'FILTER_SIMILAR_DISTANCE', 10),
+                                             0, 64)
+            limit = parse_bounded_int(request, 'limit', 20, 1, 100)
+        except FilterError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        results = find_similar(value, max_distance, limit, exclude)
+        return Response({
+            'perceptual_hash': value,
+            'results': [{'distance': d, 'entered_image': EnteredImageSerializer(entered_image).data}
+                        for d, entered_image in results],
+        }, status=status.HTTP_200_OK)
+
+
+class ImageRecordFileView(View):
+    """The file behind an image record, served from memory until write-behind stores it."""
+
+    def get(self, request, uuid):
+        pending = find_pending(uuid)
+        if pending is not None:
+            if pending.entered_image.uuid == uuid:
+                instance, data = pending.entered_image, pending.upload
+            else:
+                instance, data = pending.filtered_image, pending.encoded
+            content_type = mimetypes.guess_type(instance.image_file.name)[0] or 'application/octet-stream'
+            return HttpResponse(data, content_type=content_type)
+        instance = (EnteredImage.objects.filter(uuid=uuid).first()
+                    or get_object_or_404(FilteredImage, uuid=uuid))
+        if not instance.image_file:
+            raise Http404
+        return FileResponse(instance.image_file.open('rb'))
+
+
+class MetricsView(View):
+    """Filter request metrics in the Prometheus text format."""
 
-        sepia_image = Image.fromarray(sepia_effect_img)
-
-        output_buffer = BytesIO()
-        sepia_image.save(output_buffer, format='JPEG')
-        output_buffer.seek(0)
-
-        filtered_image = InMemoryUploadedFile(
-            output_buffer,
-            'image',
-            f'{image_file.name.split(".")[0]}_sepia.jpg',
-            'image/jpeg',
-            output_buffer.tell(),
-            None
-        )
-
-        return filtered_image
-
-    def save_filtered_image(self, filtered_image, entered_image, filter_used):
-        filtered_image_obj = FilteredImage.objects.create(
-            image_file=filtered_image,
-            original_image=entered_image,
-            filter_used=filter_used
-        )
-        return filtered_image_obj
+    def get(self, request):
+        if not metrics.enabled():
+            raise Http404
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def parse_filter_list(data):
+    """Accept ``filters`` as repeated form fields or one comma separated value."""
+    values = data.getlist('filters') if hasattr(data, 'getlist') else data.get('filters') or []
+    if isinstance(values, str):
+        values = [values]
+    names = [name.strip() for value in values for name in value.split(',')]
+    return [name for name in names if name]
+
+
+def parse_field_list(request, name, allowed):
+    """Comma separated names from the query string, or None when the parameter is absent."""
+    value = request.query_params.get(name)
+    if value is None:
+        return None
+    names = [item.strip() for item in value.split(',') if item.strip()]
+    unknown = [item for item in names if item not in allowed]
+    if unknown:
+        raise FilterError(f'Unknown {name}: {", ".join(unknown)}. Choose from {", ".join(allowed)}.')
+    return names
+
+
+def is_flag_set(request, name):
+    value = request.query_params.get(name, request.data.get(name, ''))
+    return str(value).lower() in ('1', 'true', 'yes', 'on')
+
+
+def parse_tiled(request):
+    # Tiling never changes the output; without the flag it is used for very large images.
+    return True if is_flag_set(request, 'tiled') else None
+
+
+def parse_stride(request):
+    value = request.query_params.get('stride', request.data.get('stride'))
+    if value in (None, ''):
+        return 1
+    try:
+        stride = int(value)
+    except (TypeError, ValueError):
+        stride = 0
+    if stride < 1:
+        raise FilterError('stride must be a positive integer.')
+    return stride
+
+
+def parse_bounded_int(request, name, default, minimum, maximum):
+    value = request.query_params.get(name, request.data.get(name))
+    if value in (None, ''):
+        return default
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        value = None
+    if value is None or not minimum <= value <= maximum:
+        raise FilterError(f'{name} must be an integer between {minimum} and {maximum}.')
+    return value
+
+
+def parse_max_dimension(request):
+    value = request.query_params.get('max_dimension', request.data.get('max_dimension'))
+    if value in (None, ''):
+        return None
+    try:
+        max_dimension = int(value)
+    except (TypeError, ValueError):
+        max_dimension = 0
+    if max_dimension < 16:
+        raise FilterError('max_dimension must be an integer of at least 16.')
+    return max_dimension
+
+
+def parse_encode_options(request, default_format='jpeg'):
+    """Return the output format and the ``engine.encode`` options that differ from its defaults.
+
+    ``format`` is only read from the request body because DRF reserves the
+    ``?format=`` query parameter; without it the ``Accept`` header decides.
+    """
+    name = request.data.get('format') or negotiate(request.META.get('HTTP_ACCEPT'), default_format)
+    output_format = get_format(name)
+    if output_format is None:
+        raise FilterError(f'Unsupported output format: {name}.')
+
+    options = {}
+    if output_format.name != 'jpeg':
+        options['format'] = output_format.name
+    value = request.query_params.get('output_quality', request.data.get('output_quality'))
+    if value not in (None, ''):
+        try:
+            options['quality'] = int(value)
+        except (TypeError, ValueError):
+            raise FilterError('output_quality must be an integer.')
+        if not 1 <= options['quality'] <= 100:
+            raise FilterError('output_quality must be between 1 and 100.')
+    if output_format.name == 'jpeg' and is_flag_set(request, 'progressive'):
+        options['progressive'] = True
+    return output_format, options
+
+
+@contextmanager
+def open_video_path(video_file):
+    """A filesystem path to the upload, which ``cv2.VideoCapture`` needs; small uploads are copied to one."""
+    if hasattr(video_file, 'temporary_file_path'):
+        yield video_file.temporary_file_path()
+        return
+    with tempfile.NamedTemporaryFile(suffix=os.path.splitext(video_file.name)[1]) as copy:
+        for chunk in video_file.chunks():
+            copy.write(chunk)
+        copy.flush()
+        yield copy.name
+
+
+def parse_priority(request):
+    try:
+        return int(request.data.get('priority', 0))
+    except (TypeError, ValueError):
+        raise FilterError('Priority must be an integer.')
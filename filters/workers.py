@@ -0,0 +1,73 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.conf import settings
+
+
+_lock = threading.Lock()
+_thread_pool = None
+_process_pool = None
+_derivative_pool = None
+
+
+def thread_pool_size():
+    return getattr(settings, 'FILTER_THREAD_POOL_SIZE', None) or os.cpu_count()
+
+
+def get_thread_pool():
+    """Shared pool for filter work that releases the GIL (OpenCV calls, encoding)."""
+    global _thread_pool
+    with _lock:
+        if _thread_pool is None:
+            _thread_pool = ThreadPoolExecutor(
+                max_workers=thread_pool_size(),
+                thread_name_prefix='filters',
+            )
+    return _thread_pool
+
+
+def get_derivative_pool():
+    """Small pool for background derivative generation.
+
+    It is kept apart from the shared thread pool, whose tasks requests wait
+    on, so a burst of uploads cannot push request work to the back of the queue.
+    """
+    global _derivative_pool
+    with _lock:
+        if _derivative_pool is None:
+            _derivative_pool = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'FILTER_DERIVATIVE_WORKERS', 2),
+                thread_name_prefix='filter-derivatives',
+            )
+    return _derivative_pool
+
+
+def process_pool_size():
+    return getattr(settings, 'FILTER_PROCESS_POOL_SIZE', None) or os.cpu_count()
+
+
+def get_process_pool():
+    """Shared pool of worker processes for CPU-bound work that holds the GIL.
+
+    Workers are spawned rather than forked so they never inherit the
+    server's threads, locks or database connections.
+    """
+    global _process_pool
+    with _lock:
+        if _process_pool is None:
+            _process_pool = ProcessPoolExecutor(
+                max_workers=process_pool_size(),
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+    return _process_pool
+
+
+def discard_process_pool():
+    """Drop a pool whose worker died so the next caller gets a fresh one."""
+    global _process_pool
+    with _lock:
+        pool, _process_pool = _process_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,187 @@
+"""Write-behind persistence for filter results.
+
+With ``FILTER_WRITE_BEHIND`` on, a request hands its upload and result to
+the writer and responds straight away with unsaved model instances whose
+``uuid`` and file names are already assigned. A background thread then
+stores the files and inserts the rows in batches of up to
+``FILTER_WRITE_BEHIND_BATCH_SIZE``, waiting at most
+``FILTER_WRITE_BEHIND_INTERVAL`` seconds to fill one. Until a result is
+written, ``find`` and ``find_cached`` return it from memory, so lookups
+read their own writes. The queue is flushed when the process exits.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connection
+
+from .db import ResultRow, insert_results
+from .derivatives import schedule_derivatives
+from .models import EnteredImage, FilteredImage
+from .similarity import schedule_perceptual_hash
+
+logger = logging.getLogger(__name__)
+
+PendingWrite = namedtuple('PendingWrite', ['entered_image', 'upload', 'filtered_image', 'encoded', 'cache_key'])
+
+_lock = threading.Lock()
+_writer = None
+
+
+def enabled():
+    return getattr(settings, 'FILTER_WRITE_BEHIND', False)
+
+
+class WriteBehindWriter:
+    def __init__(self, batch_size=32, interval=0.25, max_pending=256):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.by_uuid = {}
+        self.by_cache_key = {}
+        self.thread = None
+        self.stopping = False
+
+    def submit(self, name, data, content_hash, encoded, filter_used, suffix, extension, cache_key,
+               perceptual_hash=''):
+        """Queue an upload's bytes and its result; returns the unsaved ``(EnteredImage, FilteredImage)``.
+
+        Returns None when the queue is full, leaving the caller to write
+        synchronously.
+        """
+        with self.lock:
+            # Every pending write is indexed under two uuids.
+            if self.stopping or len(self.by_uuid) >= 2 * self.max_pending:
+                return None
+            entered_image = EnteredImage(content_hash=content_hash, perceptual_hash=perceptual_hash)
+            stem, upload_extension = os.path.splitext(os.path.basename(name))
+            # The uuid keeps names unique before anything is on disk.
+            stem = f'{stem}_{entered_image.uuid.hex[:8]}'
+            entered_image.image_file.name = entered_image.image_file.field.generate_filename(
+                entered_image, stem + upload_extension)
+            filtered_image = FilteredImage(original_image=entered_image, filter_used=filter_used)
+            filtered_image.image_file.name = filtered_image.image_file.field.generate_filename(
+                filtered_image, f'{stem}_{suffix}{extension}')
+
+            # The upload's buffer goes away with the request, so a memory-mapped one is copied.
+            data = data if isinstance(data, bytes) else bytes(data)
+            item = PendingWrite(entered_image, data, filtered_image, encoded, cache_key)
+            self.by_uuid[entered_image.uuid] = self.by_uuid[filtered_image.uuid] = item
+            self.by_cache_key.setdefault(cache_key, item)
+            self.start()
+        self.queue.put(item)
+        return entered_image, filtered_image
+
+    def find(self, uuid):
+        """The pending write holding the image with this ``uuid``, or None once it is stored."""
+        with self.lock:
+            return self.by_uuid.get(uuid)
+
+    def find_cached(self, cache_key):
+        with self.lock:
+            item = self.by_cache_key.get(cache_key)
+        return item.filtered_image if item else None
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, name='filter-write-behind', daemon=True)
+            self.thread.start()
+
+    def run(self):
+        try:
+            while True:
+                batch = self.next_batch()
+                if batch is None:
+                    return
+                self.write(batch)
+        finally:
+            connection.close()
+
+    def next_batch(self):
+        item = self.queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batch_size:
+            try:
+                item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is None:
+                # Write what we have, then stop.
+                self.queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def write(self, batch):
+        from .cache import maybe_evict_cached_results
+
+        try:
+            for item in batch:
+                for instance, data in ((item.entered_image, item.upload), (item.filtered_image, item.encoded)):
+                    storage = instance.image_file.storage
+                    instance.image_file.name = storage.save(instance.image_file.name, ContentFile(data))
+            cached = insert_results([
+                ResultRow(item.entered_image, item.filtered_image, item.cache_key[2], len(item.encoded))
+                for item in batch])
+            try:
+                for item, filtered_image in zip(batch, cached):
+                    schedule_derivatives(item.entered_image, item.upload)
+                    schedule_perceptual_hash(item.entered_image, item.upload)
+                    if filtered_image is item.filtered_image:
+                        schedule_derivatives(item.filtered_image, item.encoded)
+            except RuntimeError:
+                # The derivative pool is already shut down when flushing at exit.
+                logger.warning('Skipped derivatives and hashes for %d filter results', len(batch), exc_info=True)
+            maybe_evict_cached_results()
+        except Exception:
+            logger.exception('Could not write %d filter results', len(batch))
+        finally:
+            with self.lock:
+                for item in batch:
+                    self.by_uuid.pop(item.entered_image.uuid, None)
+                    self.by_uuid.pop(item.filtered_image.uuid, None)
+                    if self.by_cache_key.get(item.cache_key) is item:
+                        del self.by_cache_key[item.cache_key]
+
+    def flush(self, timeout=None):
+        """Stop accepting results and wait until everything queued is written."""
+        with self.lock:
+            self.stopping = True
+            thread = self.thread
+        if thread is not None and thread.is_alive():
+            self.queue.put(None)
+            thread.join(timeout)
+
+
+def get_writer():
+    global _writer
+    with _lock:
+        if _writer is None:
+            _writer = WriteBehindWriter(
+                batch_size=getattr(settings, 'FILTER_WRITE_BEHIND_BATCH_SIZE', 32),
+                interval=getattr(settings, 'FILTER_WRITE_BEHIND_INTERVAL', 0.25),
+                max_pending=getattr(settings, 'FILTER_WRITE_BEHIND_MAX_PENDING', 256),
+            )
+            atexit.register(_writer.flush)
+    return _writer
+
+
+def find_pending(uuid):
+    return _writer.find(uuid) if _writer is not None else None
+
+
+def find_pending_result(content_hash, filter_used, params_key):
+    if _writer is None:
+        return None
+    return _writer.find_cached((content_hash, filter_used, params_key))
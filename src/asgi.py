@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'src.settings')
 
 application = get_asgi_application()
+
+# Run filter jobs queued before the server (re)started; see filters.jobs.
+from filters.jobs import start_inline_worker  # noqa: E402
+
+start_inline_worker()
@@ -73,6 +73,13 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Keep connections open between requests, checking them before reuse.
+        'CONN_MAX_AGE': 60,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            # Seconds a writer waits for the lock before "database is locked".
+            'timeout': 20,
+        },
     }
 }
 
@@ -131,4 +138,110 @@ REST_FRAMEWORK = {
 CORS_ORIGIN_ALLOW_ALL = True
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:3000",
-]
\ No newline at end of file
+]
+
+# Filter result cache: least recently used results are evicted once they are
+# older than FILTER_CACHE_MAX_AGE seconds or the cache exceeds FILTER_CACHE_MAX_BYTES.
+# Set either to None to disable that limit. New results trigger eviction at most once
+# every FILTER_CACHE_EVICT_INTERVAL seconds; None leaves it to the evict_filter_cache command.
+
+FILTER_CACHE_MAX_AGE = 60 * 60 * 24 * 30
+FILTER_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+FILTER_CACHE_EVICT_INTERVAL = 60
+
+# Worker threads used to run several filters over one upload at once.
+# None uses one thread per CPU.
+
+FILTER_THREAD_POOL_SIZE = None
+
+# Asynchronous filter jobs (POST with async=1). Jobs are queued in the
+# database and run on a pool of FILTER_PROCESS_POOL_SIZE worker processes
+# (None uses one per CPU), at most FILTER_JOB_CONCURRENCY at a time. Set
+# FILTER_JOBS_INLINE_WORKER to False to run them with
+# `manage.py run_filter_jobs` instead of inside the web server. Jobs still
+# running after FILTER_JOB_STALE_AFTER seconds are taken to have lost their
+# worker (e.g. to a restart) and are queued again.
+
+FILTER_PROCESS_POOL_SIZE = None
+FILTER_JOB_CONCURRENCY = 2
+FILTER_JOBS_INLINE_WORKER = True
+FILTER_JOB_STALE_AFTER = 600
+
+# Batch filtering (/filters/batch/): maximum images per request and how many
+# finished images are written per bulk insert. Zip archives are rejected before
+# anything is extracted if one member is larger than FILTER_BATCH_MAX_FILE_BYTES or
+# all of them together are larger than FILTER_BATCH_MAX_BYTES (None disables a limit).
+
+FILTER_BATCH_MAX_FILES = 500
+FILTER_BATCH_MAX_FILE_BYTES = 50 * 1024 * 1024
+FILTER_BATCH_MAX_BYTES = 500 * 1024 * 1024
+FILTER_BATCH_WRITE_SIZE = 32
+
+# Downscaled copies (longest side in pixels) generated in the background for
+# every stored image and served from /filters/derivatives/ with immutable
+# cache headers. An empty tuple disables them. They are generated on their
+# own pool of FILTER_DERIVATIVE_WORKERS threads, so they never queue ahead of
+# request work.
+
+FILTER_DERIVATIVE_SIZES = (128, 512, 1024)
+FILTER_DERIVATIVE_WORKERS = 2
+
+# Per-stage timings for filter requests, sent as a Server-Timing header and
+# aggregated per process at /filters/metrics/ in the Prometheus text format.
+
+FILTER_METRICS_ENABLED = True
+
+# Write-behind persistence: filter responses return right away with the
+# result's uuid while a background thread stores files and inserts rows in
+# batches of FILTER_WRITE_BEHIND_BATCH_SIZE, waiting up to
+# FILTER_WRITE_BEHIND_INTERVAL seconds to fill one. Past
+# FILTER_WRITE_BEHIND_MAX_PENDING queued results, requests write synchronously.
+
+FILTER_WRITE_BEHIND = False
+FILTER_WRITE_BEHIND_BATCH_SIZE = 32
+FILTER_WRITE_BEHIND_INTERVAL = 0.25
+FILTER_WRITE_BEHIND_MAX_PENDING = 256
+
+# Video filtering (/filters/video/): clips longer than FILTER_VIDEO_MAX_FRAMES
+# are rejected; previews keep the first FILTER_VIDEO_PREVIEW_SECONDS, shrunk to
+# FILTER_VIDEO_PREVIEW_DIMENSION pixels unless max_dimension is given.
+
+FILTER_VIDEO_MAX_FRAMES = 9000
+FILTER_VIDEO_PREVIEW_SECONDS = 3
+FILTER_VIDEO_PREVIEW_DIMENSION = 480
+
+# Perceptual-hash lookups: /filters/similar/ returns stored uploads within
+# FILTER_SIMILAR_DISTANCE bits (of 64) by default. When
+# FILTER_NEAR_DUPLICATE_DISTANCE is set, filter requests that miss the cache
+# reuse the result of a stored upload at most that many bits away; None turns
+# this off, since the reused result was made from a different file.
+
+FILTER_SIMILAR_DISTANCE = 10
+FILTER_NEAR_DUPLICATE_DISTANCE = None
+
+# SQLite write path: PRAGMAs run on every new connection (WAL lets reads run
+# alongside the writer; synchronous=NORMAL only syncs at checkpoints). With
+# FILTER_GROUP_COMMIT, concurrent filter requests insert their rows together,
+# up to FILTER_GROUP_COMMIT_MAX_BATCH requests per transaction.
+
+FILTER_SQLITE_PRAGMAS = {'journal_mode': 'WAL', 'synchronous': 'NORMAL'}
+FILTER_GROUP_COMMIT = True
+FILTER_GROUP_COMMIT_MAX_BATCH = 64
+
+# Admission control for filter requests that miss the cache. Each request's
+# cost is estimated from the image header (megapixels times the filters'
+# per-pixel cost) and must fit in a per-process budget of
+# FILTER_ADMISSION_CPU_BUDGET units (None: 40 per core) and
+# FILTER_ADMISSION_MEMORY_BUDGET bytes. Requests wait up to
+# FILTER_ADMISSION_QUEUE_TIMEOUT seconds in a line of at most
+# FILTER_ADMISSION_MAX_QUEUE, then get 503 with Retry-After. Images up to
+# FILTER_ADMISSION_FAST_LANE_PIXELS use a fast lane holding
+# FILTER_ADMISSION_FAST_LANE_SHARE of the budget.
+
+FILTER_ADMISSION_ENABLED = True
+FILTER_ADMISSION_CPU_BUDGET = None
+FILTER_ADMISSION_MEMORY_BUDGET = 2 * 2 ** 30
+FILTER_ADMISSION_QUEUE_TIMEOUT = 5.0
+FILTER_ADMISSION_MAX_QUEUE = 64
+FILTER_ADMISSION_FAST_LANE_PIXELS = 2000000
+FILTER_ADMISSION_FAST_LANE_SHARE = 0.2